@@ -0,0 +1,327 @@
+"""
+Achievement engine.
+
+Computes the percentage of every automatic badge (a ClassBadge with criteria)
+for every enrollment of a class. The grades of the class are loaded once into
+student × assignment task matrices, and each criterion is evaluated for all
+students at once with NumPy, so the number of queries doesn't depend on the
+number of students, badges or criteria.
+"""
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .models import CourseClass, Enrollment, AssignmentTask, Grade, ClassBadge, ClassBadgeCriteria, Achievement
+from . import caching, deferred, metrics
+
+
+def matching_assignment_tasks(assignment_tasks, assignment_id, task_id):
+    """
+    Positions, in a list of (id, assignment_id, task_id, ...) tuples, of the
+    assignment tasks read by a criterion with this assignment and/or task.
+    """
+    return [
+        position for position, (_, task_assignment_id, task_task_id, *_) in enumerate(assignment_tasks)
+        if (assignment_id == None or task_assignment_id == assignment_id)
+        and (task_id == None or task_task_id == task_id)
+    ]
+
+
+class ClassGrades:
+    """
+    Grades of a class as matrices with one row per enrollment and one column per
+    assignment task:
+      - scores: Grade.score (0 where there is no grade)
+      - points: Grade.points (0 where there is no grade)
+      - is_graded: True where there is a grade
+      - is_canceled: True where the grade is canceled
+    """
+
+    def __init__(self, course_class, enrollment_ids=None):
+        enrollments = Enrollment.objects.filter(course_class=course_class)
+        if enrollment_ids != None:
+            enrollments = enrollments.filter(id__in=enrollment_ids)
+        self.enrollment_ids = list(enrollments.order_by('id').values_list('id', flat=True))
+
+        self.assignment_tasks = list(AssignmentTask.objects.filter(
+            course_class=course_class
+        ).order_by('id').values_list('id', 'assignment_id', 'task_id', 'points', 'is_optional'))
+
+        grades = Grade.objects.filter(
+            assignment_task__course_class=course_class,
+            enrollment__course_class=course_class,
+        )
+        if enrollment_ids != None:
+            grades = grades.filter(enrollment_id__in=self.enrollment_ids)
+        grades = list(grades.values_list('enrollment_id', 'assignment_task_id', 'score', 'is_canceled'))
+
+        row_of = {enrollment_id: row for row, enrollment_id in enumerate(self.enrollment_ids)}
+        column_of = {assignment_task[0]: column for column, assignment_task in enumerate(self.assignment_tasks)}
+
+        shape = (len(self.enrollment_ids), len(self.assignment_tasks))
+        self.scores = np.zeros(shape)
+        self.is_graded = np.zeros(shape, dtype=bool)
+        self.is_canceled = np.zeros(shape, dtype=bool)
+
+        if len(grades) > 0:
+            rows = np.array([row_of[grade[0]] for grade in grades], dtype=int)
+            columns = np.array([column_of[grade[1]] for grade in grades], dtype=int)
+            self.scores[rows, columns] = [grade[2] for grade in grades]
+            self.is_graded[rows, columns] = True
+            self.is_canceled[rows, columns] = [grade[3] for grade in grades]
+
+        # Same rules as Grade.points
+        task_points = np.array(
+            [np.nan if assignment_task[3] == None else assignment_task[3] for assignment_task in self.assignment_tasks]
+        )
+        self.points = np.where(
+            np.isnan(task_points),
+            np.round(self.scores),
+            np.round(self.scores * np.nan_to_num(task_points)),
+        )
+        self.points[self.is_canceled | ~self.is_graded] = 0
+
+    def columns(self, assignment_id=None, task_id=None):
+        """
+        Columns of the assignment tasks read by a criterion with this assignment and/or task.
+        """
+        return matching_assignment_tasks(self.assignment_tasks, assignment_id, task_id)
+
+    def assignment_points(self, assignment_id):
+        """
+        Same as Assignment.points(): the points of the mandatory tasks, or None if there is none.
+        """
+        points = [
+            assignment_task[3] for assignment_task in self.assignment_tasks
+            if assignment_task[1] == assignment_id and not assignment_task[4] and assignment_task[3] != None
+        ]
+        return sum(points) if len(points) > 0 else None
+
+
+def criteria_results(class_grades, criteria):
+    """
+    Returns the vector (one value per enrollment) that a criterion compares with its goal,
+    or None if the criterion can't be evaluated and must be ignored.
+    """
+    goal_type_is_percentage = (criteria.goal_type == ClassBadgeCriteria.PERCENTAGE)
+    columns = class_grades.columns(criteria.assignment_id, criteria.task_id)
+
+    if criteria.assignment_id != None and criteria.task_id != None:
+        if len(columns) == 0:
+            return np.zeros(len(class_grades.enrollment_ids))
+        elif goal_type_is_percentage:
+            return class_grades.scores[:, columns[0]]
+        else:
+            return class_grades.points[:, columns[0]]
+
+    elif criteria.assignment_id != None:
+        result = class_grades.points[:, columns].sum(axis=1)
+        if goal_type_is_percentage:
+            points = class_grades.assignment_points(criteria.assignment_id)
+            if points == None or points == 0:
+                return None
+            result = result / points
+        return result
+
+    else:
+        if not goal_type_is_percentage:
+            return class_grades.points[:, columns].sum(axis=1)
+        elif len(columns) == 0:
+            return None
+        else:
+            is_complete = class_grades.is_graded[:, columns] & (class_grades.scores[:, columns] == 1)
+            return is_complete.sum(axis=1) / len(columns)
+
+def compute_percentages(course_class, enrollment_ids=None, class_badge_ids=None):
+    """
+    Computes the achievement percentages of a class (a CourseClass or its id),
+    optionally only for some enrollments and/or class badges.
+    Returns a dict {(enrollment_id, class_badge_id): percentage}.
+    Badges without criteria are manual, so they are not in the result.
+    """
+    criteria_list = ClassBadgeCriteria.objects.filter(
+        class_badge__course_class=course_class
+    ).select_related('class_badge').order_by('class_badge_id', 'id')
+    if class_badge_ids != None:
+        criteria_list = criteria_list.filter(class_badge_id__in=class_badge_ids)
+
+    criteria_by_badge = {}
+    for criteria in criteria_list:
+        criteria_by_badge.setdefault(criteria.class_badge, []).append(criteria)
+    if len(criteria_by_badge) == 0:
+        return {}
+
+    class_grades = ClassGrades(course_class, enrollment_ids)
+
+    percentages = {}
+    for class_badge, badge_criteria in criteria_by_badge.items():
+        criteria_percentages = []
+
+        for criteria in badge_criteria:
+            result = criteria_results(class_grades, criteria)
+            if result is None:
+                continue
+
+            if not criteria.accepts_partial_goal:
+                result = np.where(result < criteria.goal, 0.0, result)
+
+            if criteria.goal == 0:
+                percentage = np.ones(len(result))
+            else:
+                percentage = np.clip(result / criteria.goal, 0, 1)
+
+            criteria_percentages.append(percentage)
+
+        if len(criteria_percentages) == 0:
+            continue
+
+        if class_badge.aggregation_type_for_criteria == ClassBadge.AND:
+            # Summed one criterion at a time, to give the same floats as sum()
+            total = np.zeros(len(class_grades.enrollment_ids))
+            for percentage in criteria_percentages:
+                total = total + percentage
+            badge_percentages = total / len(criteria_percentages)
+        else:
+            badge_percentages = np.max(criteria_percentages, axis=0)
+
+        for enrollment_id, percentage in zip(class_grades.enrollment_ids, badge_percentages.tolist()):
+            percentages[(enrollment_id, class_badge.id)] = percentage
+
+    return percentages
+
+
+def saved_percentages(percentages):
+    """
+    The saved percentages of the achievements in a compute_percentages result,
+    as a dict {(enrollment_id, class_badge_id): percentage}, in one query.
+    """
+    enrollment_ids = {enrollment_id for enrollment_id, _ in percentages}
+    class_badge_ids = {class_badge_id for _, class_badge_id in percentages}
+    if len(percentages) == 0:
+        return {}
+
+    return {
+        (enrollment_id, class_badge_id): percentage
+        for enrollment_id, class_badge_id, percentage in Achievement.objects.filter(
+            enrollment_id__in=enrollment_ids,
+            class_badge_id__in=class_badge_ids,
+        ).values_list('enrollment_id', 'class_badge_id', 'percentage')
+    }
+
+def save_percentages(percentages):
+    """
+    Writes the result of compute_percentages to the Achievement rows, skipping
+    the ones that didn't change, with batched upserts in a single transaction.
+    Returns a dict with the number of 'inserted', 'updated' and 'unchanged' rows.
+    """
+    saved = saved_percentages(percentages)
+
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    changed = []
+    for (enrollment_id, class_badge_id), percentage in percentages.items():
+        saved_percentage = saved.get((enrollment_id, class_badge_id))
+        if saved_percentage == percentage:
+            counts['unchanged'] += 1
+            continue
+
+        counts['inserted' if saved_percentage == None else 'updated'] += 1
+        changed.append(Achievement(enrollment_id=enrollment_id, class_badge_id=class_badge_id, percentage=percentage))
+
+    if len(changed) > 0:
+        with transaction.atomic():
+            Achievement.objects.bulk_create(
+                changed,
+                batch_size=500,
+                update_conflicts=True,
+                unique_fields=['enrollment', 'class_badge'],
+                update_fields=['percentage'],
+            )
+
+    return counts
+
+def refresh_class(course_class):
+    """
+    Recomputes and saves every achievement of a class, and records when it was done.
+    Returns the counts of save_percentages.
+    """
+    with metrics.ACHIEVEMENT_REFRESH_DURATION.time():
+        counts = save_percentages(compute_percentages(course_class))
+    CourseClass.objects.filter(pk=course_class.id).update(achievements_refreshed_datetime=timezone.now())
+    if counts['inserted'] + counts['updated'] > 0:
+        caching.bump_class_generation(course_class.id)
+    return counts
+
+def diff_percentages(percentages):
+    """
+    Compares computed percentages with the saved achievements.
+    Returns a list of (enrollment_id, class_badge_id, saved percentage or None, new percentage)
+    for the achievements that would change.
+    """
+    saved = saved_percentages(percentages)
+
+    return [
+        (enrollment_id, class_badge_id, saved.get((enrollment_id, class_badge_id)), percentage)
+        for (enrollment_id, class_badge_id), percentage in sorted(percentages.items())
+        if saved.get((enrollment_id, class_badge_id)) != percentage
+    ]
+
+
+def affected_class_badge_ids(course_class, assignment_tasks):
+    """
+    Ids of the class badges with a criterion that reads one of these assignment
+    tasks, given as (assignment_id, task_id) pairs, so deleted assignment tasks
+    can be matched too.
+    """
+    assignment_tasks = [(None, assignment_id, task_id) for assignment_id, task_id in set(assignment_tasks)]
+    return {
+        class_badge_id
+        for class_badge_id, assignment_id, task_id in ClassBadgeCriteria.objects.filter(
+            class_badge__course_class=course_class
+        ).values_list('class_badge_id', 'assignment_id', 'task_id')
+        if len(matching_assignment_tasks(assignment_tasks, assignment_id, task_id)) > 0
+    }
+
+def refresh_affected_achievements(course_class, assignment_task_ids, enrollment_ids=None):
+    """
+    Recomputes only the achievements whose criteria read one of these assignment
+    tasks, for these enrollments (or the whole class if enrollment_ids is None).
+    Used after grades or assignment tasks change, so badges are updated right away.
+    """
+    assignment_tasks = AssignmentTask.objects.filter(id__in=assignment_task_ids).values_list('assignment_id', 'task_id')
+    return refresh_achievements_reading(course_class, assignment_tasks, enrollment_ids)
+
+def refresh_achievements_reading(course_class, assignment_tasks, enrollment_ids=None):
+    """
+    Same as refresh_affected_achievements, with the assignment tasks given as
+    (assignment_id, task_id) pairs. Returns the counts of save_percentages.
+    """
+    class_badge_ids = affected_class_badge_ids(course_class, assignment_tasks)
+    if len(class_badge_ids) == 0:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    with metrics.ACHIEVEMENT_REFRESH_DURATION.time():
+        return save_percentages(compute_percentages(course_class, enrollment_ids, class_badge_ids))
+
+def schedule_refresh(course_class_id, assignment_tasks, enrollment_ids=None):
+    """
+    Refreshes the achievements of a class that read these assignment tasks
+    ((assignment_id, task_id) pairs), for these enrollments or the whole class
+    if enrollment_ids is None, when the current transaction commits. All the
+    changes of a transaction are merged, so it is done once per class.
+    """
+    def add(work):
+        work.setdefault('assignment_tasks', set()).update(assignment_tasks)
+        if enrollment_ids == None:
+            work['enrollment_ids'] = None
+        elif work.setdefault('enrollment_ids', set()) != None:
+            work['enrollment_ids'].update(enrollment_ids)
+
+    deferred.merge_on_commit(
+        ('achievements', course_class_id), add, lambda work: refresh_after_commit(course_class_id, work)
+    )
+
+def refresh_after_commit(course_class_id, work):
+    counts = refresh_achievements_reading(course_class_id, work['assignment_tasks'], work['enrollment_ids'])
+    # The pages may have been cached between the commit and the refresh
+    if counts['inserted'] + counts['updated'] > 0:
+        caching.bump_class_generation(course_class_id)
@@ -3,9 +3,11 @@ from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.apps import apps
 from django.shortcuts import render
-from course.management.commands import refreshachievements
 from .models import *
-from .forms.forms import UserCreationForm, CaptchaPasswordResetForm, NewStudentForm, NewStudentEnrollmentFormSet
+from .forms.forms import UserCreationForm, CaptchaPasswordResetForm, NewStudentForm, NewStudentEnrollmentFormSet, GradeImportForm, RosterImportForm
+from . import imports, invitations, jobs
+from .metrics import MARKDOWN_RENDER_DURATION
+from django.contrib.sites.shortcuts import get_current_site
 from django.forms import BaseInlineFormSet, ModelForm
 from django.forms.widgets import TextInput
 from django.contrib.auth.admin import UserAdmin
@@ -13,13 +15,20 @@ from django.contrib.auth.models import User
 from django.contrib import messages
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import ngettext
-from django.urls import path
+from django.urls import path, reverse
+from django.utils.html import format_html
+from django.db import transaction
+from django.db.models import Prefetch
 import markdown2
+import io
+import re
+import time
 
 from django.utils.formats import date_format
 
 def invite_user(modeladmin, request, queryset):
-    for user in queryset:
+    users = list(queryset)
+    for user in users:
         if user.has_usable_password():
             messages.error(
                 request,
@@ -33,22 +42,14 @@ def invite_user(modeladmin, request, queryset):
             )
             return
 
-    for user in queryset:
-        reset_form = CaptchaPasswordResetForm({'email': user.email})
-        reset_form.is_valid()
-        reset_form.save(
-            request=request,
-            use_https=request.is_secure(),
-            subject_template_name='email/password_creation_subject.txt',
-            html_email_template_name='email/password_creation_email.html',
-        )
+    count = invitations.enqueue(users, get_current_site(request).domain, request.is_secure())
 
     success_message = ngettext(
-        "%(count)d email sent successfully!",
-        "%(count)d emails sent successfully!",
-        queryset.count()
+        "%(count)d invitation queued, it will be sent in a few minutes.",
+        "%(count)d invitations queued, they will be sent in a few minutes.",
+        count
     )% {
-        'count': queryset.count(),
+        'count': count,
     }
     messages.success(request, success_message)
 
@@ -108,60 +109,153 @@ class CourseAdmin(BasicAdmin):
 admin.site.register(Course, CourseAdmin)
 
 
-def duplicate_course_class(modeladmin, request, queryset):
-    for course_class in queryset:
+def find_free_copy_code(code):
+    """
+    The first "code (n)", with n >= 2, not used by any class, found with a single query.
+    """
+    copy_code_pattern = re.compile(r'^%s \((\d+)\)$' % re.escape(code))
+    used_copy_numbers = set()
+    for existing_code in CourseClass.objects.filter(code__startswith=code + ' (').values_list('code', flat=True):
+        match = copy_code_pattern.match(existing_code)
+        if match != None:
+            used_copy_numbers.add(int(match.group(1)))
+
+    copy_number = 2
+    while copy_number in used_copy_numbers:
+        copy_number += 1
+    return "%s (%d)" % (code, copy_number)
+
+def clone_course_class(course_class):
+    """
+    Copies a class with its instructors, tasks, widgets, posts and badges (with
+    their criteria), using bulk inserts in a single transaction.
+    """
+    with transaction.atomic():
         new_course_class = CourseClass.objects.get(pk=course_class.id)
         new_course_class.id = None
-        
-        # Duplicate course class, adding a (number) on the code
-        copy_number = 2
-        while True:
-            new_code = "%s (%d)" % (course_class.code, copy_number)
-            if CourseClass.objects.filter(code=new_code).first() == None:
-                new_course_class.code = new_code
-                break
-            else:
-                copy_number += 1
+        new_course_class.code = find_free_copy_code(course_class.code)
+        # The clone has no achievements yet, and its own cached data
+        new_course_class.achievements_refreshed_datetime = None
+        new_course_class.cache_generation = time.time_ns()
         new_course_class.save()
 
         # Duplicate instructors, tasks, widgets and posts from original course class
         models = [ClassInstructor, AssignmentTask, Widget, Post]
         for model in models:
-            existing_objects = model.objects.filter(course_class=course_class).order_by('id')
-            for existing_object in existing_objects:
-                new_object = existing_object
+            new_objects = list(model.objects.filter(course_class=course_class).order_by('id'))
+            for new_object in new_objects:
                 new_object.id = None
                 new_object.course_class = new_course_class
-                new_object.save()
-        
-        # Duplicate badges tasks from original course class
-        class_badges = ClassBadge.objects.filter(course_class=course_class).order_by('id')
-        for class_badge in class_badges:
-            criteria_list = ClassBadgeCriteria.objects.filter(class_badge=class_badge).order_by('id') # this line must come before we change the id in class_badge
+            model.objects.bulk_create(new_objects, batch_size=500)
 
+        # Duplicate badges, keeping the new id of each one to copy their criteria
+        class_badges = list(ClassBadge.objects.filter(course_class=course_class).order_by('id'))
+        old_class_badge_ids = [class_badge.id for class_badge in class_badges]
+        for class_badge in class_badges:
             class_badge.id = None
             class_badge.course_class = new_course_class
-            class_badge.save()
+        ClassBadge.objects.bulk_create(class_badges, batch_size=500)
+        new_class_badge_ids = dict(zip(old_class_badge_ids, [class_badge.id for class_badge in class_badges]))
+
+        criteria_list = list(ClassBadgeCriteria.objects.filter(
+            class_badge__course_class=course_class
+        ).order_by('id'))
+        for criteria in criteria_list:
+            criteria.id = None
+            criteria.class_badge_id = new_class_badge_ids[criteria.class_badge_id]
+        ClassBadgeCriteria.objects.bulk_create(criteria_list, batch_size=500)
+
+    # Bulk inserts skip Widget.save, which renders the widgets once in advance
+    for markdown_text in set(Widget.objects.filter(course_class=new_course_class).values_list('markdown_text', flat=True)):
+        render_widget_markdown(markdown_text)
 
-            for criteria in criteria_list:
-                criteria.id = None
-                criteria.class_badge = class_badge
-                criteria.save()
+    return new_course_class
+
+def duplicate_course_class(modeladmin, request, queryset):
+    for course_class in queryset:
+        clone_course_class(course_class)
 
             
 duplicate_course_class.short_description = _("Duplicate course class")
 
 def refresh_achievements(modeladmin, request, queryset):
-    refreshachievements.refresh_achievements(queryset)
+    job = jobs.enqueue(Job.REFRESH_ACHIEVEMENTS, queryset, request.user)
+    messages.success(
+        request,
+        format_html(
+            _("Achievements will be refreshed in the background: <a href='{}'>follow the progress</a>."),
+            reverse('admin:course_job_change', args=[job.id])
+        )
+    )
 
 
 refresh_achievements.short_description = _("Refresh achievements")
 
 class CourseClassAdmin(BasicAdmin):
-    list_display = ('code', 'course', 'start_date', 'end_date')
+    list_display = ('code', 'course', 'start_date', 'end_date', 'achievements_refreshed_datetime')
+    list_select_related = ('course',)
     ordering = ('-start_date', 'course', 'code')
     actions = (duplicate_course_class, refresh_achievements)
 
+    def get_urls(self):
+        return [
+            path(
+                '<path:object_id>/import-grades/',
+                self.admin_site.admin_view(self.import_grades_view),
+                name='course_courseclass_import_grades'
+            ),
+        ] + super().get_urls()
+
+    def import_grades_view(self, request, object_id):
+        course_class = self.get_object(request, object_id)
+        if course_class == None or not self.has_change_permission(request, course_class):
+            return self._get_obj_does_not_exist_redirect(request, self.opts, object_id)
+
+        errors = None
+        if request.method == 'POST':
+            form = GradeImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                uploaded_file = form.cleaned_data['file']
+                dry_run = form.cleaned_data['dry_run']
+                stream = io.TextIOWrapper(uploaded_file.file, encoding='utf-8-sig', newline='')
+                counts, errors = imports.import_grades(
+                    course_class, stream, imports.guess_format(uploaded_file.name), dry_run
+                )
+
+                if len(errors) == 0:
+                    messages.success(
+                        request,
+                        (_("Dry run: %(created)d grades would be created, %(updated)d updated and %(unchanged)d unchanged")
+                         if dry_run else
+                         _("%(created)d grades created, %(updated)d updated and %(unchanged)d unchanged")) % counts
+                    )
+                    if not dry_run:
+                        return HttpResponseRedirect('../')
+                else:
+                    messages.error(
+                        request,
+                        ngettext(
+                            "%(count)d invalid line, no grades were imported",
+                            "%(count)d invalid lines, no grades were imported",
+                            len(errors)
+                        ) % {'count': len(errors)}
+                    )
+        else:
+            form = GradeImportForm()
+
+        return TemplateResponse(
+            request,
+            'admin/course/courseclass/import_grades.html',
+            {
+                **self.admin_site.each_context(request),
+                'opts': self.opts,
+                'original': course_class,
+                'title': _("Import grades"),
+                'form': form,
+                'errors': errors,
+            }
+        )
+
 admin.site.register(CourseClass, CourseClassAdmin)
 
 
@@ -227,12 +321,26 @@ class GradeInline(admin.TabularInline):
     formset = GradeInlineFormSet
     raw_id_fields = ("enrollment",)
     
+
+class CourseClassListFilter(admin.RelatedFieldListFilter):
+    # The class names include the course code, so the courses are loaded with the classes
+    def field_choices(self, field, request, model_admin):
+        return [
+            (course_class.id, str(course_class))
+            for course_class in CourseClass.objects.select_related('course').order_by('-start_date', 'course__code', 'code')
+        ]
+
+
 class AssignmentTaskAdmin(BasicAdmin):
     inlines = [GradeInline]
     list_display = ('__str__', 'points', 'course_class')
-    list_filter = ('course_class',)
+    list_filter = (('course_class', CourseClassListFilter),)
     ordering = ('-course_class', 'assignment_id', 'id',)
 
+    def get_queryset(self, request):
+        # The names of the assignment, the task and the class come from a single query
+        return super().get_queryset(request).select_related('assignment', 'task', 'course_class__course')
+
     def course(self, obj):
         return obj.assignment.course
 
@@ -289,16 +397,31 @@ def last_login_formatted_for_enrolment(self):
     return last_login_formatted(self.student.user)
     
 last_login_formatted_for_enrolment.short_description = _('Last Login')
+last_login_formatted_for_enrolment.admin_order_field = 'student__user__last_login'
+
 
 class EnrollmentAdmin(BasicAdmin):
     inlines = [SimpleGradeInline]
     list_display = ('student', 'id_number', 'course_class', 'total_score', 'lost_lives', last_login_formatted_for_enrolment)
-    list_filter = ('course_class',)
+    list_filter = (('course_class', CourseClassListFilter),)
     ordering = ('-course_class__start_date', 'student__full_name')
     search_fields = ('student__full_name',)
+
+    def get_queryset(self, request):
+        # Everything shown in the list comes from a single query
+        return super().get_queryset(request).select_related('student__user', 'course_class__course')
     
     def id_number(self, object):
         return object.student.id_number
+
+    id_number.short_description = _('Id number')
+    id_number.admin_order_field = 'student__id_number'
+    
+    def total_score(self, object):
+        return object.total_score()
+
+    total_score.short_description = _('Total score')
+    total_score.admin_order_field = 'total_xp'
     
 
 admin.site.register(Enrollment, EnrollmentAdmin)
@@ -311,6 +434,15 @@ class StudentAdmin(BasicAdmin):
     ordering = ('full_name',)
     raw_id_fields = ("user",)
 
+    def get_queryset(self, request):
+        # The enrollments column is built from one extra query for the whole page
+        return super().get_queryset(request).prefetch_related(
+            Prefetch(
+                'enrollment_set',
+                queryset=Enrollment.objects.select_related('course_class__course').order_by('course_class__start_date', 'id')
+            )
+        )
+
     # Change Add Student form to create the user, student and enrolments at the same time
     def add_view(self, request, form_url='', extra_context=None):
         self.form = NewStudentForm
@@ -356,10 +488,99 @@ class StudentAdmin(BasicAdmin):
 
         return super().change_view(request, object_id, form_url, extra_context)
 
+    def get_urls(self):
+        return [
+            path(
+                'import-roster/',
+                self.admin_site.admin_view(self.import_roster_view),
+                name='course_student_import_roster'
+            ),
+        ] + super().get_urls()
+
+    def import_roster_view(self, request):
+        if not self.has_add_permission(request):
+            return HttpResponseRedirect('../')
+
+        errors = None
+        invited_users = None
+        if request.method == 'POST':
+            form = RosterImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                uploaded_file = form.cleaned_data['file']
+                dry_run = form.cleaned_data['dry_run']
+                stream = io.TextIOWrapper(uploaded_file.file, encoding='utf-8-sig', newline='')
+                counts, errors, invited_users = imports.import_roster(
+                    form.cleaned_data['course_class'], stream, imports.guess_format(uploaded_file.name), dry_run
+                )
+
+                if len(errors) == 0:
+                    messages.success(
+                        request,
+                        (_("Dry run: %(users_created)d users and %(students_created)d students would be created, %(enrolled)d students enrolled and %(already_enrolled)d were already enrolled")
+                         if dry_run else
+                         _("%(users_created)d users and %(students_created)d students created, %(enrolled)d students enrolled and %(already_enrolled)d were already enrolled")) % counts
+                    )
+                    if dry_run:
+                        invited_users = None
+                    elif form.cleaned_data['send_invitations'] and len(invited_users) > 0:
+                        count = invitations.enqueue(invited_users, get_current_site(request).domain, request.is_secure())
+                        messages.success(
+                            request,
+                            ngettext(
+                                "%(count)d invitation queued, it will be sent in a few minutes.",
+                                "%(count)d invitations queued, they will be sent in a few minutes.",
+                                count
+                            ) % {'count': count}
+                        )
+                else:
+                    invited_users = None
+                    messages.error(
+                        request,
+                        ngettext(
+                            "%(count)d invalid line, no students were imported",
+                            "%(count)d invalid lines, no students were imported",
+                            len(errors)
+                        ) % {'count': len(errors)}
+                    )
+        else:
+            form = RosterImportForm()
+
+        return TemplateResponse(
+            request,
+            'admin/course/student/import_roster.html',
+            {
+                **self.admin_site.each_context(request),
+                'opts': self.opts,
+                'title': _("Import roster"),
+                'form': form,
+                'errors': errors,
+                'invited_users': invited_users,
+            }
+        )
+
     
 admin.site.register(Student, StudentAdmin)
 
 
+def retry_invitations(modeladmin, request, queryset):
+    queryset.exclude(status__in=[Invitation.SENT, Invitation.SENDING]).update(
+        status=Invitation.PENDING, attempts=0, next_attempt_datetime=timezone.now()
+    )
+
+retry_invitations.short_description = _("Retry selected invitations")
+
+class InvitationAdmin(BasicAdmin):
+    list_display = ('user', 'domain', 'status', 'attempts', 'created_datetime', 'sent_datetime', 'last_error')
+    list_filter = ('status',)
+    list_select_related = ('user',)
+    ordering = ('-created_datetime',)
+    search_fields = ('user__email',)
+    raw_id_fields = ('user',)
+    actions = (retry_invitations,)
+
+admin.site.register(Invitation, InvitationAdmin)
+
+
 class ClassInstructorInline(admin.TabularInline):
     model = ClassInstructor
     ordering = ('course_class_id',)
@@ -383,7 +604,8 @@ class PostAdmin(BasicAdmin):
     list_filter = ('course_class',)
     
     def save_model(self, request, post, form, change):
-        post.html_code = markdown2.markdown(post.markdown_text, extras=["tables", "fenced-code-blocks"])
+        with MARKDOWN_RENDER_DURATION.time():
+            post.html_code = markdown2.markdown(post.markdown_text, extras=["tables", "fenced-code-blocks"])
         super().save_model(request, post, form, change)
     
 admin.site.register(Post, PostAdmin)
@@ -464,4 +686,25 @@ class ClassBadgeAdmin(BasicAdmin):
     inlines = [ClassBadgeCriteriaInline, AchievementInline]
     list_filter = ('course_class',)
     
-admin.site.register(ClassBadge, ClassBadgeAdmin)
\ No newline at end of file
+admin.site.register(ClassBadge, ClassBadgeAdmin)
+
+class JobAdmin(BasicAdmin):
+    list_display = ('__str__', 'status', 'progress', 'rows_updated', 'duration', 'created_by', 'created_datetime')
+    list_filter = ('status', 'kind')
+    list_select_related = ('created_by',)
+    ordering = ('-created_datetime',)
+    readonly_fields = (
+        'kind', 'status', 'progress', 'rows_updated', 'duration', 'created_by',
+        'created_datetime', 'started_datetime', 'finished_datetime', 'log',
+    )
+    exclude = ('course_class_ids', 'classes_done')
+
+    def progress(self, job):
+        return _("%(done)d of %(total)d classes") % {'done': job.classes_done, 'total': len(job.course_class_ids)}
+
+    progress.short_description = _('Progress')
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(Job, JobAdmin)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CourseConfig(AppConfig):
     name = 'course'
     icon = '<i class="material-icons">class</i>'
+
+    def ready(self):
+        from . import signals
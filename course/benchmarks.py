@@ -0,0 +1,235 @@
+"""
+Benchmark suite of the hot paths.
+
+Builds a synthetic class of each size (see course/synthetic.py) inside a
+transaction that is rolled back at the end, and measures the student and
+instructor pages, the ranking, the achievement refresh and the main admin
+changelists. For each one it records the wall time of several rounds, the
+number of queries and the peak of memory allocated by Python (with
+tracemalloc, in a separate round, because tracing slows everything down).
+
+The class cache is cleared before every round, so the pages are measured
+without it. Results are plain dicts, saved as JSON by the runbenchmarks
+command, and two of them can be compared with compare().
+"""
+import datetime
+import logging
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+
+from .models import Enrollment, ClassInstructor
+from . import synthetic, leaderboard, achievements, views
+
+SIZES = {
+    'small': {'students': 30, 'assignments': 10, 'tasks': 5, 'badges': 5},
+    'medium': {'students': 300, 'assignments': 20, 'tasks': 5, 'badges': 10},
+    'large': {'students': 2000, 'assignments': 40, 'tasks': 5, 'badges': 10},
+}
+
+# A private cache, so clearing it doesn't touch the cache of the site
+BENCHMARK_SETTINGS = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmarks'}},
+    'ALLOWED_HOSTS': ['*'],
+    'VIEW_BUDGETS': {},
+}
+
+MEASURES = ('wall_time', 'queries', 'peak_memory')
+
+
+def measure(function, rounds):
+    """
+    Calls function once to warm up, rounds times measuring it, and once more
+    with tracemalloc. Returns the wall time statistics, the queries of one call
+    and the peak memory.
+    """
+    queries = []
+    def count_query(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    cache.clear()
+    function()
+
+    times = []
+    for round_number in range(rounds):
+        cache.clear()
+        del queries[:]
+        with connection.execute_wrapper(count_query):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    number_of_queries = len(queries)
+
+    cache.clear()
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_time': {
+            'min': min(times),
+            'max': max(times),
+            'mean': statistics.mean(times),
+            'median': statistics.median(times),
+            'stddev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        },
+        'queries': number_of_queries,
+        'peak_memory': peak_memory,
+    }
+
+def get_page(client, url):
+    response = client.get(url)
+    if response.status_code not in (200, 302):
+        raise RuntimeError("%s returned %d" % (url, response.status_code))
+
+def benchmarks_of_class(course_class):
+    """
+    Returns a list of (name, function) with the benchmarks of a synthetic class.
+    """
+    enrollment = Enrollment.objects.select_related('student__user').filter(
+        course_class=course_class
+    ).order_by('id').first()
+    instructor_user = ClassInstructor.objects.select_related(
+        'instructor__user'
+    ).get(course_class=course_class).instructor.user
+    admin_user = User.objects.create_superuser('%s-admin' % course_class.course.code, '', None)
+
+    student_client = Client()
+    student_client.force_login(enrollment.student.user)
+    instructor_client = Client()
+    instructor_client.force_login(instructor_user)
+    admin_client = Client()
+    admin_client.force_login(admin_user)
+
+    class_url = '/%s/%s' % (course_class.course.code, course_class.code)
+
+    return [
+        ('classes', lambda: get_page(student_client, '/classes/')),
+        ('home (student)', lambda: get_page(student_client, class_url + '/')),
+        ('assignments (student)', lambda: get_page(student_client, class_url + '/assignments/')),
+        ('assignments (instructor)', lambda: get_page(
+            instructor_client, '%s/assignments/%d' % (class_url, enrollment.student_id)
+        )),
+        ('get_ranking_data', lambda: views.get_ranking_data(course_class, course_class.ranking_size)),
+        ('refresh_achievements', lambda: achievements.refresh_class(course_class)),
+        ('admin enrollments', lambda: get_page(admin_client, '/admin/course/enrollment/')),
+        ('admin students', lambda: get_page(admin_client, '/admin/course/student/')),
+        ('admin assignment tasks', lambda: get_page(admin_client, '/admin/course/assignmenttask/')),
+        ('admin classes', lambda: get_page(admin_client, '/admin/course/courseclass/')),
+    ]
+
+def run_suite(size_names, rounds=5, seed=0, sizes=SIZES, report=None):
+    """
+    Runs every benchmark for each size, without saving anything.
+    report, if given, is called with each result as soon as it is measured.
+    Returns the results as a dict that can be saved as JSON.
+    """
+    results = {
+        'datetime': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'rounds': rounds,
+        'seed': seed,
+        'benchmarks': [],
+    }
+
+    # The instrumentation middleware would log every request
+    instrumentation_logger = logging.getLogger('course.instrumentation')
+    previous_level = instrumentation_logger.level
+    instrumentation_logger.setLevel(logging.WARNING)
+
+    try:
+        with override_settings(**BENCHMARK_SETTINGS):
+            for size_name in size_names:
+                for result in run_size(size_name, sizes[size_name], rounds, seed):
+                    results['benchmarks'].append(result)
+                    if report != None:
+                        report(result)
+    finally:
+        instrumentation_logger.setLevel(previous_level)
+
+    return results
+
+def run_size(size_name, size, rounds, seed):
+    """
+    Yields the result of each benchmark on a synthetic class of this size.
+    The class is created in a transaction that is rolled back at the end.
+    """
+    rng = random.Random(seed)
+
+    with transaction.atomic():
+        course, assignments, tasks, badges = synthetic.create_course(
+            'benchmark-%s' % size_name, size['assignments'], size['tasks'], size['badges']
+        )
+        course_class, number_of_grades = synthetic.create_class(
+            rng, course, assignments, tasks, badges, 'bench', size['students'],
+            number_of_posts=3, number_of_widgets=3,
+        )
+        leaderboard.rebuild(course_class)
+        achievements.refresh_class(course_class)
+
+        for name, function in benchmarks_of_class(course_class):
+            result = {
+                'name': name,
+                'size': size_name,
+                'students': size['students'],
+                'grades': number_of_grades,
+            }
+            result.update(measure(function, rounds))
+            yield result
+
+        transaction.set_rollback(True)
+
+
+def compare(old_results, new_results, threshold=0.2):
+    """
+    Compares the minimum wall time (the least noisy), the queries and the peak
+    memory of the benchmarks in both results. Returns a list of dicts with the
+    name, size, measure, old and new values, the relative change, and whether
+    it is a regression (an increase above the threshold, or any more queries).
+    """
+    old_benchmarks = {(result['name'], result['size']): result for result in old_results['benchmarks']}
+
+    comparison = []
+    for new_result in new_results['benchmarks']:
+        old_result = old_benchmarks.get((new_result['name'], new_result['size']))
+        if old_result == None:
+            continue
+
+        for measure_name in MEASURES:
+            old_value = old_result[measure_name]
+            new_value = new_result[measure_name]
+            if measure_name == 'wall_time':
+                old_value = old_value['min']
+                new_value = new_value['min']
+
+            change = (new_value - old_value) / old_value if old_value > 0 else 0.0
+            if measure_name == 'queries':
+                is_regression = new_value > old_value
+            else:
+                is_regression = change > threshold
+
+            comparison.append({
+                'name': new_result['name'],
+                'size': new_result['size'],
+                'measure': measure_name,
+                'old': old_value,
+                'new': new_value,
+                'change': change,
+                'is_regression': is_regression,
+            })
+
+    return comparison
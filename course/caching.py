@@ -0,0 +1,63 @@
+"""
+Versioned cache of class data.
+
+Every CourseClass has a generation number (CourseClass.cache_generation), which
+changes whenever something in the class is written (see the signals in
+course/signals.py). The data shown in the class pages is cached under keys that
+include the generation, so a write makes all the old entries unreachable at
+once and they just expire.
+
+The generation is stored in the database, not in the cache, so every process
+(web workers, the invitation and job workers, cron commands) sees the changes
+made by the others, and it changes right after the data is committed. The
+cache backend itself doesn't need to be shared: with a per-process one, each
+process just computes its own copy of the data.
+"""
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import CourseClass
+from .instrumentation import record_cache
+from . import deferred
+
+_missing = object()
+
+
+def class_generation(course_class_id):
+    """
+    The current generation of a class, or None if the class doesn't exist.
+    """
+    return CourseClass.objects.filter(pk=course_class_id).values_list('cache_generation', flat=True).first()
+
+def bump_class_generation(course_class_id):
+    """
+    Invalidates the cached data of a class. The new generation is written once
+    per transaction, after it commits (in the same callbacks as the ranks and
+    the achievements, see course/deferred.py): writing it inside the transaction
+    would lock the class row until the commit, so the concurrent writers of a
+    class would wait for each other. Until it is written, the requests may still
+    be served the data cached before the commit.
+    """
+    if course_class_id == None:
+        return
+
+    def run(work):
+        # A timestamp instead of a counter, so a generation is never reused
+        CourseClass.objects.filter(pk=course_class_id).update(cache_generation=time.time_ns())
+
+    deferred.merge_on_commit(('generation', course_class_id), lambda work: None, run)
+
+def get_or_compute(course_class, name, compute):
+    """
+    Returns the cached value of name for the generation of course_class (as it
+    was loaded, see views.resolve_membership), calling compute() and caching
+    its result when there is none.
+    """
+    key = 'course-class:%d:%d:%s' % (course_class.id, course_class.cache_generation, name)
+    value = cache.get(key, _missing)
+    record_cache('class', value is not _missing)
+    if value is _missing:
+        value = compute()
+        cache.set(key, value, settings.COURSE_CACHE_TIMEOUT)
+    return value
@@ -0,0 +1,42 @@
+"""
+Work deferred until the current transaction commits.
+
+The signals in course/signals.py run on every single save or delete, so a
+transaction that writes many rows (an inline formset, a cascade delete...)
+would repeat the same class-wide work for each of them. Instead they add what
+changed to the work pending under a key (e.g. the class) and it is done once,
+after the commit. Outside a transaction it is done right away.
+"""
+import threading
+from django.db import transaction
+
+_local = threading.local()
+
+
+def merge_on_commit(key, add, run):
+    """
+    Calls add(work) with the dict of the work pending under key, and makes sure
+    run(work) is called once when the current transaction commits.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending == None:
+        pending = _local.pending = {}
+
+    # A callback of a transaction (or savepoint) that was rolled back never
+    # runs, so the pending work only counts while its callback is still queued
+    callback, work = pending.get(key, (None, None))
+    connection = transaction.get_connection()
+    if callback != None and any(entry[1] is callback for entry in connection.run_on_commit):
+        add(work)
+        return
+
+    work = {}
+    add(work)
+
+    def callback():
+        if pending.get(key, (None, None))[0] is callback:
+            del pending[key]
+        run(work)
+
+    pending[key] = (callback, work)
+    transaction.on_commit(callback)
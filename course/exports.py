@@ -0,0 +1,102 @@
+"""
+Grade exports.
+
+One row per enrollment of a class, with the points of each assignment task,
+the total XP, the lost lives, the percentage of each badge and the rank. The
+enrollments are read with a server-side iterator and the grades and
+achievements are fetched for one chunk of enrollments at a time, so the memory
+used doesn't depend on the size of the class.
+"""
+import csv
+from itertools import islice
+from django.utils.translation import gettext as _
+
+from .models import Enrollment, AssignmentTask, Grade, ClassBadge, Achievement, display_xp
+
+CHUNK_SIZE = 500
+
+
+def grade_points(score, is_canceled, task_points):
+    # Same rules as Grade.points
+    if is_canceled:
+        return 0
+    elif task_points == None:
+        return round(score)
+    else:
+        return round(score * task_points)
+
+def export_rows(course_class, chunk_size=CHUNK_SIZE):
+    """
+    Yields the header and then one row (a list of values) per enrollment.
+    """
+    assignment_tasks = list(AssignmentTask.objects.filter(
+        course_class=course_class
+    ).select_related('assignment', 'task').order_by('assignment_id', 'is_optional', 'id'))
+    class_badges = list(ClassBadge.objects.filter(
+        course_class=course_class
+    ).select_related('badge').order_by('id'))
+
+    column_of_assignment_task = {assignment_task.id: column for column, assignment_task in enumerate(assignment_tasks)}
+    points_of_assignment_task = {assignment_task.id: assignment_task.points for assignment_task in assignment_tasks}
+    column_of_class_badge = {class_badge.id: column for column, class_badge in enumerate(class_badges)}
+
+    yield (
+        [_('Student'), _('Id number'), _('Email')]
+        + ['%s – %s' % (assignment_task.assignment.name, assignment_task.task.name) for assignment_task in assignment_tasks]
+        + [_('Total XP'), _('Lost lives')]
+        + ['%s (%%)' % class_badge.badge.name for class_badge in class_badges]
+        + [_('Rank')]
+    )
+
+    enrollments = Enrollment.objects.filter(
+        course_class=course_class
+    ).order_by(
+        'student__full_name', 'id'
+    ).values_list(
+        'id', 'student__full_name', 'student__id_number', 'student__user__email', 'total_xp', 'lost_lives', 'rank'
+    ).iterator(chunk_size=chunk_size)
+
+    while True:
+        chunk = list(islice(enrollments, chunk_size))
+        if len(chunk) == 0:
+            break
+        enrollment_ids = [enrollment[0] for enrollment in chunk]
+
+        grades = {enrollment_id: [''] * len(assignment_tasks) for enrollment_id in enrollment_ids}
+        for enrollment_id, assignment_task_id, score, is_canceled in Grade.objects.filter(
+            enrollment_id__in=enrollment_ids,
+            assignment_task__course_class=course_class,
+        ).values_list('enrollment_id', 'assignment_task_id', 'score', 'is_canceled'):
+            grades[enrollment_id][column_of_assignment_task[assignment_task_id]] = grade_points(
+                score, is_canceled, points_of_assignment_task[assignment_task_id]
+            )
+
+        percentages = {enrollment_id: [0] * len(class_badges) for enrollment_id in enrollment_ids}
+        for enrollment_id, class_badge_id, percentage in Achievement.objects.filter(
+            enrollment_id__in=enrollment_ids,
+            class_badge__course_class=course_class,
+        ).values_list('enrollment_id', 'class_badge_id', 'percentage'):
+            percentages[enrollment_id][column_of_class_badge[class_badge_id]] = int(percentage * 100)
+
+        for enrollment_id, full_name, id_number, email, total_xp, lost_lives, rank in chunk:
+            yield (
+                [full_name, id_number, email]
+                + grades[enrollment_id]
+                + [display_xp(total_xp), lost_lives]
+                + percentages[enrollment_id]
+                + ['' if rank == None else rank]
+            )
+
+
+class Echo:
+    """
+    A file-like object that returns what is written, so csv.writer can be used
+    to build the lines of a streaming response.
+    """
+    def write(self, value):
+        return value
+
+def csv_lines(course_class, chunk_size=CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    for row in export_rows(course_class, chunk_size):
+        yield writer.writerow(row)
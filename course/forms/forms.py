@@ -4,7 +4,7 @@ from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import get_user_model
 from django_recaptcha.fields import ReCaptchaField
 from django.conf import settings
-from course.models import Student, Enrollment
+from course.models import Student, Enrollment, CourseClass
 from django.forms import inlineformset_factory
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
@@ -86,4 +86,24 @@ class NewStudentEnrollmentForm(forms.ModelForm):
         fields = ['course_class']
 
 # Criando um formset para ModeloB relacionado com ModeloA
-NewStudentEnrollmentFormSet = inlineformset_factory(Student, Enrollment, form=NewStudentEnrollmentForm)   
\ No newline at end of file
+NewStudentEnrollmentFormSet = inlineformset_factory(Student, Enrollment, form=NewStudentEnrollmentForm)   
+
+class GradeImportForm(forms.Form):
+    file = forms.FileField(
+        label=_("File"),
+        help_text=_("CSV (with a header) or JSON lines, with the columns student (id number or email), assignment, task, score and, optionally, canceled")
+    )
+    dry_run = forms.BooleanField(label=_("Only validate (dry run)"), required=False)
+
+
+class RosterImportForm(forms.Form):
+    course_class = forms.ModelChoiceField(
+        queryset=CourseClass.objects.select_related('course').order_by('-start_date', 'course__code', 'code'),
+        label=_("Class")
+    )
+    file = forms.FileField(
+        label=_("File"),
+        help_text=_("CSV (with a header) or JSON lines, with the columns email, first_name and last_name (or full_name) and, optionally, id_number")
+    )
+    send_invitations = forms.BooleanField(label=_("Send invitations to the new users"), required=False)
+    dry_run = forms.BooleanField(label=_("Only validate (dry run)"), required=False)
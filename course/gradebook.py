@@ -0,0 +1,101 @@
+"""
+Instructor gradebook.
+
+The grades of a whole class as a students × assignment tasks matrix, with the
+total XP of each student and the average points of each assignment task. The
+grades are fetched once (see achievements.ClassGrades) and the totals and
+averages are computed with NumPy, so the number of queries doesn't depend on
+the size of the class.
+"""
+import numpy as np
+
+from .models import Enrollment, AssignmentTask, display_xp
+from .achievements import ClassGrades
+
+
+def get_gradebook_data(course_class):
+    """
+    Returns a dict with:
+      - assignment_tasks: one dict per column, in the order of the assignments page
+      - students: one dict per row, sorted by name, with the points of each
+        column (None where there is no grade) and the total XP
+      - averages: the average points of each column among the students with a
+        (not canceled) grade, or None if there is none
+    """
+    class_grades = ClassGrades(course_class)
+
+    enrollments = {
+        enrollment['id']: enrollment
+        for enrollment in Enrollment.objects.filter(
+            course_class=course_class
+        ).values('id', 'student_id', 'student__full_name', 'lost_lives')
+    }
+
+    assignment_tasks = list(AssignmentTask.objects.filter(
+        course_class=course_class
+    ).select_related(
+        'assignment', 'task'
+    ).order_by('assignment_id', 'is_optional', 'id'))
+
+    # Rows and columns of the ClassGrades matrices, in the order they are shown
+    column_of = {assignment_task[0]: column for column, assignment_task in enumerate(class_grades.assignment_tasks)}
+    columns = [column_of[assignment_task.id] for assignment_task in assignment_tasks]
+    rows = sorted(
+        range(len(class_grades.enrollment_ids)),
+        key=lambda row: (enrollments[class_grades.enrollment_ids[row]]['student__full_name'].lower(), row)
+    )
+    selection = np.ix_(rows, columns)
+
+    points = class_grades.points[selection]
+    scores = class_grades.scores[selection]
+    is_graded = class_grades.is_graded[selection]
+    is_counted = is_graded & ~class_grades.is_canceled[selection]
+
+    # Same rules as the leaderboard (leaderboard.grade_xp)
+    task_points = np.array(
+        [np.nan if assignment_task.points == None else assignment_task.points for assignment_task in assignment_tasks]
+    )
+    xp = np.where(is_counted, np.where(np.isnan(task_points), scores, scores * np.nan_to_num(task_points)), 0)
+    totals = xp.sum(axis=1)
+
+    counts = is_counted.sum(axis=0)
+    sums = np.where(is_counted, points, 0).sum(axis=0)
+    averages = np.divide(sums, counts, out=np.zeros(len(columns)), where=(counts > 0))
+
+    students_data = []
+    for position, row in enumerate(rows):
+        enrollment = enrollments[class_grades.enrollment_ids[row]]
+        row_points = points[position].astype(int).tolist()
+        row_is_graded = is_graded[position].tolist()
+
+        student_data = {}
+        student_data['id'] = enrollment['student_id']
+        student_data['full_name'] = enrollment['student__full_name']
+        student_data['lost_lives'] = enrollment['lost_lives']
+        student_data['grades'] = [
+            grade_points if grade_is_graded else None
+            for grade_points, grade_is_graded in zip(row_points, row_is_graded)
+        ]
+        student_data['total'] = display_xp(totals[position].item())
+
+        students_data.append(student_data)
+
+    assignment_tasks_data = []
+    for assignment_task in assignment_tasks:
+        assignment_task_data = {}
+        assignment_task_data['id'] = assignment_task.id
+        assignment_task_data['assignment'] = assignment_task.assignment.name
+        assignment_task_data['task'] = assignment_task.task.name
+        assignment_task_data['points'] = assignment_task.points
+        assignment_task_data['is_optional'] = assignment_task.is_optional
+
+        assignment_tasks_data.append(assignment_task_data)
+
+    return {
+        'assignment_tasks': assignment_tasks_data,
+        'students': students_data,
+        'averages': [
+            average if count > 0 else None
+            for average, count in zip(averages.tolist(), counts.tolist())
+        ],
+    }
@@ -0,0 +1,400 @@
+"""
+Bulk imports from CSV or JSON lines files.
+
+The rows are read as a stream and written in batches, inside a single
+transaction: if any line has an error, nothing is saved and all the errors are
+reported, with their line numbers. Bulk writes don't send signals, so the
+leaderboard, the achievements and the cached class data are updated here.
+"""
+import csv
+import json
+import math
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from .models import Student, Enrollment, AssignmentTask, Grade
+from . import leaderboard, achievements, caching, metrics
+
+BATCH_SIZE = 500
+
+CSV = 'csv'
+JSON_LINES = 'jsonl'
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'x')
+FALSE_VALUES = ('0', 'false', 'no', 'n')
+
+
+class ImportRowError(Exception):
+    """
+    An invalid row. The message is reported with the line number.
+    """
+
+
+def record_rows(kind, counts, errors):
+    for result, count in counts.items():
+        metrics.IMPORT_ROWS.labels(kind, result).inc(count)
+    metrics.IMPORT_ROWS.labels(kind, 'error').inc(len(errors))
+
+def guess_format(file_name):
+    return JSON_LINES if file_name.lower().endswith(('.jsonl', '.json', '.ndjson')) else CSV
+
+def read_rows(stream, file_format=CSV):
+    """
+    Yields (line number, row as a dict) for each row of a text stream. CSV files
+    must have a header; in JSON lines files, each line is an object.
+    """
+    if file_format == JSON_LINES:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip() == '':
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None
+                continue
+            yield line_number, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(stream)
+        if reader.fieldnames != None:
+            reader.fieldnames = [field_name.strip().lower() for field_name in reader.fieldnames]
+        for row in reader:
+            yield reader.line_num, row
+
+def read_batches(rows, batch_size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def text_value(row, field):
+    value = row.get(field)
+    if value == None:
+        raise ImportRowError(_("Missing column: %s") % field)
+    return str(value).strip()
+
+def boolean_value(row, field):
+    value = str(row.get(field, '')).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    elif value in FALSE_VALUES:
+        return False
+    raise ImportRowError(_("Invalid %(field)s value: %(value)s") % {'field': field, 'value': value})
+
+
+class GradeImporter:
+    """
+    Imports grades of a class from rows with the columns:
+      - student: the student id number or email
+      - assignment, task: names of the assignment and the task
+      - score: same rules as Grade.clean (a value between 0 and 1 if the
+        assignment task has points, or else an integer number of points)
+      - canceled (optional): true/false; if missing or empty, existing grades keep their value
+    The assignment tasks and enrollments of the class are loaded once, and the
+    existing grades are fetched with one query per batch.
+    """
+
+    def __init__(self, course_class):
+        self.course_class = course_class
+
+        self.assignment_tasks = {
+            (assignment_name.lower(), task_name.lower()): (assignment_task_id, points)
+            for assignment_task_id, assignment_name, task_name, points in AssignmentTask.objects.filter(
+                course_class=course_class
+            ).values_list('id', 'assignment__name', 'task__name', 'points')
+        }
+
+        self.enrollments_by_id_number = {}
+        self.enrollments_by_email = {}
+        for enrollment_id, id_number, email in Enrollment.objects.filter(
+            course_class=course_class
+        ).values_list('id', 'student__id_number', 'student__user__email'):
+            if id_number:
+                self.enrollments_by_id_number[id_number.strip().lower()] = enrollment_id
+            if email:
+                self.enrollments_by_email.setdefault(email.strip().lower(), enrollment_id)
+
+        self.counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        self.errors = []
+        self.deltas = {}
+        self.imported_keys = set()
+        self.assignment_task_ids = set()
+        self.enrollment_ids = set()
+
+    def parse(self, row):
+        """
+        Returns (enrollment_id, assignment_task_id, points, score, is_canceled or None).
+        """
+        if row == None:
+            raise ImportRowError(_("Invalid row"))
+
+        student = text_value(row, 'student').lower()
+        enrollment_id = self.enrollments_by_id_number.get(student) or self.enrollments_by_email.get(student)
+        if enrollment_id == None:
+            raise ImportRowError(_("Student not found in the class: %s") % student)
+
+        assignment_name = text_value(row, 'assignment')
+        task_name = text_value(row, 'task')
+        assignment_task = self.assignment_tasks.get((assignment_name.lower(), task_name.lower()))
+        if assignment_task == None:
+            raise ImportRowError(_("Assignment task not found in the class: %(assignment)s – %(task)s") % {
+                'assignment': assignment_name, 'task': task_name
+            })
+        assignment_task_id, points = assignment_task
+
+        try:
+            score = float(text_value(row, 'score'))
+        except ValueError:
+            raise ImportRowError(_("Invalid score: %s") % row.get('score'))
+        if not math.isfinite(score):
+            raise ImportRowError(_("Invalid score: %s") % row.get('score'))
+
+        if points == None and not score.is_integer():
+            raise ImportRowError(_('Score must be an integer value, since the assignment task has no points'))
+        elif points != None and (score < 0 or score > 1):
+            raise ImportRowError(_('Score must be a value between 0 and 1, representing the percentage of the assignment task points'))
+
+        # An empty cell is the same as a missing column: the existing value is kept
+        canceled = row.get('canceled')
+        is_canceled = None if canceled == None or str(canceled).strip() == '' else boolean_value(row, 'canceled')
+
+        if (enrollment_id, assignment_task_id) in self.imported_keys:
+            raise ImportRowError(_("Duplicated grade"))
+        self.imported_keys.add((enrollment_id, assignment_task_id))
+
+        return enrollment_id, assignment_task_id, points, score, is_canceled
+
+    def import_batch(self, batch):
+        grades = []
+        for line_number, row in batch:
+            try:
+                grades.append(self.parse(row))
+            except ImportRowError as error:
+                self.errors.append((line_number, str(error)))
+
+        if len(self.errors) > 0 or len(grades) == 0:
+            # Nothing will be saved, so only the validation goes on
+            return
+
+        existing_grades = {
+            (enrollment_id, assignment_task_id): (score, is_canceled)
+            for enrollment_id, assignment_task_id, score, is_canceled in Grade.objects.filter(
+                enrollment_id__in={grade[0] for grade in grades},
+                assignment_task_id__in={grade[1] for grade in grades},
+            ).values_list('enrollment_id', 'assignment_task_id', 'score', 'is_canceled')
+        }
+
+        now = timezone.now()
+        changed_grades = []
+        for enrollment_id, assignment_task_id, points, score, is_canceled in grades:
+            existing_grade = existing_grades.get((enrollment_id, assignment_task_id))
+            if existing_grade == None:
+                is_canceled = bool(is_canceled)
+                old_xp = 0
+                self.counts['created'] += 1
+            else:
+                old_score, old_is_canceled = existing_grade
+                if is_canceled == None:
+                    is_canceled = old_is_canceled
+                if old_score == score and old_is_canceled == is_canceled:
+                    self.counts['unchanged'] += 1
+                    continue
+                old_xp = leaderboard.grade_xp(old_score, old_is_canceled, points)
+                self.counts['updated'] += 1
+
+            changed_grades.append(Grade(
+                enrollment_id=enrollment_id,
+                assignment_task_id=assignment_task_id,
+                score=score,
+                is_canceled=is_canceled,
+                last_modified=now, # bulk writes don't set auto_now fields
+            ))
+
+            delta = leaderboard.grade_xp(score, is_canceled, points) - old_xp
+            self.deltas[enrollment_id] = self.deltas.get(enrollment_id, 0) + delta
+            self.assignment_task_ids.add(assignment_task_id)
+            self.enrollment_ids.add(enrollment_id)
+
+        # New and changed grades are written with the same upsert
+        Grade.objects.bulk_create(
+            changed_grades,
+            batch_size=BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['enrollment', 'assignment_task'],
+            update_fields=['score', 'is_canceled', 'last_modified'],
+        )
+
+    def finish(self):
+        leaderboard.apply_deltas(self.deltas)
+        leaderboard.refresh_ranks(self.course_class.id)
+        achievements.refresh_affected_achievements(self.course_class, self.assignment_task_ids, self.enrollment_ids)
+        caching.bump_class_generation(self.course_class.id)
+
+
+def import_grades(course_class, stream, file_format=CSV, dry_run=False):
+    """
+    Imports the grades of a text stream into a class (see GradeImporter).
+    Returns (counts, errors): counts has the number of 'created', 'updated' and
+    'unchanged' grades, and errors is a list of (line number, message).
+    Nothing is saved if there is any error, or in a dry run.
+    """
+    importer = GradeImporter(course_class)
+
+    with metrics.IMPORT_DURATION.labels('grades').time(), transaction.atomic():
+        for batch in read_batches(read_rows(stream, file_format)):
+            importer.import_batch(batch)
+
+        if len(importer.errors) > 0 or dry_run:
+            transaction.set_rollback(True)
+        elif importer.counts['created'] + importer.counts['updated'] > 0:
+            importer.finish()
+
+    record_rows('grades', importer.counts, importer.errors)
+    return importer.counts, importer.errors
+
+
+class RosterImporter:
+    """
+    Enrolls students in a class from rows with the columns:
+      - email
+      - first_name and last_name, or full_name (only used for new students)
+      - id_number (optional, only used for new students)
+    Existing users are found by email (or by username, which is the email for
+    users created here), with one query per batch. New users get an unusable
+    password, so they must be invited to create one.
+    """
+
+    def __init__(self, course_class):
+        self.course_class = course_class
+        self.counts = {'users_created': 0, 'students_created': 0, 'enrolled': 0, 'already_enrolled': 0}
+        self.errors = []
+        self.imported_emails = set()
+        self.invitations = []
+
+    def parse(self, row):
+        """
+        Returns (email, first name, last name, full name, id number).
+        """
+        if row == None:
+            raise ImportRowError(_("Invalid row"))
+
+        email = text_value(row, 'email').lower()
+        try:
+            validate_email(email)
+        except ValidationError:
+            raise ImportRowError(_("Invalid email: %s") % email)
+        # New users get the email as username, which is shorter than an email can be
+        if len(email) > User._meta.get_field('username').max_length:
+            raise ImportRowError(_("Email too long: %s") % email)
+
+        if row.get('full_name') not in (None, ''):
+            full_name = str(row['full_name']).strip()
+            first_name, _separator, last_name = full_name.partition(' ')
+        else:
+            first_name = text_value(row, 'first_name')
+            last_name = text_value(row, 'last_name')
+            full_name = first_name + " " + last_name
+
+        id_number = str(row.get('id_number') or '').strip()
+        if len(id_number) > Student._meta.get_field('id_number').max_length:
+            raise ImportRowError(_("Invalid id number: %s") % id_number)
+
+        if email in self.imported_emails:
+            raise ImportRowError(_("Duplicated email: %s") % email)
+        self.imported_emails.add(email)
+
+        return email, first_name[:150], last_name[:150], full_name[:200], id_number
+
+    def import_batch(self, batch):
+        rows = []
+        for line_number, row in batch:
+            try:
+                rows.append(self.parse(row))
+            except ImportRowError as error:
+                self.errors.append((line_number, str(error)))
+
+        if len(self.errors) > 0 or len(rows) == 0:
+            return
+
+        emails = [row[0] for row in rows]
+        existing_users = {}
+        for user_id, email, username, student_id in User.objects.annotate(
+            lower_email=Lower('email'), lower_username=Lower('username')
+        ).filter(
+            Q(lower_email__in=emails) | Q(lower_username__in=emails)
+        ).values_list('id', 'lower_email', 'lower_username', 'student__id'):
+            existing_users.setdefault(email, (user_id, student_id))
+            existing_users.setdefault(username, (user_id, student_id))
+
+        new_users = []
+        new_students = []
+        for email, first_name, last_name, full_name, id_number in rows:
+            if email in existing_users:
+                continue
+            user = User(username=email, email=email, first_name=first_name, last_name=last_name)
+            user.set_unusable_password()
+            new_users.append(user)
+        User.objects.bulk_create(new_users, batch_size=BATCH_SIZE)
+        for user in new_users:
+            existing_users[user.email] = (user.id, None)
+        self.counts['users_created'] += len(new_users)
+        self.invitations.extend(new_users)
+
+        for email, first_name, last_name, full_name, id_number in rows:
+            user_id, student_id = existing_users[email]
+            if student_id == None:
+                new_students.append(Student(user_id=user_id, full_name=full_name, id_number=id_number))
+        Student.objects.bulk_create(new_students, batch_size=BATCH_SIZE)
+        student_ids = {user_id: student_id for user_id, student_id in existing_users.values() if student_id != None}
+        student_ids.update({student.user_id: student.id for student in new_students})
+        self.counts['students_created'] += len(new_students)
+
+        batch_student_ids = {student_ids[existing_users[row[0]][0]] for row in rows}
+        enrolled_student_ids = set(Enrollment.objects.filter(
+            course_class=self.course_class,
+            student_id__in=batch_student_ids,
+        ).values_list('student_id', flat=True))
+
+        Enrollment.objects.bulk_create([
+            Enrollment(student_id=student_id, course_class=self.course_class)
+            for student_id in batch_student_ids - enrolled_student_ids
+        ], batch_size=BATCH_SIZE)
+        self.counts['enrolled'] += len(batch_student_ids - enrolled_student_ids)
+        self.counts['already_enrolled'] += len(enrolled_student_ids)
+
+    def finish(self):
+        # New enrollments have no grades, so they don't change the leaderboard
+        caching.bump_class_generation(self.course_class.id)
+
+
+def import_roster(course_class, stream, file_format=CSV, dry_run=False):
+    """
+    Enrolls the students of a text stream in a class (see RosterImporter).
+    Returns (counts, errors, invitations): counts has the number of
+    'users_created', 'students_created', 'enrolled' and 'already_enrolled',
+    errors is a list of (line number, message), and invitations is the list of
+    created users, which have no password yet.
+    Nothing is saved if there is any error, or in a dry run.
+    """
+    importer = RosterImporter(course_class)
+
+    with metrics.IMPORT_DURATION.labels('roster').time(), transaction.atomic():
+        for batch in read_batches(read_rows(stream, file_format)):
+            importer.import_batch(batch)
+
+        if len(importer.errors) > 0 or dry_run:
+            transaction.set_rollback(True)
+        elif importer.counts['enrolled'] + importer.counts['students_created'] > 0:
+            importer.finish()
+
+    record_rows('roster', importer.counts, importer.errors)
+    return importer.counts, importer.errors, importer.invitations
@@ -0,0 +1,171 @@
+"""
+Request instrumentation.
+
+InstrumentationMiddleware measures every request: the number of SQL queries and
+the time spent in them (on all the database connections), the hits and misses
+of the class and membership caches, and the wall time. Each request is logged
+as one JSON line, keyed by the resolved view name (e.g. "course:home" or
+"admin:course_enrollment_changelist"), and added to an in-process rolling
+aggregate of the last requests of each view (see summary()), and recorded in
+the Prometheus metrics (see course/metrics.py).
+
+settings.VIEW_BUDGETS sets the maximum queries and wall time of each view. A
+request over its budget logs a warning. When settings.VIEW_BUDGETS_RAISE is set
+(it is when running the tests), going over the query budget raises
+BudgetExceeded instead; the wall time depends on the machine, so it is always
+only logged.
+
+For streaming responses only the work done before the response is returned is
+measured, not the rows generated while it is sent.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_current_stats = ContextVar('request_stats', default=None)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class RequestStats:
+    """
+    Counters of one request. It is also the execute wrapper of the database
+    connections, so it sees every query.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_time += time.perf_counter() - started
+
+def record_cache(cache_name, hit):
+    """
+    Counts a lookup in one of the caches (e.g. 'class' or 'membership'), also
+    in the current request if it is being measured.
+    """
+    metrics.CACHE_LOOKUPS.labels(cache_name, 'hit' if hit else 'miss').inc()
+    stats = _current_stats.get()
+    if stats != None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+class RollingAggregate:
+    """
+    The last settings.INSTRUMENTATION_WINDOW samples of each view.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, view_name, sample):
+        with self.lock:
+            if view_name not in self.samples:
+                self.samples[view_name] = deque(maxlen=settings.INSTRUMENTATION_WINDOW)
+            self.samples[view_name].append(sample)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        """
+        Returns, for each view, the number of samples and the mean and maximum
+        of each measure, plus the 95th percentile of the wall time.
+        """
+        with self.lock:
+            samples_of_view = {view_name: list(samples) for view_name, samples in self.samples.items()}
+
+        summary = {}
+        for view_name, samples in samples_of_view.items():
+            view_summary = {'requests': len(samples)}
+            for measure in ('queries', 'sql_ms', 'cache_hits', 'cache_misses', 'wall_ms'):
+                values = [sample[measure] for sample in samples]
+                view_summary[measure] = {'mean': sum(values) / len(values), 'max': max(values)}
+            wall_times = sorted(sample['wall_ms'] for sample in samples)
+            view_summary['wall_ms']['p95'] = wall_times[min(len(wall_times) - 1, int(len(wall_times) * 0.95))]
+            summary[view_name] = view_summary
+        return summary
+
+aggregate = RollingAggregate()
+
+def summary():
+    return aggregate.summary()
+
+
+def check_budget(view_name, sample):
+    budget = settings.VIEW_BUDGETS.get(view_name, settings.VIEW_BUDGETS.get('*'))
+    if budget == None:
+        return
+
+    if 'wall_ms' in budget and sample['wall_ms'] > budget['wall_ms']:
+        logger.warning('%s %s over budget: %.1f ms (budget %d ms)' % (
+            sample['method'], view_name, sample['wall_ms'], budget['wall_ms']
+        ))
+
+    if 'queries' in budget and sample['queries'] > budget['queries']:
+        message = '%s %s over budget: %d queries (budget %d)' % (
+            sample['method'], view_name, sample['queries'], budget['queries']
+        )
+        if settings.VIEW_BUDGETS_RAISE:
+            raise BudgetExceeded(message)
+        logger.warning(message)
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = _current_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                response = self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        wall_time = time.perf_counter() - started
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_name = resolver_match.view_name if resolver_match != None else '<unresolved>'
+        sample = {
+            'view': view_name,
+            'method': request.method,
+            'status': response.status_code,
+            'queries': stats.queries,
+            'sql_ms': round(stats.sql_time * 1000, 2),
+            'cache_hits': stats.cache_hits,
+            'cache_misses': stats.cache_misses,
+            'wall_ms': round(wall_time * 1000, 2),
+        }
+        logger.info(json.dumps(sample))
+        aggregate.add(view_name, sample)
+        metrics.observe_request(sample)
+        check_budget(view_name, sample)
+
+        return response
@@ -0,0 +1,155 @@
+"""
+Invitation outbox.
+
+Inviting users only writes Invitation rows, so the admin doesn't wait for the
+mail server. The sendinvitations command sends them in batches, reusing one
+connection to the mail server per batch, with a rate limit and retries (with
+exponential backoff) for the ones that fail.
+
+A worker first claims a batch in a short transaction (status 'sending'), then
+sends it without holding any lock, and saves each invitation as sent or failed
+right after trying it. If the worker dies, only the invitation being sent may
+be sent twice: the others of its batch are claimed again by another worker when
+their lease (settings.INVITATION_LEASE) expires.
+"""
+import datetime
+import time
+from django.conf import settings
+from django.contrib.auth.tokens import default_token_generator
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.template import loader
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from .models import Invitation
+
+
+def enqueue(users, domain, use_https=True):
+    """
+    Adds an invitation to the outbox for each user, except the ones that
+    already have a pending invitation. Returns the number of invitations added.
+    """
+    user_ids = {user.id for user in users}
+    pending_user_ids = set(Invitation.objects.filter(
+        user_id__in=user_ids, status__in=[Invitation.PENDING, Invitation.SENDING]
+    ).values_list('user_id', flat=True))
+
+    invitations = Invitation.objects.bulk_create([
+        Invitation(user_id=user_id, domain=domain, use_https=use_https)
+        for user_id in sorted(user_ids - pending_user_ids)
+    ])
+    return len(invitations)
+
+def build_message(invitation):
+    """
+    The same email the password reset form sends, with a link to create a password.
+    The token is made now, so it is valid for the whole PASSWORD_RESET_TIMEOUT.
+    """
+    user = invitation.user
+    context = {
+        'email': user.email,
+        'domain': invitation.domain,
+        'site_name': invitation.domain,
+        'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+        'user': user,
+        'token': default_token_generator.make_token(user),
+        'protocol': 'https' if invitation.use_https else 'http',
+    }
+
+    subject = loader.render_to_string('email/password_creation_subject.txt', context)
+    subject = ''.join(subject.splitlines()) # Email subject must not contain newlines
+    body = loader.render_to_string('registration/password_reset_email.html', context)
+
+    message = EmailMultiAlternatives(subject, body, None, [user.email])
+    message.attach_alternative(
+        loader.render_to_string('email/password_creation_email.html', context),
+        'text/html'
+    )
+    return message
+
+def record_failure(invitation, error, now):
+    invitation.attempts += 1
+    invitation.last_error = str(error) or error.__class__.__name__
+    if invitation.attempts >= settings.INVITATION_MAX_ATTEMPTS:
+        invitation.status = Invitation.FAILED
+    else:
+        invitation.status = Invitation.PENDING
+        delay = settings.INVITATION_RETRY_DELAY * 2 ** (invitation.attempts - 1)
+        invitation.next_attempt_datetime = now + datetime.timedelta(seconds=delay)
+    invitation.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_datetime'])
+
+def record_sent(invitation, now):
+    invitation.status = Invitation.SENT
+    invitation.attempts += 1
+    invitation.sent_datetime = now
+    invitation.save(update_fields=['status', 'attempts', 'sent_datetime'])
+
+def claim_batch(batch_size):
+    """
+    Marks as being sent the next invitations that are due (pending ones, and
+    the ones claimed by a worker whose lease expired), for active users only,
+    and commits, so no lock is held while they are sent. Returns them.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # Locked only until the commit, so that several workers don't claim the same invitations
+        invitations = list(Invitation.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+            Q(status=Invitation.PENDING, next_attempt_datetime__lte=now) |
+            Q(status=Invitation.SENDING, claimed_datetime__lt=now - datetime.timedelta(seconds=settings.INVITATION_LEASE)),
+            user__is_active=True,
+        ).select_related('user').order_by('next_attempt_datetime', 'id')[:batch_size])
+
+        Invitation.objects.filter(pk__in=[invitation.pk for invitation in invitations]).update(
+            status=Invitation.SENDING, claimed_datetime=now
+        )
+
+    for invitation in invitations:
+        invitation.status = Invitation.SENDING
+        invitation.claimed_datetime = now
+    return invitations
+
+def send_batch(batch_size=None):
+    """
+    Sends the next batch of pending invitations that are due, through a single
+    connection. Returns a dict with the number of 'sent' and 'failed' ones.
+    """
+    batch_size = batch_size or settings.INVITATION_BATCH_SIZE
+    per_minute = settings.INVITATIONS_PER_MINUTE
+    counts = {'sent': 0, 'failed': 0}
+
+    invitations = claim_batch(batch_size)
+    if len(invitations) == 0:
+        return counts
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        for invitation in invitations:
+            record_failure(invitation, error, timezone.now())
+        counts['failed'] = len(invitations)
+        return counts
+
+    try:
+        for invitation in invitations:
+            started = time.monotonic()
+            try:
+                message = build_message(invitation)
+                message.connection = connection
+                message.send()
+            except Exception as error:
+                record_failure(invitation, error, timezone.now())
+                counts['failed'] += 1
+            else:
+                record_sent(invitation, timezone.now())
+                counts['sent'] += 1
+
+            if per_minute > 0:
+                time.sleep(max(0, 60 / per_minute - (time.monotonic() - started)))
+    finally:
+        connection.close()
+
+    return counts
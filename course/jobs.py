@@ -0,0 +1,94 @@
+"""
+Background jobs.
+
+Slow admin actions only write a Job row and return. The runjobs command takes
+the queued jobs, one at a time per worker thread, and saves their progress
+after each class, so the admin can show it while the job runs.
+
+Each progress update also renews the job's lease (heartbeat_datetime). A
+running job without progress for settings.JOB_LEASE seconds lost its worker
+(e.g. it was killed during a deploy), so the next worker takes it and carries
+on from the first class that wasn't done.
+"""
+import datetime
+import traceback
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job, CourseClass
+from . import achievements
+
+
+def enqueue(kind, course_classes, user=None):
+    return Job.objects.create(
+        kind=kind,
+        course_class_ids=[course_class.id for course_class in course_classes],
+        created_by=user,
+    )
+
+def claim_next_job():
+    """
+    Marks the oldest queued job, or running job whose lease expired, as
+    running and returns it (or None). Locked rows are skipped, so each job goes
+    to a single worker.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(
+            Q(status=Job.QUEUED) |
+            Q(status=Job.RUNNING, heartbeat_datetime__lt=now - datetime.timedelta(seconds=settings.JOB_LEASE))
+        ).order_by('created_datetime', 'id').first()
+        if job == None:
+            return None
+
+        if job.status == Job.RUNNING:
+            job.log += "Restarted after %d classes: its worker stopped\n" % job.classes_done
+        else:
+            job.started_datetime = now
+        job.status = Job.RUNNING
+        job.heartbeat_datetime = now
+        job.save(update_fields=['status', 'started_datetime', 'heartbeat_datetime', 'log'])
+    return job
+
+def refresh_achievements(job):
+    # A restarted job skips the classes already done
+    course_classes = CourseClass.objects.select_related('course').filter(
+        id__in=job.course_class_ids
+    ).order_by('id')[job.classes_done:]
+
+    for course_class in course_classes:
+        counts = achievements.refresh_class(course_class)
+
+        job.classes_done += 1
+        job.rows_updated += counts['inserted'] + counts['updated']
+        job.log += "%s: %d inserted, %d updated, %d unchanged\n" % (
+            course_class, counts['inserted'], counts['updated'], counts['unchanged']
+        )
+        job.heartbeat_datetime = timezone.now()
+        job.save(update_fields=['classes_done', 'rows_updated', 'log', 'heartbeat_datetime'])
+
+RUNNERS = {
+    Job.REFRESH_ACHIEVEMENTS: refresh_achievements,
+}
+
+def run_job(job):
+    try:
+        RUNNERS[job.kind](job)
+    except Exception:
+        job.status = Job.FAILED
+        job.log += traceback.format_exc()
+    else:
+        job.status = Job.DONE
+    job.finished_datetime = timezone.now()
+    job.save(update_fields=['status', 'log', 'finished_datetime'])
+
+def run_next_job():
+    """
+    Runs the oldest queued job, if there is one, and returns it.
+    """
+    job = claim_next_job()
+    if job != None:
+        run_job(job)
+    return job
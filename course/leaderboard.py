@@ -0,0 +1,252 @@
+"""
+Materialized class leaderboard.
+
+Each Enrollment keeps its total XP (total_xp) and its position in the class
+ranking (rank). Grade and AssignmentTask writes apply deltas to total_xp (see
+course/signals.py) and refresh the ranks of the affected class once their
+transaction commits, so the home page only has to read the top rows of the
+(course_class, rank) index.
+
+Enrollments without any grade have rank = None and stay out of the ranking,
+just like in the aggregate query.
+"""
+from django.db.models import Sum, Case, When, F, Exists, OuterRef, Subquery, FloatField
+from rank import Rank
+
+from .models import Enrollment, Grade, display_xp
+from . import caching, deferred
+
+
+def grade_xp(score, is_canceled, points):
+    if score == None or is_canceled:
+        return 0.0
+    elif points == None:
+        return score
+    else:
+        return score * points
+
+def total_xp_expression(output_field=None):
+    return Sum(
+        Case(
+            When(is_canceled=True, then=0),
+            When(assignment_task__points=None, then=F('score')),
+            default=F('score') * F('assignment_task__points'),
+            output_field=output_field or FloatField()
+        )
+    )
+
+
+def apply_deltas(deltas):
+    """
+    Adds each XP delta to its enrollment. deltas is a dict {enrollment_id: delta}.
+    """
+    for enrollment_id, delta in deltas.items():
+        if delta != 0:
+            Enrollment.objects.filter(pk=enrollment_id).update(total_xp=F('total_xp') + delta)
+
+def apply_points_change(assignment_task, old_points, new_points):
+    """
+    Updates the total XP of every enrollment graded in assignment_task after its
+    points changed, using a single UPDATE.
+    """
+    old_factor = 1 if old_points == None else old_points
+    new_factor = 1 if new_points == None else new_points
+    if old_factor == new_factor:
+        return
+
+    grade_score = Grade.objects.filter(
+        enrollment=OuterRef('pk'),
+        assignment_task=assignment_task,
+    ).values('score')[:1]
+
+    Enrollment.objects.filter(
+        grade__assignment_task=assignment_task,
+        grade__is_canceled=False,
+    ).update(
+        total_xp=F('total_xp') + Subquery(grade_score) * (new_factor - old_factor)
+    )
+
+def refresh_ranks(course_class_id):
+    """
+    Recomputes the ranks of a class from the stored totals and writes only the
+    ranks that changed. Ties share the same position (1, 1, 3...), like RANK().
+    """
+    rows = Enrollment.objects.filter(
+        course_class_id=course_class_id
+    ).annotate(
+        is_graded=Exists(Grade.objects.filter(enrollment=OuterRef('pk')))
+    ).values_list('id', 'total_xp', 'rank', 'is_graded')
+
+    new_ranks = compute_ranks(
+        (enrollment_id, total_xp) for enrollment_id, total_xp, _, is_graded in rows if is_graded
+    )
+
+    changed = [
+        Enrollment(id=enrollment_id, rank=new_ranks.get(enrollment_id))
+        for enrollment_id, _, rank, _ in rows
+        if new_ranks.get(enrollment_id) != rank
+    ]
+    if len(changed) > 0:
+        Enrollment.objects.bulk_update(changed, ['rank'], batch_size=500)
+
+def schedule_rank_refresh(course_class_id):
+    """
+    Refreshes the ranks of a class once, after the current transaction commits
+    (right away outside a transaction), however many grades the transaction
+    writes. Refreshing them on every save would read the whole class each time.
+    """
+    deferred.merge_on_commit(
+        ('ranks', course_class_id), lambda work: None, lambda work: refresh_ranks_after_commit(course_class_id)
+    )
+
+def refresh_ranks_after_commit(course_class_id):
+    refresh_ranks(course_class_id)
+    # The pages may have been cached between the commit and the refresh
+    caching.bump_class_generation(course_class_id)
+
+def compute_ranks(totals):
+    """
+    Returns {enrollment_id: rank} from (enrollment_id, total_xp) pairs.
+    """
+    ordered = sorted(totals, key=lambda item: -round(item[1], 6))
+
+    ranks = {}
+    previous_total = None
+    rank = 0
+    for position, (enrollment_id, total_xp) in enumerate(ordered, start=1):
+        total_xp = round(total_xp, 6)
+        if total_xp != previous_total:
+            rank = position
+            previous_total = total_xp
+        ranks[enrollment_id] = rank
+
+    return ranks
+
+
+def rebuild(course_class):
+    """
+    Recomputes total_xp and rank of every enrollment of a class from its grades.
+    """
+    totals = dict(
+        Grade.objects.filter(
+            enrollment__course_class=course_class
+        ).values(
+            'enrollment_id'
+        ).annotate(
+            total=total_xp_expression()
+        ).values_list('enrollment_id', 'total')
+    )
+    ranks = compute_ranks(totals.items())
+
+    enrollments = list(Enrollment.objects.filter(course_class=course_class).only('id'))
+    for enrollment in enrollments:
+        enrollment.total_xp = totals.get(enrollment.id) or 0.0
+        enrollment.rank = ranks.get(enrollment.id)
+
+    Enrollment.objects.bulk_update(enrollments, ['total_xp', 'rank'], batch_size=500)
+    caching.bump_class_generation(course_class.id)
+
+def aggregate_ranking(course_class):
+    """
+    The ranking computed from scratch by aggregating every grade of the class.
+    This was the query behind the home page before the leaderboard was stored,
+    and it is now used to verify the stored values.
+    """
+    return Grade.objects.values(
+        'enrollment__student__id'
+    ).annotate(
+        total = total_xp_expression(),
+        full_name = F('enrollment__student__full_name'),
+        student_id = F('enrollment__student__id'),
+        enrollment_id = F('enrollment__id'),
+    ).annotate(
+        # this "dense_rank" was throwing an error sometimes, randomly
+        # it was not finding the previous "total" annotation
+        # so I put it in another "annotate" to respect the dependency
+        dense_rank = Rank('total'),
+    ).filter(
+        enrollment__course_class = course_class
+    ).order_by('-total', 'full_name')
+
+def verify(course_class):
+    """
+    Compares the stored leaderboard with the aggregate query.
+    Returns a list of (enrollment_id, stored (xp, rank), expected (xp, rank)).
+    """
+    expected = {
+        row['enrollment_id']: (display_xp(row['total']), row['dense_rank'])
+        for row in aggregate_ranking(course_class)
+    }
+
+    mismatches = []
+    for enrollment_id, total_xp, rank in Enrollment.objects.filter(
+        course_class=course_class
+    ).values_list('id', 'total_xp', 'rank'):
+        stored = (display_xp(total_xp), rank) if rank != None else (None, None)
+        expected_values = expected.get(enrollment_id, (None, None))
+        if stored != expected_values:
+            mismatches.append((enrollment_id, stored, expected_values))
+
+    return mismatches
+
+def find_drift(course_class, tolerance=1e-6):
+    """
+    Compares the stored total XP of each enrollment with the sum of its grades.
+    Returns a list of (enrollment_id, stored total, actual total).
+    """
+    actual = dict(
+        Grade.objects.filter(
+            enrollment__course_class=course_class
+        ).values(
+            'enrollment_id'
+        ).annotate(
+            total=total_xp_expression()
+        ).values_list('enrollment_id', 'total')
+    )
+
+    drift = []
+    for enrollment_id, total_xp in Enrollment.objects.filter(
+        course_class=course_class
+    ).values_list('id', 'total_xp'):
+        actual_total = actual.get(enrollment_id) or 0.0
+        if abs(total_xp - actual_total) > tolerance:
+            drift.append((enrollment_id, total_xp, actual_total))
+
+    return drift
+
+def repair_drift(course_class, drift):
+    """
+    Writes the actual totals found by find_drift and refreshes the class ranks.
+    """
+    Enrollment.objects.bulk_update(
+        [Enrollment(id=enrollment_id, total_xp=actual_total) for enrollment_id, _, actual_total in drift],
+        ['total_xp'],
+        batch_size=500
+    )
+    refresh_ranks(course_class.id)
+    caching.bump_class_generation(course_class.id)
+
+
+def get_top(course_class, ranking_size):
+    """
+    The first ranking_size rows of the class ranking, read from the stored
+    leaderboard. Each row has the keys used by course/class.html.
+    """
+    rows = Enrollment.objects.filter(
+        course_class=course_class,
+        rank__isnull=False,
+    ).order_by(
+        'rank', 'student__full_name'
+    ).values_list(
+        'student_id', 'student__full_name', 'total_xp', 'rank'
+    )[:ranking_size]
+
+    return [
+        {
+            'student_id': student_id,
+            'full_name': full_name,
+            'total': display_xp(total_xp),
+            'dense_rank': rank,
+        }
+        for student_id, full_name, total_xp, rank in rows
+    ]
@@ -0,0 +1,152 @@
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from course.models import *
+from course import achievements, synthetic
+
+class Command(BaseCommand):
+    help = 'Compare the achievement engine with the previous per-row computation on synthetic classes (nothing is saved)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,30,100', help='Comma-separated numbers of students')
+        parser.add_argument('--badges', type=int, default=10)
+        parser.add_argument('--assignments', type=int, default=10)
+        parser.add_argument('--tasks', type=int, default=5, help='Tasks per assignment')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        self.stdout.write("%8s %12s %10s %12s %10s %8s" % ('students', 'per-row (s)', 'queries', 'engine (s)', 'queries', 'speedup'))
+        for size in sizes:
+            with transaction.atomic():
+                course_class = create_synthetic_class(
+                    random.Random(options['seed']), size,
+                    options['assignments'], options['tasks'], options['badges']
+                )
+
+                reference_time, reference_queries, expected = measure(reference_percentages, course_class)
+                engine_time, engine_queries, result = measure(achievements.compute_percentages, course_class)
+
+                transaction.set_rollback(True)
+
+            if result != expected:
+                raise CommandError("The engine computed different percentages for %d students" % size)
+
+            self.stdout.write("%8d %12.3f %10d %12.3f %10d %7.1fx" % (
+                size, reference_time, reference_queries, engine_time, engine_queries,
+                reference_time / engine_time
+            ))
+
+def measure(function, course_class):
+    queries = []
+    def count_query(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_query):
+        start = time.perf_counter()
+        result = function(course_class)
+        duration = time.perf_counter() - start
+    return duration, len(queries), result
+
+def reference_percentages(course_class):
+    """
+    The per-row computation used by refreshachievements before the engine,
+    kept to check that both give the same percentages. It used to fail on
+    assignments without mandatory points and on goals of 0: here it handles
+    them like the engine (the criterion is ignored, and a goal of 0 is always
+    reached).
+    """
+    result_percentages = {}
+    for enrollment in course_class.enrollment_set.all():
+        for class_badge in course_class.classbadge_set.all():
+            percentages = []
+
+            for class_badge_criteria in class_badge.classbadgecriteria_set.order_by('id'):
+                result = 0.0
+                goal = class_badge_criteria.goal
+                goal_type_is_percentage = (class_badge_criteria.goal_type == ClassBadgeCriteria.PERCENTAGE)
+
+                assignment = class_badge_criteria.assignment
+                task = class_badge_criteria.task
+                assignment_tasks = AssignmentTask.objects.filter(course_class=course_class)
+
+                if assignment != None and task != None:
+                    assignment_task = assignment_tasks.filter(assignment=assignment, task=task).first()
+                    grade = Grade.objects.filter(enrollment=enrollment, assignment_task=assignment_task).first()
+
+                    if grade == None:
+                        result = 0
+                    elif goal_type_is_percentage:
+                        result = grade.score
+                    else:
+                        result = grade.points
+
+                elif assignment != None:
+                    assignment_tasks = assignment_tasks.filter(assignment=assignment)
+
+                    for assignment_task in assignment_tasks:
+                        grade = Grade.objects.filter(enrollment=enrollment, assignment_task=assignment_task).first()
+                        if grade != None:
+                            result += grade.points
+
+                    if goal_type_is_percentage:
+                        points = assignment.points(course_class)
+                        if points == None or points == 0:
+                            continue
+                        result = result / points
+
+                elif task != None:
+                    assignment_tasks = assignment_tasks.filter(task=task)
+
+                    total = 0.0
+                    for assignment_task in assignment_tasks:
+                        grade = Grade.objects.filter(enrollment=enrollment, assignment_task=assignment_task).first()
+
+                        if goal_type_is_percentage:
+                            total += 1
+                            if grade != None and grade.score == 1:
+                                result += 1
+                        elif grade != None:
+                            result += grade.points
+
+                    if goal_type_is_percentage:
+                        if total == 0:
+                            continue
+                        result = result / total
+
+                if not class_badge_criteria.accepts_partial_goal and result < class_badge_criteria.goal:
+                    result = 0.0
+
+                if goal == 0:
+                    percentage = 1.0
+                else:
+                    percentage = result / goal
+                    percentage = min(max(percentage, 0), 1)
+
+                percentages.append(percentage)
+
+            if percentages == []:
+                continue
+
+            if class_badge.aggregation_type_for_criteria == ClassBadge.AND:
+                percentage = sum(percentages, 0.0) / len(percentages)
+            else:
+                percentage = max(percentages)
+
+            result_percentages[(enrollment.id, class_badge.id)] = percentage
+
+    return result_percentages
+
+def create_synthetic_class(rng, number_of_students, number_of_assignments, tasks_per_assignment, number_of_badges):
+    """
+    Creates a class with random grades and badge criteria (see course/synthetic.py).
+    """
+    suffix = '%d-%d' % (number_of_students, rng.randrange(10**9))
+    course, assignments, tasks, badges = synthetic.create_course(
+        'bench-%s' % suffix, number_of_assignments, tasks_per_assignment, number_of_badges
+    )
+    course_class, _ = synthetic.create_class(rng, course, assignments, tasks, badges, 'bench', number_of_students)
+    return course_class
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from course.models import *
+from course import leaderboard
+
+class Command(BaseCommand):
+    help = 'Report (and optionally repair) enrollments whose stored total score differs from their grades'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Write the correct totals and refresh the ranks')
+
+    def handle(self, *args, **options):
+        total_drift = 0
+        for course_class in CourseClass.objects.select_related('course').order_by('id'):
+            with transaction.atomic():
+                drift = leaderboard.find_drift(course_class)
+                if len(drift) == 0:
+                    continue
+
+                total_drift += len(drift)
+                self.stdout.write("%s: %d enrollments with wrong total score" % (course_class, len(drift)))
+                for enrollment_id, stored_total, actual_total in drift:
+                    self.stdout.write("  enrollment %d: stored %s, actual %s" % (enrollment_id, stored_total, actual_total))
+
+                if options['repair']:
+                    leaderboard.repair_drift(course_class, drift)
+
+        if total_drift == 0:
+            self.stdout.write("All total scores are consistent")
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS("Repaired %d enrollments" % total_drift))
+        else:
+            raise CommandError("%d enrollments have a wrong total score (use --repair to fix them)" % total_drift)
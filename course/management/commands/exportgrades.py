@@ -0,0 +1,27 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from course.models import *
+from course import exports
+
+class Command(BaseCommand):
+    help = 'Export the grades, total XP, lost lives, badge percentages and rank of each student of a class as CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--course', required=True, help='Course code of the class')
+        parser.add_argument('--class', dest='class_code', required=True, help='Code of the class')
+        parser.add_argument('--output', help='Path of the CSV file (standard output by default)')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE, help='Students loaded at a time')
+
+    def handle(self, *args, **options):
+        course_class = CourseClass.objects.select_related('course').filter(
+            course__code=options['course'], code=options['class_code']
+        ).first()
+        if course_class == None:
+            raise CommandError("Class not found: %s %s" % (options['course'], options['class_code']))
+
+        lines = exports.csv_lines(course_class, options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                output.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
@@ -0,0 +1,84 @@
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_date
+from course.models import *
+from course import synthetic, leaderboard, achievements
+
+class Command(BaseCommand):
+    help = 'Create synthetic courses, classes, students and grades for load and scaling tests (the same seed gives the same data)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='synthetic', help='Start of the course codes and usernames')
+        parser.add_argument('--courses', type=int, default=1)
+        parser.add_argument('--classes', type=int, default=1, help='Classes per course')
+        parser.add_argument('--students', type=int, default=100, help='Students per class')
+        parser.add_argument('--assignments', type=int, default=10, help='Assignments per course')
+        parser.add_argument('--tasks', type=int, default=5, help='Tasks per assignment')
+        parser.add_argument('--badges', type=int, default=5, help='Badges per course')
+        parser.add_argument('--graded', type=float, default=0.7, help='Fraction of the assignment tasks graded for each student')
+        parser.add_argument('--optional', type=float, default=0.2, help='Fraction of optional assignment tasks')
+        parser.add_argument('--canceled', type=float, default=0.05, help='Fraction of canceled grades')
+        parser.add_argument('--percentage-tasks', type=float, default=0.2, help='Fraction of assignment tasks without points (the score is the XP)')
+        parser.add_argument('--posts', type=int, default=3, help='Posts per class')
+        parser.add_argument('--widgets', type=int, default=3, help='Widgets per class')
+        parser.add_argument('--achievements', action='store_true', help='Also compute the achievements of the classes')
+        parser.add_argument('--base-date', default=str(synthetic.BASE_DATE), help=(
+            'Date the classes run around, as YYYY-MM-DD (default: %(default)s); use today to make them current'
+        ))
+
+    def handle(self, *args, **options):
+        for option in ('graded', 'optional', 'canceled', 'percentage_tasks'):
+            if not 0 <= options[option] <= 1:
+                raise CommandError("--%s must be between 0 and 1" % option.replace('_', '-'))
+
+        try:
+            base_date = parse_date(options['base_date'])
+        except ValueError:
+            base_date = None
+        if base_date == None:
+            raise CommandError("Invalid --base-date: %s" % options['base_date'])
+
+        course_codes = ['%s-%d' % (options['prefix'], i) for i in range(options['courses'])]
+        if Course.objects.filter(code__in=course_codes).exists():
+            raise CommandError("There are already courses with the prefix %s" % options['prefix'])
+
+        rng = random.Random(options['seed'])
+        start = time.perf_counter()
+        total_of_grades = 0
+
+        for course_code in course_codes:
+            with transaction.atomic():
+                course, assignments, tasks, badges = synthetic.create_course(
+                    course_code, options['assignments'], options['tasks'], options['badges']
+                )
+
+            for i in range(options['classes']):
+                class_start = time.perf_counter()
+                # One transaction per class, so a big dataset isn't a single huge transaction
+                with transaction.atomic():
+                    course_class, number_of_grades = synthetic.create_class(
+                        rng, course, assignments, tasks, badges, '%d' % i, options['students'],
+                        graded_fraction=options['graded'],
+                        optional_fraction=options['optional'],
+                        canceled_fraction=options['canceled'],
+                        percentage_task_fraction=options['percentage_tasks'],
+                        number_of_posts=options['posts'],
+                        number_of_widgets=options['widgets'],
+                        base_date=base_date,
+                    )
+                    # Bulk inserts send no signals, so the leaderboard is computed once at the end
+                    leaderboard.rebuild(course_class)
+                    if options['achievements']:
+                        achievements.refresh_class(course_class)
+
+                total_of_grades += number_of_grades
+                self.stdout.write("%s: %d students, %d grades (%.1f s)" % (
+                    course_class, options['students'], number_of_grades, time.perf_counter() - class_start
+                ))
+
+        self.stdout.write("%d classes, %d grades in %.1f s" % (
+            options['courses'] * options['classes'], total_of_grades, time.perf_counter() - start
+        ))
@@ -0,0 +1,40 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from course.models import *
+from course import imports
+
+class Command(BaseCommand):
+    help = 'Import grades of a class from a CSV or JSON lines file with student (id number or email), assignment, task, score and, optionally, canceled'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='Path of the file, or - to read from the standard input')
+        parser.add_argument('--course', required=True, help='Course code of the class')
+        parser.add_argument('--class', dest='class_code', required=True, help='Code of the class')
+        parser.add_argument('--format', choices=[imports.CSV, imports.JSON_LINES], help='File format (guessed from the file name by default)')
+        parser.add_argument('--dry-run', action='store_true', help='Validate the file and print the counts, without saving the grades')
+
+    def handle(self, *args, **options):
+        course_class = CourseClass.objects.select_related('course').filter(
+            course__code=options['course'], code=options['class_code']
+        ).first()
+        if course_class == None:
+            raise CommandError("Class not found: %s %s" % (options['course'], options['class_code']))
+
+        file_format = options['format'] or imports.guess_format(options['file'])
+        if options['file'] == '-':
+            counts, errors = imports.import_grades(course_class, sys.stdin, file_format, options['dry_run'])
+        else:
+            with open(options['file'], newline='', encoding='utf-8-sig') as stream:
+                counts, errors = imports.import_grades(course_class, stream, file_format, options['dry_run'])
+
+        for line_number, message in errors:
+            self.stderr.write("Line %d: %s" % (line_number, message))
+        if len(errors) > 0:
+            raise CommandError("%d invalid lines, no grades were imported" % len(errors))
+
+        self.stdout.write(
+            "%s%s: %d created, %d updated, %d unchanged" % (
+                "(dry run) " if options['dry_run'] else "",
+                course_class, counts['created'], counts['updated'], counts['unchanged']
+            )
+        )
@@ -0,0 +1,54 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from course.models import *
+from course import imports, invitations
+
+class Command(BaseCommand):
+    help = 'Enroll students in a class from a CSV or JSON lines file with email, first_name and last_name (or full_name) and, optionally, id_number'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='Path of the file, or - to read from the standard input')
+        parser.add_argument('--course', required=True, help='Course code of the class')
+        parser.add_argument('--class', dest='class_code', required=True, help='Code of the class')
+        parser.add_argument('--format', choices=[imports.CSV, imports.JSON_LINES], help='File format (guessed from the file name by default)')
+        parser.add_argument('--dry-run', action='store_true', help='Validate the file and print the counts, without saving anything')
+        parser.add_argument('--invitations', help='Write the emails of the created users (who have no password yet) to this file')
+        parser.add_argument('--invite', metavar='DOMAIN', help='Queue invitations to the created users, with links to this domain (sent by sendinvitations)')
+        parser.add_argument('--http', action='store_true', help='Use http instead of https in the invitation links')
+
+    def handle(self, *args, **options):
+        course_class = CourseClass.objects.select_related('course').filter(
+            course__code=options['course'], code=options['class_code']
+        ).first()
+        if course_class == None:
+            raise CommandError("Class not found: %s %s" % (options['course'], options['class_code']))
+
+        file_format = options['format'] or imports.guess_format(options['file'])
+        if options['file'] == '-':
+            counts, errors, invited_users = imports.import_roster(course_class, sys.stdin, file_format, options['dry_run'])
+        else:
+            with open(options['file'], newline='', encoding='utf-8-sig') as stream:
+                counts, errors, invited_users = imports.import_roster(course_class, stream, file_format, options['dry_run'])
+
+        for line_number, message in errors:
+            self.stderr.write("Line %d: %s" % (line_number, message))
+        if len(errors) > 0:
+            raise CommandError("%d invalid lines, no students were imported" % len(errors))
+
+        self.stdout.write(
+            "%s%s: %d users created, %d students created, %d enrolled, %d already enrolled" % (
+                "(dry run) " if options['dry_run'] else "",
+                course_class, counts['users_created'], counts['students_created'],
+                counts['enrolled'], counts['already_enrolled']
+            )
+        )
+
+        if options['invitations'] and not options['dry_run']:
+            with open(options['invitations'], 'w') as invitations_file:
+                for user in invited_users:
+                    invitations_file.write(user.email + "\n")
+            self.stdout.write("%d users to invite written to %s" % (len(invited_users), options['invitations']))
+
+        if options['invite'] and not options['dry_run']:
+            count = invitations.enqueue(invited_users, options['invite'], not options['http'])
+            self.stdout.write("%d invitations queued" % count)
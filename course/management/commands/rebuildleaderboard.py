@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from course.models import *
+from course import leaderboard
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored leaderboard (total XP and rank of each enrollment) and verify it against the aggregate query'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--course', help='Only classes of this course code')
+        parser.add_argument('--class', dest='class_code', help='Only classes with this code')
+        parser.add_argument('--verify-only', action='store_true', help='Do not rebuild, only report differences')
+
+    def handle(self, *args, **options):
+        course_classes = CourseClass.objects.select_related('course').order_by('id')
+        if options['course']:
+            course_classes = course_classes.filter(course__code=options['course'])
+        if options['class_code']:
+            course_classes = course_classes.filter(code=options['class_code'])
+
+        total_mismatches = 0
+        for course_class in course_classes:
+            if not options['verify_only']:
+                with transaction.atomic():
+                    leaderboard.rebuild(course_class)
+
+            mismatches = leaderboard.verify(course_class)
+            total_mismatches += len(mismatches)
+
+            self.stdout.write("%s: %d mismatches" % (course_class, len(mismatches)))
+            for enrollment_id, stored, expected in mismatches:
+                self.stdout.write(
+                    "  enrollment %d: stored (xp, rank) = %s, expected %s" % (enrollment_id, stored, expected)
+                )
+
+        if total_mismatches > 0:
+            raise CommandError("Leaderboard differs from the aggregate query in %d enrollments" % total_mismatches)
@@ -1,94 +1,90 @@
-from django.core.management.base import BaseCommand
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import date
+import django
 from course.models import *
+from course import achievements
 
 class Command(BaseCommand):
     help = 'Compute percentages for achievements in current course classes'
 
-    def handle(self, *args, **options):
-        today = date.today()
-        course_classes = CourseClass.objects.filter(start_date__lte=today, end_date__gte=today)
-        refresh_achievements(course_classes)
-
-def refresh_achievements(course_classes):
-    for course_class in course_classes:
-        print("Refreshing achievements of %s" % course_class)
-        
-        for enrollment in course_class.enrollment_set.all():
-            for class_badge in course_class.classbadge_set.all():
-                percentages = []
-
-                for class_badge_criteria in class_badge.classbadgecriteria_set.all():
-                    result = 0.0
-                    goal = class_badge_criteria.goal
-                    goal_type_is_percentage = (class_badge_criteria.goal_type == ClassBadgeCriteria.PERCENTAGE)
-
-                    assignment = class_badge_criteria.assignment
-                    task = class_badge_criteria.task
-                    assignment_tasks = AssignmentTask.objects.filter(course_class=course_class)
-
-                    if assignment != None and task != None:
-                        assignment_task = assignment_tasks.filter(assignment=assignment, task=task).first()
-                        grade = Grade.objects.filter(enrollment=enrollment, assignment_task=assignment_task).first()
-
-                        if grade == None:
-                            result = 0
-                        elif goal_type_is_percentage:
-                            result = grade.score
-                        else:
-                            result = grade.points
-
-                    elif assignment != None:
-                        assignment_tasks = assignment_tasks.filter(assignment=assignment)
-
-                        for assignment_task in assignment_tasks:
-                            grade = Grade.objects.filter(enrollment=enrollment, assignment_task=assignment_task).first()
-                            if grade != None:
-                                result += grade.points
-
-                        if goal_type_is_percentage:
-                            points = assignment.points(course_class)
-                            if points == 0:
-                                continue
-                            result = result / points
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=1, help='Number of processes refreshing classes in parallel')
+        parser.add_argument('--course', help='Only classes of this course code (current or not)')
+        parser.add_argument('--class', dest='class_code', help='Only classes with this code (current or not)')
+        parser.add_argument('--since', help=(
+            'Only classes with grades created or changed after this date/time (e.g. "2024-03-01 18:00"). '
+            'Deleted grades and changes of points, optional tasks or badge criteria leave no trace, '
+            'so they are missed: refresh those classes without --since'
+        ))
+        parser.add_argument('--dry-run', action='store_true', help='Print the percentages that would change, without saving them')
 
-                    elif task != None:
-                        assignment_tasks = assignment_tasks.filter(task=task)
-
-                        total = 0.0
-                        for assignment_task in assignment_tasks:
-                            grade = Grade.objects.filter(enrollment=enrollment, assignment_task=assignment_task).first()
-                            
-                            if goal_type_is_percentage:
-                                total += 1
-                                if grade != None and grade.score == 1:
-                                    result += 1
-                            elif grade != None:
-                                result += grade.points
-                                    
-
-                        if goal_type_is_percentage:
-                            result = result / total
-
-                    if not class_badge_criteria.accepts_partial_goal and result < class_badge_criteria.goal:
-                        result = 0.0
-
-                    percentage = result / goal
-                    percentage = min(max(percentage, 0), 1)
-
-                    percentages.append(percentage)
-                    
-
-                if percentages == []:
-                    continue
-
-                if class_badge.aggregation_type_for_criteria == ClassBadge.AND:
-                    percentage = sum(percentages, 0.0) / len(percentages)
-                else:
-                    percentage = max(percentages)
-                        
-                achievement = Achievement.objects.filter(enrollment=enrollment, class_badge=class_badge).first()
-                if achievement == None:
-                    achievement = Achievement(enrollment=enrollment, class_badge=class_badge)
-                achievement.percentage = percentage
-                achievement.save()
\ No newline at end of file
+    def handle(self, *args, **options):
+        course_classes = CourseClass.objects.select_related('course').order_by('id')
+        if options['course'] or options['class_code']:
+            if options['course']:
+                course_classes = course_classes.filter(course__code=options['course'])
+            if options['class_code']:
+                course_classes = course_classes.filter(code=options['class_code'])
+        else:
+            today = date.today()
+            course_classes = course_classes.filter(start_date__lte=today, end_date__gte=today)
+
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since == None:
+                raise CommandError("Invalid --since date/time: %s" % options['since'])
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            course_classes = course_classes.filter(
+                assignmenttask__grade__last_modified__gt=since
+            ).distinct()
+
+        course_class_ids = list(course_classes.values_list('id', flat=True))
+        dry_run = options['dry_run']
+
+        if options['jobs'] > 1 and len(course_class_ids) > 1:
+            # Each process must open its own database connection
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['jobs'], initializer=django.setup) as executor:
+                for lines in executor.map(refresh_course_class_by_id, course_class_ids, [dry_run] * len(course_class_ids)):
+                    self.stdout.write("\n".join(lines))
+        else:
+            for course_class_id in course_class_ids:
+                self.stdout.write("\n".join(refresh_course_class_by_id(course_class_id, dry_run)))
+
+COUNTS_MESSAGE = "  %(inserted)d inserted, %(updated)d updated, %(unchanged)d unchanged"
+
+def refresh_course_class_by_id(course_class_id, dry_run=False):
+    """
+    Refreshes (or, in a dry run, compares) the achievements of one class.
+    Returns the lines to print, so it can run in another process.
+    """
+    course_class = CourseClass.objects.select_related('course').get(pk=course_class_id)
+
+    if not dry_run:
+        counts = achievements.refresh_class(course_class)
+        return ["Refreshing achievements of %s" % course_class, COUNTS_MESSAGE % counts]
+
+    changes = achievements.diff_percentages(achievements.compute_percentages(course_class))
+    lines = ["%s: %d achievements would change" % (course_class, len(changes))]
+
+    student_names = dict(Enrollment.objects.filter(
+        course_class=course_class
+    ).values_list('id', 'student__full_name'))
+    badge_names = dict(ClassBadge.objects.filter(
+        course_class=course_class
+    ).values_list('id', 'badge__name'))
+
+    for enrollment_id, class_badge_id, old_percentage, new_percentage in changes:
+        lines.append("  %s – %s: %s -> %.1f%%" % (
+            student_names[enrollment_id],
+            badge_names[class_badge_id],
+            "(none)" if old_percentage == None else "%.1f%%" % (old_percentage * 100),
+            new_percentage * 100,
+        ))
+
+    return lines
@@ -0,0 +1,80 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from course import benchmarks
+
+ROW_FORMAT = "%-34s %10s %10s %10s %10s %10s %8s %12s"
+COMPARISON_FORMAT = "%-34s %-12s %14s %14s %9s  %s"
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the pages, the ranking, the achievement refresh and the admin changelists on synthetic classes '
+        '(nothing is saved), or compare two result files'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='small,medium', help='Comma-separated sizes: %s' % ', '.join(benchmarks.SIZES))
+        parser.add_argument('--rounds', type=int, default=5, help='Measured calls of each benchmark')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Path of the JSON file to save the results')
+        parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two JSON result files instead of running')
+        parser.add_argument('--threshold', type=float, default=0.2, help='Relative increase of time or memory taken as a regression (0.2 is 20%%)')
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            self.compare(*options['compare'], options['threshold'])
+            return
+
+        size_names = options['sizes'].split(',')
+        for size_name in size_names:
+            if size_name not in benchmarks.SIZES:
+                raise CommandError("Unknown size: %s" % size_name)
+        if options['rounds'] < 1:
+            raise CommandError("--rounds must be at least 1")
+
+        self.stdout.write(ROW_FORMAT % ('Name (size)', 'Min (ms)', 'Max (ms)', 'Mean (ms)', 'StdDev', 'Median', 'Queries', 'Peak memory'))
+        results = benchmarks.run_suite(size_names, options['rounds'], options['seed'], report=self.report)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write("Results saved to %s" % options['output'])
+
+    def report(self, result):
+        wall_time = result['wall_time']
+        self.stdout.write(ROW_FORMAT % (
+            '%s (%s)' % (result['name'], result['size']),
+            '%.2f' % (wall_time['min'] * 1000),
+            '%.2f' % (wall_time['max'] * 1000),
+            '%.2f' % (wall_time['mean'] * 1000),
+            '%.2f' % (wall_time['stddev'] * 1000),
+            '%.2f' % (wall_time['median'] * 1000),
+            result['queries'],
+            '%.1f KiB' % (result['peak_memory'] / 1024),
+        ))
+
+    def compare(self, old_path, new_path, threshold):
+        results = []
+        for path in (old_path, new_path):
+            try:
+                with open(path) as result_file:
+                    results.append(json.load(result_file))
+            except (OSError, ValueError) as error:
+                raise CommandError("Could not read %s: %s" % (path, error))
+
+        comparison = benchmarks.compare(*results, threshold=threshold)
+        self.stdout.write(COMPARISON_FORMAT % ('Name (size)', 'Measure', 'Old', 'New', 'Change', ''))
+        for row in comparison:
+            if row['measure'] == 'wall_time':
+                old_value, new_value = '%.2f ms' % (row['old'] * 1000), '%.2f ms' % (row['new'] * 1000)
+            elif row['measure'] == 'peak_memory':
+                old_value, new_value = '%.1f KiB' % (row['old'] / 1024), '%.1f KiB' % (row['new'] / 1024)
+            else:
+                old_value, new_value = row['old'], row['new']
+            self.stdout.write(COMPARISON_FORMAT % (
+                '%s (%s)' % (row['name'], row['size']), row['measure'], old_value, new_value,
+                '%+.1f%%' % (row['change'] * 100), 'REGRESSION' if row['is_regression'] else '',
+            ))
+
+        regressions = [row for row in comparison if row['is_regression']]
+        if len(regressions) > 0:
+            raise CommandError("%d regressions" % len(regressions))
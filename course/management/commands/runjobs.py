@@ -0,0 +1,36 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection
+from course import jobs
+
+class Command(BaseCommand):
+    help = 'Run the queued background jobs (e.g. achievement refreshes started in the admin)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=1, help='Number of jobs running at the same time')
+        parser.add_argument('--loop', action='store_true', help='Keep running, checking for new jobs')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between checks for new jobs when looping')
+
+    def handle(self, *args, **options):
+        if options['threads'] > 1:
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                futures = [executor.submit(self.work, options) for i in range(options['threads'])]
+                for future in futures:
+                    future.result()
+        else:
+            self.work(options)
+
+    def work(self, options):
+        try:
+            while True:
+                job = jobs.run_next_job()
+                if job != None:
+                    self.stdout.write("%s: %s in %s" % (job, job.get_status_display(), job.duration))
+                elif options['loop']:
+                    time.sleep(options['interval'])
+                else:
+                    break
+        finally:
+            # Each thread has its own database connection
+            connection.close()
@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from course import invitations
+
+class Command(BaseCommand):
+    help = 'Send the pending invitation emails of the outbox, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Invitations sent through each connection (default: INVITATION_BATCH_SIZE)')
+        parser.add_argument('--loop', action='store_true', help='Keep running, checking the outbox for new invitations')
+        parser.add_argument('--interval', type=float, default=30, help='Seconds between outbox checks when looping')
+
+    def handle(self, *args, **options):
+        while True:
+            counts = invitations.send_batch(options['batch_size'])
+            if counts['sent'] + counts['failed'] > 0:
+                self.stdout.write("%(sent)d invitations sent, %(failed)d failed" % counts)
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
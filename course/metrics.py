@@ -0,0 +1,61 @@
+"""
+Prometheus metrics.
+
+The metrics are exposed at /metrics in the Prometheus text format. Every process
+with PROMETHEUS_MULTIPROC_DIR set (the gunicorn workers, the runjobs and
+sendinvitations workers, see settings.py) writes its values to files in that
+directory, and they are all added up there.
+"""
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+
+REQUEST_DURATION = Histogram(
+    'gamified_request_duration_seconds', 'Wall time of the requests, by view', ['view'],
+)
+REQUEST_QUERIES = Histogram(
+    'gamified_request_queries', 'SQL queries made by the requests, by view', ['view'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+REQUEST_SQL_DURATION = Histogram(
+    'gamified_request_sql_duration_seconds', 'Time spent in SQL queries by the requests, by view', ['view'],
+)
+CACHE_LOOKUPS = Counter(
+    'gamified_cache_lookups', 'Lookups in the class and membership caches', ['cache', 'result'],
+)
+ACHIEVEMENT_REFRESH_DURATION = Histogram(
+    'gamified_achievement_refresh_duration_seconds', 'Time to recompute and save the achievements of a class',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+IMPORT_DURATION = Histogram(
+    'gamified_import_duration_seconds', 'Time to import a grades or roster file', ['kind'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+IMPORT_ROWS = Counter(
+    'gamified_import_rows', 'Rows of imported files, by outcome', ['kind', 'result'],
+)
+MARKDOWN_RENDER_DURATION = Histogram(
+    'gamified_markdown_render_duration_seconds', 'Time to render the markdown of widgets and posts',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+def observe_request(sample):
+    """
+    Records a request measured by the instrumentation middleware.
+    """
+    REQUEST_DURATION.labels(sample['view']).observe(sample['wall_ms'] / 1000)
+    REQUEST_QUERIES.labels(sample['view']).observe(sample['queries'])
+    REQUEST_SQL_DURATION.labels(sample['view']).observe(sample['sql_ms'] / 1000)
+
+def render():
+    """
+    Returns the text of all the metrics and its content type.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR', '') != '':
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+
+def fill_leaderboard(apps, schema_editor):
+    Enrollment = apps.get_model('course', 'Enrollment')
+    Grade = apps.get_model('course', 'Grade')
+
+    totals = {}
+    for enrollment_id, score, is_canceled, points in Grade.objects.values_list(
+        'enrollment_id', 'score', 'is_canceled', 'assignment_task__points'
+    ):
+        if is_canceled:
+            xp = 0.0
+        elif points == None:
+            xp = score
+        else:
+            xp = score * points
+        totals[enrollment_id] = totals.get(enrollment_id, 0.0) + xp
+
+    enrollments_by_class = {}
+    for enrollment in Enrollment.objects.only('id', 'course_class_id'):
+        enrollments_by_class.setdefault(enrollment.course_class_id, []).append(enrollment)
+
+    for enrollments in enrollments_by_class.values():
+        graded = sorted(
+            (enrollment for enrollment in enrollments if enrollment.id in totals),
+            key=lambda enrollment: -totals[enrollment.id]
+        )
+        for position, enrollment in enumerate(graded, start=1):
+            previous = graded[position - 2] if position > 1 else None
+            if previous != None and totals[previous.id] == totals[enrollment.id]:
+                enrollment.rank = previous.rank
+            else:
+                enrollment.rank = position
+
+        for enrollment in enrollments:
+            enrollment.total_xp = totals.get(enrollment.id, 0.0)
+            if enrollment.id not in totals:
+                enrollment.rank = None
+
+        Enrollment.objects.bulk_update(enrollments, ['total_xp', 'rank'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0026_alter_courseclass_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enrollment',
+            name='rank',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='enrollment',
+            name='total_xp',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='enrollment',
+            index=models.Index(fields=['course_class', 'rank'], name='enrollment_ranking_idx'),
+        ),
+        migrations.RunPython(fill_leaderboard, migrations.RunPython.noop),
+    ]
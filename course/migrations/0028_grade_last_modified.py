@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0027_leaderboard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grade',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
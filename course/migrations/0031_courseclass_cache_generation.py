@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0030_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='courseclass',
+            name='cache_generation',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0032_invitation_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat_datetime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:48
+
+import time
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('course', '0033_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='courseclass',
+            name='cache_generation',
+            field=models.BigIntegerField(default=time.time_ns, editable=False),
+        ),
+    ]
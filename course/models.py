@@ -7,9 +7,16 @@ from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
 import datetime
+import functools
+import hashlib
+import math
+import time
 import markdown2
 
+from .metrics import MARKDOWN_RENDER_DURATION
+
 # Create your models here.
 
 def convert_hex_to_rgba(color_hex, alpha):
@@ -18,6 +25,13 @@ def convert_hex_to_rgba(color_hex, alpha):
     rgba_text = 'rgba(%d, %d, %d, %f)' % (rgb_values + (alpha,))
     return rgba_text
 
+def display_xp(total_xp):
+    # Stored totals are kept by adding deltas, so they may carry tiny float errors
+    # (e.g. 69.99999999 instead of 70). Fractional totals are shown as they are,
+    # like the sum of the grades was before the totals were stored
+    total_xp = round(float(total_xp), 6)
+    return int(total_xp) if total_xp.is_integer() else total_xp
+
 def validate_hex_color(value):
     if not re.search(r'^#[0-9a-fA-F]{6}$', value):
         raise ValidationError(
@@ -75,6 +89,13 @@ class CourseClass(models.Model):
     end_date = models.DateField()
     ranking_size = models.IntegerField(default=10, validators=[MinValueValidator(0)])
     total_of_lives = models.IntegerField(default=0, validators=[MinValueValidator(0)])
+    achievements_refreshed_datetime = models.DateTimeField(
+        null=True, blank=True, editable=False, verbose_name=_('Achievements refreshed at')
+    )
+    # Version of the cached data of the class (see course/caching.py)
+    # A timestamp, like the ones written by caching.bump_class_generation, so a
+    # new class never finds the data cached for a deleted one with the same id
+    cache_generation = models.BigIntegerField(default=time.time_ns, editable=False)
     
     class Meta:
         verbose_name_plural = "Classes"
@@ -85,6 +106,16 @@ class CourseClass(models.Model):
     def __str__(self):
         return self.course.code + ' – ' + self.code
 
+    def save(self, *args, **kwargs):
+        # cache_generation is only changed by caching.bump_class_generation, so
+        # saving an instance loaded earlier must not write back its old value
+        if self.pk != None and not self._state.adding and kwargs.get('update_fields') == None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'cache_generation'
+            ]
+        super().save(*args, **kwargs)
+
     def clean(self):
         super(CourseClass, self).clean()
 
@@ -113,6 +144,9 @@ class Enrollment(models.Model):
     student = models.ForeignKey(Student, on_delete=models.CASCADE)
     course_class = models.ForeignKey(CourseClass, on_delete=models.CASCADE)
     lost_lives = models.IntegerField(default=0, validators=[MinValueValidator(0)])
+    # Materialized leaderboard, maintained by course/leaderboard.py
+    total_xp = models.FloatField(default=0, editable=False)
+    rank = models.IntegerField(null=True, blank=True, editable=False)
     
     def __str__(self):
         return "%s (%s)" % (self.student, self.course_class)
@@ -133,24 +167,13 @@ class Enrollment(models.Model):
         super().clean()
 
     def total_score(self):
-        score = self.grade_set.all().aggregate(
-            score = Sum(
-                Case(
-                    When(is_canceled=True, then=0),
-                    When(assignment_task__points=None, then=F('score')),
-                    default=F('score') * F('assignment_task__points'),
-                    output_field=IntegerField()
-                )
-            )
-        )['score']
-
-        if score == None:
-            score = 0
-
-        return score
+        return display_xp(self.total_xp)
 
     class Meta:
         unique_together = ('student', 'course_class')
+        indexes = [
+            models.Index(fields=['course_class', 'rank'], name='enrollment_ranking_idx'),
+        ]
         
 
 class Instructor(models.Model):
@@ -243,6 +266,7 @@ class Grade(models.Model):
     assignment_task = models.ForeignKey(AssignmentTask, on_delete=models.CASCADE)
     score = models.FloatField()
     is_canceled = models.BooleanField(default=False, verbose_name='Canceled')
+    last_modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('enrollment', 'assignment_task')
@@ -311,37 +335,87 @@ class Widget(models.Model):
     # This processing allows a widget to have conditional content based on the current date and time
     # Snippets of markdown text can be hidden if its datetime is in the future
     # The datetime must be in the format {{{snippet}}}(YYYY-MM-DD HH:MM:SS)
-    # I had to use a substitute function to delete the \r\n if the removed snippet leaves an empty line
+    # The rendered HTML is cached until the next snippet shows up (see render_widget_markdown)
     @property
     def html_code(self):
-        final_text = self.markdown_text
+        return render_widget_markdown(self.markdown_text)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Parse the snippet schedule and render the current HTML once, instead of in the next request
+        render_widget_markdown(self.markdown_text)
+
+
+WIDGET_SNIPPET_PATTERN = re.compile(
+    r"\{\{\{([\s\S]*?)\}\}\}\((\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\)([ \t]*(?:\r\n|\n\r|\n|\r))?"
+)
+
+@functools.lru_cache(maxsize=1024)
+def parse_widget_snippets(markdown_text):
+    """
+    Finds the timed snippets of a widget text, only once per text.
+    Returns a tuple of (start, end, text when shown, text when hidden, datetime to show).
+    I had to keep the ending of the match to delete the \r\n if the removed snippet leaves an empty line.
+    """
+    snippets = []
+    for match in WIDGET_SNIPPET_PATTERN.finditer(markdown_text):
+        whole_match = match.group(0)
+        snippet = match.group(1)
+        datetime_text = match.group(2)
+        ending = match.group(3) or ""
+
+        previous_character = markdown_text[match.start()-1] if match.start() > 0 else ""
+        if len(markdown_text) == len(whole_match):
+            hidden_text = ""
+        elif (previous_character in ['\n', '\r'] or previous_character == "") and \
+            (match.end() == len(markdown_text) or ending != ""):
+            hidden_text = ""
+        else:
+            hidden_text = ending
 
-        pattern = r"\{\{\{([\s\S]*?)\}\}\}\((\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\)([ \t]*(?:\r\n|\n\r|\n|\r))?"
-        
-        def substituir_condicional(match: re.Match):
-            whole_match = match.group(0)
-            snippet = match.group(1)
-            datetime_text = match.group(2)
-            ending = match.group(3) or ""
-
-            datetime_object = datetime.datetime.strptime(datetime_text, "%Y-%m-%d %H:%M:%S")
-            if datetime_object < datetime.datetime.now():
-                return snippet + ending
-            else:
-                previous_character = final_text[match.start()-1] if match.start() > 0 else ""
-                
-                if len(self.markdown_text) == len(whole_match):
-                    return ""
-                elif (previous_character in ['\n', '\r'] or previous_character == "") and \
-                    (match.end() == len(self.markdown_text) or ending != ""):
-                    return ""
-                else:
-                    return ending
-            
-        final_text = re.sub(pattern, substituir_condicional, final_text)
-        
-        final_html_code = markdown2.markdown(final_text, extras=["tables", "fenced-code-blocks"])
-        return final_html_code
+        snippets.append((
+            match.start(), match.end(), snippet + ending, hidden_text,
+            datetime.datetime.strptime(datetime_text, "%Y-%m-%d %H:%M:%S")
+        ))
+
+    return tuple(snippets)
+
+def render_widget_markdown(markdown_text):
+    """
+    Renders a widget text, showing the snippets whose datetime has passed.
+    The HTML is cached by the hash of the text and the number of snippets shown,
+    and expires when the next snippet shows up.
+    """
+    now = datetime.datetime.now()
+    snippets = parse_widget_snippets(markdown_text)
+
+    show_datetimes = sorted(snippet[4] for snippet in snippets)
+    shown_count = sum(1 for show_datetime in show_datetimes if show_datetime < now)
+    text_hash = hashlib.sha1(markdown_text.encode('utf-8')).hexdigest()
+    cache_key = 'widget-html:%s:%d' % (text_hash, shown_count)
+
+    html_code = cache.get(cache_key)
+    if html_code != None:
+        return html_code
+
+    pieces = []
+    position = 0
+    for start, end, shown_text, hidden_text, show_datetime in snippets:
+        pieces.append(markdown_text[position:start])
+        pieces.append(shown_text if show_datetime < now else hidden_text)
+        position = end
+    pieces.append(markdown_text[position:])
+
+    with MARKDOWN_RENDER_DURATION.time():
+        html_code = markdown2.markdown("".join(pieces), extras=["tables", "fenced-code-blocks"])
+
+    timeout = settings.COURSE_CACHE_TIMEOUT
+    if shown_count < len(show_datetimes):
+        seconds_to_next_snippet = (show_datetimes[shown_count] - now).total_seconds()
+        timeout = max(1, min(timeout, math.ceil(seconds_to_next_snippet)))
+    cache.set(cache_key, html_code, timeout)
+
+    return html_code
 
 
 class Badge(ModelWithIcon):
@@ -470,4 +544,78 @@ class Achievement(models.Model):
                 code='invalid'
             )
 
-    
\ No newline at end of file
+    
+
+class Invitation(models.Model):
+    """
+    An invitation email in the outbox, sent by the sendinvitations command
+    (see course/invitations.py).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    domain = models.CharField(max_length=255)
+    use_https = models.BooleanField(default=True)
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, _('Pending')), (SENDING, _('Sending')), (SENT, _('Sent')), (FAILED, _('Failed')))
+    status = models.CharField(choices=STATUSES, max_length=10, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_datetime = models.DateTimeField(default=timezone.now)
+    next_attempt_datetime = models.DateTimeField(default=timezone.now)
+    sent_datetime = models.DateTimeField(null=True, blank=True)
+    # When a worker claimed it to send it (see invitations.claim_batch)
+    claimed_datetime = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "%s (%s)" % (self.user.email, self.get_status_display())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_datetime'], name='invitation_outbox_idx'),
+        ]
+
+
+class Job(models.Model):
+    """
+    A background job, run by the runjobs command (see course/jobs.py).
+    """
+    REFRESH_ACHIEVEMENTS = 'refresh_achievements'
+    KINDS = ((REFRESH_ACHIEVEMENTS, _('Refresh achievements')),)
+    kind = models.CharField(choices=KINDS, max_length=30)
+    course_class_ids = models.JSONField(default=list)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((QUEUED, _('Queued')), (RUNNING, _('Running')), (DONE, _('Done')), (FAILED, _('Failed')))
+    status = models.CharField(choices=STATUSES, max_length=10, default=QUEUED)
+
+    # Progress, updated after each class
+    classes_done = models.IntegerField(default=0)
+    rows_updated = models.IntegerField(default=0)
+    log = models.TextField(blank=True)
+
+    created_datetime = models.DateTimeField(default=timezone.now)
+    started_datetime = models.DateTimeField(null=True, blank=True)
+    finished_datetime = models.DateTimeField(null=True, blank=True)
+    # Renewed with each progress update, so a job whose worker died can be taken by another one
+    heartbeat_datetime = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "%s #%d" % (self.get_kind_display(), self.id)
+
+    @property
+    def duration(self):
+        if self.started_datetime == None:
+            return None
+        return (self.finished_datetime or timezone.now()) - self.started_datetime
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_datetime'], name='job_queue_idx'),
+        ]
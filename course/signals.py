@@ -0,0 +1,167 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import leaderboard, achievements, caching
+from .models import *
+
+
+# Keep the leaderboard (Enrollment.total_xp and Enrollment.rank) up to date.
+# The totals change right away; the ranks are refreshed once per class when the
+# transaction commits, so saving or deleting many grades doesn't reread the class
+# each time.
+# Bulk writes (queryset.update, bulk_create...) don't send signals, so they must
+# call the leaderboard and achievements functions themselves.
+
+@receiver(pre_save, sender=Grade)
+def remember_previous_grade(sender, instance, raw=False, **kwargs):
+    instance._previous_grade = None
+    if raw or instance.pk == None:
+        return
+
+    instance._previous_grade = Grade.objects.filter(pk=instance.pk).values_list(
+        'enrollment_id', 'score', 'is_canceled', 'assignment_task__points', 'assignment_task__course_class_id',
+        'assignment_task__assignment_id', 'assignment_task__task_id',
+    ).first()
+
+@receiver(post_save, sender=Grade)
+def update_leaderboard_on_grade_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    assignment_task = instance.assignment_task
+    new_xp = leaderboard.grade_xp(instance.score, instance.is_canceled, assignment_task.points)
+    deltas = {instance.enrollment_id: new_xp}
+    course_class_ids = {assignment_task.course_class_id}
+
+    previous = getattr(instance, '_previous_grade', None)
+    if previous != None:
+        enrollment_id, score, is_canceled, points, course_class_id = previous[:5]
+        if enrollment_id == instance.enrollment_id and new_xp == leaderboard.grade_xp(score, is_canceled, points):
+            return
+        deltas[enrollment_id] = deltas.get(enrollment_id, 0) - leaderboard.grade_xp(score, is_canceled, points)
+        course_class_ids.add(course_class_id)
+
+    leaderboard.apply_deltas(deltas)
+    for course_class_id in course_class_ids:
+        leaderboard.schedule_rank_refresh(course_class_id)
+
+@receiver(post_delete, sender=Grade)
+def update_leaderboard_on_grade_delete(sender, instance, **kwargs):
+    assignment_task = AssignmentTask.objects.filter(pk=instance.assignment_task_id).values_list(
+        'points', 'course_class_id'
+    ).first()
+    if assignment_task == None:
+        return
+
+    points, course_class_id = assignment_task
+    leaderboard.apply_deltas({
+        instance.enrollment_id: -leaderboard.grade_xp(instance.score, instance.is_canceled, points)
+    })
+    leaderboard.schedule_rank_refresh(course_class_id)
+
+
+@receiver(pre_save, sender=AssignmentTask)
+def remember_previous_assignment_task(sender, instance, raw=False, **kwargs):
+    instance._previous_points = None
+    instance._previous_assignment_task = None
+    if raw or instance.pk == None:
+        return
+
+    instance._previous_assignment_task = AssignmentTask.objects.filter(pk=instance.pk).values_list(
+        'points', 'is_optional', 'assignment_id', 'task_id'
+    ).first()
+    if instance._previous_assignment_task != None:
+        instance._previous_points = instance._previous_assignment_task[0]
+
+@receiver(post_save, sender=AssignmentTask)
+def update_leaderboard_on_points_change(sender, instance, created, raw=False, **kwargs):
+    if raw or created or instance._previous_points == instance.points:
+        return
+
+    leaderboard.apply_points_change(instance, instance._previous_points, instance.points)
+    leaderboard.schedule_rank_refresh(instance.course_class_id)
+
+
+# Recompute the achievements that depend on the changed grades when the
+# transaction commits, once per class (see course/deferred.py). Only the badges
+# whose criteria read the changed assignment tasks are recomputed, and only for
+# the enrollments that were graded.
+
+@receiver(post_save, sender=Grade)
+def refresh_achievements_on_grade_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    assignment_task = instance.assignment_task
+    assignment_tasks = [(assignment_task.assignment_id, assignment_task.task_id)]
+    achievements.schedule_refresh(assignment_task.course_class_id, assignment_tasks, [instance.enrollment_id])
+
+    # A grade moved to another enrollment or assignment task changes the
+    # achievements that read it before too
+    previous = getattr(instance, '_previous_grade', None)
+    if previous != None and (previous[0], previous[5:]) != (instance.enrollment_id, assignment_tasks[0]):
+        achievements.schedule_refresh(previous[4], [previous[5:]], [previous[0]])
+
+@receiver(post_delete, sender=Grade)
+def refresh_achievements_on_grade_delete(sender, instance, **kwargs):
+    assignment_task = AssignmentTask.objects.filter(pk=instance.assignment_task_id).values_list(
+        'course_class_id', 'assignment_id', 'task_id'
+    ).first()
+    if assignment_task == None:
+        return
+
+    course_class_id, assignment_id, task_id = assignment_task
+    achievements.schedule_refresh(course_class_id, [(assignment_id, task_id)], [instance.enrollment_id])
+
+# New, deleted and optional assignment tasks and points changes change
+# Assignment.points(), so they affect the whole class
+
+@receiver(post_save, sender=AssignmentTask)
+def refresh_achievements_on_assignment_task_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    assignment_tasks = [(instance.assignment_id, instance.task_id)]
+    previous = getattr(instance, '_previous_assignment_task', None)
+    if not created and previous != None:
+        if previous == (instance.points, instance.is_optional, instance.assignment_id, instance.task_id):
+            return
+        # The criteria that read it before it moved are affected too
+        assignment_tasks.append(previous[2:])
+
+    achievements.schedule_refresh(instance.course_class_id, assignment_tasks)
+
+@receiver(post_delete, sender=AssignmentTask)
+def refresh_achievements_on_assignment_task_delete(sender, instance, **kwargs):
+    achievements.schedule_refresh(instance.course_class_id, [(instance.assignment_id, instance.task_id)])
+
+
+# Invalidate the cached data of the classes touched by a write (see course/caching.py).
+# These receivers are connected last, so they run after the ones above.
+
+def class_ids_of(instance):
+    if isinstance(instance, CourseClass):
+        return [instance.id]
+    elif isinstance(instance, Course):
+        return CourseClass.objects.filter(course_id=instance.id).values_list('id', flat=True)
+    elif isinstance(instance, (Enrollment, ClassInstructor, AssignmentTask, Post, Widget, ClassBadge)):
+        return [instance.course_class_id]
+    elif isinstance(instance, Grade):
+        return AssignmentTask.objects.filter(pk=instance.assignment_task_id).values_list('course_class_id', flat=True)
+    elif isinstance(instance, Achievement):
+        return ClassBadge.objects.filter(pk=instance.class_badge_id).values_list('course_class_id', flat=True)
+    elif isinstance(instance, Student):
+        return Enrollment.objects.filter(student_id=instance.id).values_list('course_class_id', flat=True)
+    else:
+        # Assignment, Task and Badge belong to a course, so they may be shown in all its classes
+        return CourseClass.objects.filter(course_id=instance.course_id).values_list('id', flat=True)
+
+def bump_generation_on_write(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    for course_class_id in class_ids_of(instance):
+        caching.bump_class_generation(course_class_id)
+
+for model in [Course, CourseClass, Enrollment, ClassInstructor, Student, Assignment, Task, AssignmentTask, Grade, Post, Widget, Badge, ClassBadge, Achievement]:
+    post_save.connect(bump_generation_on_write, sender=model, dispatch_uid='bump_generation_on_save_%s' % model.__name__)
+    post_delete.connect(bump_generation_on_write, sender=model, dispatch_uid='bump_generation_on_delete_%s' % model.__name__)
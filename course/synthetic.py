@@ -0,0 +1,196 @@
+"""
+Synthetic data for load and scaling tests.
+
+Creates courses (with assignments, tasks and badges) and classes (with
+instructors, students, assignment tasks, grades, badge criteria, posts and
+widgets) using bulk inserts, with everything drawn from a random.Random, so the
+same seed and sizes always give the same data. Dates are offsets from a base
+date (BASE_DATE, unless another one is given), not from today. Grades are
+inserted in batches, so memory doesn't grow with the size of the class.
+
+Bulk inserts don't send signals: the leaderboard and the achievements of the
+classes are not updated here (see the generatedata command).
+"""
+import datetime
+import markdown2
+from itertools import islice
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import (
+    Course, CourseClass, Student, Instructor, ClassInstructor, Enrollment, Assignment, Task, AssignmentTask,
+    Grade, Badge, ClassBadge, ClassBadgeCriteria, Post, Widget,
+)
+
+BATCH_SIZE = 5000
+
+BASE_DATE = datetime.date(2024, 3, 1)
+
+POST_TEXT = """# Post %d
+
+Some **news** for the class, with a [link](https://example.com/%d).
+
+| Assignment | Due date |
+|------------|----------|
+| 1          | Monday   |
+"""
+
+WIDGET_TEXT = """**Next due date:** %s
+
+{{{Solutions are [online](https://example.com/solutions).}}}(%s)
+"""
+
+
+def create_course(code, number_of_assignments, tasks_per_assignment, number_of_badges):
+    """
+    Creates a course with its assignments, tasks and badges.
+    Returns (course, assignments, tasks, badges).
+    """
+    course = Course.objects.create(name='Course %s' % code, code=code)
+    assignments = Assignment.objects.bulk_create([
+        Assignment(course=course, name='Assignment %d' % i) for i in range(number_of_assignments)
+    ])
+    tasks = Task.objects.bulk_create([
+        Task(course=course, name='Task %d' % i) for i in range(tasks_per_assignment)
+    ])
+    badges = Badge.objects.bulk_create([
+        Badge(course=course, name='Badge %d' % i) for i in range(number_of_badges)
+    ])
+    return course, assignments, tasks, badges
+
+def create_class(
+    rng, course, assignments, tasks, badges, code, number_of_students,
+    graded_fraction=0.7, optional_fraction=0.2, canceled_fraction=0.05, percentage_task_fraction=0.2,
+    number_of_posts=0, number_of_widgets=0, base_date=BASE_DATE,
+):
+    """
+    Creates a class of a course made by create_course, running around base_date,
+    with one instructor and number_of_students students, and random grades and
+    badge criteria:
+      - graded_fraction of the grades exist
+      - optional_fraction of the assignment tasks are optional
+      - canceled_fraction of the grades are canceled
+      - percentage_task_fraction of the assignment tasks have no points, so
+        their score is the XP itself
+    The first task of each assignment is mandatory and has points, so every
+    badge criteria can be evaluated. Returns (course_class, number of grades).
+    """
+    # Noon of the base date, in the current time zone
+    base_datetime = timezone.make_aware(datetime.datetime.combine(base_date, datetime.time(12)))
+    course_class = CourseClass.objects.create(
+        course=course, code=code,
+        start_date=base_date - datetime.timedelta(days=rng.randint(20, 40)),
+        end_date=base_date + datetime.timedelta(days=rng.randint(40, 80)),
+        ranking_size=10, total_of_lives=3,
+    )
+    prefix = '%s-%s' % (course.code, code)
+
+    instructor_user = User.objects.create(
+        username='%s-instructor' % prefix, email='%s-instructor@example.com' % prefix, date_joined=base_datetime
+    )
+    instructor = Instructor.objects.create(user=instructor_user, full_name='Instructor %s' % prefix)
+    ClassInstructor.objects.create(instructor=instructor, course_class=course_class)
+
+    enrollments = []
+    for batch in batches(range(number_of_students), BATCH_SIZE):
+        # '!' is an unusable password, so there is no hashing to slow it down
+        users = User.objects.bulk_create([
+            User(
+                username='%s-%d' % (prefix, i), email='%s-%d@example.com' % (prefix, i), password='!',
+                date_joined=base_datetime,
+            )
+            for i in batch
+        ])
+        students = Student.objects.bulk_create([
+            Student(user=user, full_name='Student %s %d' % (prefix, i), id_number='%d' % (i + 1))
+            for i, user in zip(batch, users)
+        ])
+        enrollments += Enrollment.objects.bulk_create([
+            Enrollment(student=student, course_class=course_class, lost_lives=rng.choice([0, 0, 0, 1, 2]))
+            for student in students
+        ])
+
+    assignment_tasks = AssignmentTask.objects.bulk_create([
+        AssignmentTask(
+            assignment=assignment, task=task, course_class=course_class,
+            points=None if i > 0 and rng.random() < percentage_task_fraction else rng.choice([10, 20, 50]),
+            is_optional=i > 0 and rng.random() < optional_fraction,
+        )
+        for assignment in assignments
+        for i, task in enumerate(tasks)
+    ])
+
+    # Plain ids instead of instances, to save the related descriptors' work on a million grades
+    assignment_task_points = [(assignment_task.id, assignment_task.points) for assignment_task in assignment_tasks]
+    def random_grades():
+        for enrollment in enrollments:
+            for assignment_task_id, points in assignment_task_points:
+                if rng.random() >= graded_fraction:
+                    continue
+                if points == None:
+                    score = float(rng.randint(0, 10))
+                else:
+                    score = rng.choice([0, 0.25, 0.5, 0.75, 1, 1, 1])
+                yield Grade(
+                    enrollment_id=enrollment.id, assignment_task_id=assignment_task_id,
+                    score=score, is_canceled=rng.random() < canceled_fraction
+                )
+
+    number_of_grades = 0
+    for batch in batches(random_grades(), BATCH_SIZE):
+        Grade.objects.bulk_create(batch)
+        number_of_grades += len(batch)
+
+    class_badges = ClassBadge.objects.bulk_create([
+        ClassBadge(
+            badge=badge, course_class=course_class,
+            aggregation_type_for_criteria=rng.choice([ClassBadge.AND, ClassBadge.OR])
+        )
+        for badge in badges
+    ])
+
+    criteria_list = []
+    for class_badge in class_badges:
+        for _ in range(rng.randint(1, 3)):
+            assignment = rng.choice(assignments + [None])
+            task = rng.choice(tasks + [None]) if assignment != None else rng.choice(tasks)
+            goal_type = rng.choice([ClassBadgeCriteria.PERCENTAGE, ClassBadgeCriteria.XP])
+            criteria_list.append(ClassBadgeCriteria(
+                class_badge=class_badge, assignment=assignment, task=task,
+                goal_type=goal_type,
+                goal=rng.choice([0.5, 0.8, 1.0]) if goal_type == ClassBadgeCriteria.PERCENTAGE else rng.choice([10, 50, 200]),
+                accepts_partial_goal=rng.random() < 0.7,
+            ))
+    ClassBadgeCriteria.objects.bulk_create(criteria_list)
+
+    posts = []
+    for i in range(number_of_posts):
+        markdown_text = POST_TEXT % (i, i)
+        posts.append(Post(
+            course_class=course_class, title='Post %d' % i, markdown_text=markdown_text,
+            html_code=markdown2.markdown(markdown_text, extras=["tables", "fenced-code-blocks"]),
+            is_pinned_to_the_top=(i == 0),
+            post_datetime=base_datetime - datetime.timedelta(minutes=rng.randint(0, 20 * 24 * 60)),
+        ))
+    Post.objects.bulk_create(posts)
+    Widget.objects.bulk_create([
+        Widget(
+            course_class=course_class, title='Widget %d' % i, order=i,
+            markdown_text=WIDGET_TEXT % (
+                base_date + datetime.timedelta(days=7 * (i + 1)),
+                # Snippet times are naive, in the server's local time
+                datetime.datetime.combine(base_date, datetime.time(12)) + datetime.timedelta(days=rng.randint(-7, 7)),
+            ),
+        )
+        for i in range(number_of_widgets)
+    ])
+
+    return course_class, number_of_grades
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
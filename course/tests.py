@@ -1,3 +1,1192 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import json
+import random
+import tempfile
+import markdown2
+from unittest import mock
+from django.conf import settings
+from django.test import Client, TestCase, override_settings
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.urls import include, re_path
+from django.utils import timezone
+from gamifiededucation import urls as gamifiededucation_urls
 
-# Create your tests here.
+from .models import *
+from .views import get_assignments_data, get_achievements_data
+from . import caching, imports, leaderboard, invitations, jobs, exports, instrumentation, benchmarks, synthetic, achievements
+from .admin import clone_course_class
+from .management.commands.benchmarkachievements import reference_percentages, create_synthetic_class
+
+
+def create_course_class(code='C1'):
+    course = Course.objects.create(name='Course %s' % code, code=code)
+    return CourseClass.objects.create(
+        course=course,
+        code='2024',
+        start_date=datetime.date.today() - datetime.timedelta(days=30),
+        end_date=datetime.date.today() + datetime.timedelta(days=30),
+    )
+
+def create_student(course_class, name):
+    user = User.objects.create(username=name, email='%s@example.com' % name)
+    student = Student.objects.create(user=user, full_name=name)
+    return Enrollment.objects.create(student=student, course_class=course_class)
+
+def add_assignments(course_class, enrollment, number_of_assignments, tasks_per_assignment=3):
+    course = course_class.course
+    first_assignment_number = Assignment.objects.filter(course=course).count()
+    tasks = [
+        Task.objects.get_or_create(course=course, name='Task %d' % i)[0]
+        for i in range(tasks_per_assignment)
+    ]
+    for i in range(number_of_assignments):
+        assignment = Assignment.objects.create(course=course, name='Assignment %d' % (first_assignment_number + i))
+        for j, task in enumerate(tasks):
+            assignment_task = AssignmentTask.objects.create(
+                assignment=assignment, task=task, course_class=course_class,
+                points=None if j == 2 else 10, is_optional=(j == 1),
+            )
+            if j != 1:
+                Grade.objects.create(
+                    enrollment=enrollment, assignment_task=assignment_task,
+                    score=3 if assignment_task.points == None else 0.5,
+                )
+
+def add_badges(course_class, enrollment, number_of_badges):
+    first_badge_number = Badge.objects.filter(course=course_class.course).count()
+    for i in range(number_of_badges):
+        badge = Badge.objects.create(course=course_class.course, name='Badge %d' % (first_badge_number + i))
+        class_badge = ClassBadge.objects.create(
+            badge=badge, course_class=course_class, show_info_before_completion=(i % 2 == 0)
+        )
+        Achievement.objects.create(enrollment=enrollment, class_badge=class_badge, percentage=0.5)
+
+
+class AssignmentsPageTest(TestCase):
+    def count_queries(self, function):
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        return len(queries)
+
+    def test_assignments_data(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        add_assignments(course_class, enrollment, 1)
+
+        assignments_data = get_assignments_data(enrollment)
+
+        self.assertEqual(len(assignments_data), 1)
+        self.assertEqual(assignments_data[0]['total_task_points'], 10)
+        self.assertEqual(assignments_data[0]['total_grade_points'], 8)
+        self.assertEqual(assignments_data[0]['total_grade_percentage'], 80)
+        self.assertEqual(
+            [(task['name'], task['grade_points'], task['is_optional']) for task in assignments_data[0]['tasks']],
+            [('Task 0', 5, False), ('Task 2', 3, False), ('Task 1', None, True)]
+        )
+
+    def test_query_count_does_not_grow_with_assignments(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        self.client.force_login(enrollment.student.user)
+        url = '/%s/%s/assignments/' % (course_class.course.code, course_class.code)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        add_assignments(course_class, enrollment, 2)
+        few_assignments_queries = self.count_queries(lambda: self.client.get(url))
+        builder_queries = self.count_queries(lambda: get_assignments_data(enrollment))
+
+        add_assignments(course_class, enrollment, 8)
+        many_assignments_queries = self.count_queries(lambda: self.client.get(url))
+
+        self.assertEqual(few_assignments_queries, many_assignments_queries)
+        self.assertEqual(builder_queries, 2)
+        self.assertEqual(self.count_queries(lambda: get_assignments_data(enrollment)), 2)
+
+    def test_achievements_data_uses_two_queries(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        add_badges(course_class, enrollment, 2)
+        Achievement.objects.filter(class_badge__badge__name='Badge 0').update(percentage=1)
+
+        achievements_data = get_achievements_data(enrollment)
+        self.assertEqual([data['name'] for data in achievements_data], ['Badge 0', '???'])
+        self.assertEqual([data['percentage_integer'] for data in achievements_data], [100, 50])
+        self.assertEqual(achievements_data[0]['icon'], '/static/course/trophy.svg')
+
+        add_badges(course_class, enrollment, 10)
+        self.assertEqual(self.count_queries(lambda: get_achievements_data(enrollment)), 2)
+
+
+class ClassCacheTest(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.course_class = create_course_class()
+            self.enrollment = create_student(self.course_class, 'alice')
+            add_assignments(self.course_class, self.enrollment, 1)
+        self.client.force_login(self.enrollment.student.user)
+        self.url = '/%s/%s/assignments/' % (self.course_class.course.code, self.course_class.code)
+
+    def check_grade_change_shows_up(self):
+        self.assertContains(self.client.get(self.url), '8 XP')
+
+        # The new generation is only written once per transaction, as if each request was one
+        with self.captureOnCommitCallbacks(execute=True):
+            grade = Grade.objects.get(enrollment=self.enrollment, assignment_task__points=10)
+            grade.score = 1
+            grade.save()
+
+        self.assertContains(self.client.get(self.url), '13 XP')
+
+    def test_grade_change_invalidates_local_memory_cache(self):
+        self.check_grade_change_shows_up()
+
+    def test_grade_change_invalidates_file_based_cache(self):
+        with tempfile.TemporaryDirectory() as cache_directory:
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': cache_directory,
+            }}):
+                self.check_grade_change_shows_up()
+
+    def in_another_process(self):
+        # Another process has its own local memory cache
+        return override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'another-process',
+        }})
+
+    def test_write_in_another_process_invalidates_the_cache(self):
+        self.assertContains(self.client.get(self.url), '8 XP')
+
+        with self.in_another_process(), self.captureOnCommitCallbacks(execute=True):
+            grade = Grade.objects.get(enrollment=self.enrollment, assignment_task__points=10)
+            grade.score = 1
+            grade.save()
+
+        self.assertContains(self.client.get(self.url), '13 XP')
+
+    def test_removed_student_loses_access_right_away(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        with self.in_another_process(), self.captureOnCommitCallbacks(execute=True):
+            Enrollment.objects.get(pk=self.enrollment.pk).delete()
+
+        self.assertTemplateUsed(self.client.get(self.url), 'course/error_page.html')
+
+    def test_saving_a_stale_class_keeps_the_new_generation(self):
+        stale_course_class = CourseClass.objects.get(pk=self.course_class.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            caching.bump_class_generation(self.course_class.id)
+        generation = caching.class_generation(self.course_class.id)
+
+        with self.captureOnCommitCallbacks():
+            stale_course_class.ranking_size = 5
+            stale_course_class.save()
+        self.assertEqual(caching.class_generation(self.course_class.id), generation)
+
+    def test_generation_is_written_after_the_commit(self):
+        generation = caching.class_generation(self.course_class.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            # Concurrent writers of the class don't wait for a lock on its row
+            with CaptureQueriesContext(connection) as queries:
+                for grade in Grade.objects.filter(enrollment=self.enrollment):
+                    grade.score = 1 if grade.score <= 1 else 10
+                    grade.save()
+            self.assertFalse(any('"course_courseclass"' in query['sql'] for query in queries if query['sql'].startswith('UPDATE')))
+            self.assertEqual(caching.class_generation(self.course_class.id), generation)
+
+        self.assertNotEqual(caching.class_generation(self.course_class.id), generation)
+
+    def test_cached_page_needs_fewer_queries(self):
+        with CaptureQueriesContext(connection) as first_queries:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as second_queries:
+            self.client.get(self.url)
+        self.assertLess(len(second_queries), len(first_queries))
+
+    def test_membership_is_cached(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        membership_queries = [
+            query for query in queries
+            if '"course_enrollment"' in query['sql'] or '"course_classinstructor"' in query['sql']
+        ]
+        self.assertEqual(membership_queries, [])
+
+    def test_instructor_membership(self):
+        user = User.objects.create(username='teacher')
+        instructor = Instructor.objects.create(user=user, full_name='Teacher')
+        ClassInstructor.objects.create(instructor=instructor, course_class=self.course_class)
+        self.client.force_login(user)
+
+        response = self.client.get('%s%d' % (self.url, self.enrollment.student_id))
+        self.assertContains(response, 'alice')
+        self.assertContains(response, '8 XP')
+
+        other_user = User.objects.create(username='stranger')
+        self.client.force_login(other_user)
+        self.assertTemplateUsed(self.client.get(self.url), 'course/error_page.html')
+
+
+class WidgetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.course_class = create_course_class()
+        enrollment = create_student(self.course_class, 'alice')
+        self.client.force_login(enrollment.student.user)
+        Widget.objects.create(
+            course_class=self.course_class, title='Widget', order=1,
+            markdown_text='Always shown\n\n{{{Shown at noon}}}(2030-01-01 12:00:00)\n',
+        )
+        self.url = '/%s/%s/' % (self.course_class.course.code, self.course_class.code)
+
+    def get_at(self, now):
+        frozen_datetime = mock.Mock(wraps=datetime.datetime)
+        frozen_datetime.now.return_value = now
+        with mock.patch('course.models.datetime', mock.Mock(datetime=frozen_datetime)):
+            return self.client.get(self.url)
+
+    def test_cached_widget_shows_the_snippet_once_its_time_passes(self):
+        with mock.patch('course.models.markdown2.markdown', wraps=markdown2.markdown) as markdown:
+            response = self.get_at(datetime.datetime(2030, 1, 1, 11, 59, 58))
+            self.assertContains(response, 'Always shown')
+            self.assertNotContains(response, 'Shown at noon')
+
+            self.assertNotContains(self.get_at(datetime.datetime(2030, 1, 1, 11, 59, 59)), 'Shown at noon')
+            # Both were read from the HTML rendered when the widget was saved
+            self.assertEqual(markdown.call_count, 0)
+
+            self.assertContains(self.get_at(datetime.datetime(2030, 1, 1, 12, 0, 1)), 'Shown at noon')
+            self.assertEqual(markdown.call_count, 1)
+
+
+class ClassesPageTest(TestCase):
+    def test_classes_are_split_in_one_query(self):
+        today = datetime.date.today()
+        user = User.objects.create(username='alice')
+        student = Student.objects.create(user=user, full_name='Alice')
+        for code, start, end in [('past', -60, -30), ('current', -10, 10), ('future', 30, 60), ('old', -90, -70)]:
+            course = Course.objects.create(name='Course %s' % code, code=code)
+            course_class = CourseClass.objects.create(
+                course=course, code='2024',
+                start_date=today + datetime.timedelta(days=start),
+                end_date=today + datetime.timedelta(days=end),
+            )
+            Enrollment.objects.create(student=student, course_class=course_class)
+        self.client.force_login(user)
+
+        self.client.get('/classes/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/classes/')
+
+        self.assertEqual(
+            [course_class.course.code for course_class in response.context['past_classes']], ['past', 'old']
+        )
+        self.assertEqual([course_class.course.code for course_class in response.context['current_classes']], ['current'])
+        self.assertEqual([course_class.course.code for course_class in response.context['future_classes']], ['future'])
+        class_queries = [query for query in queries if '"course_class"' in query['sql']]
+        self.assertEqual(len(class_queries), 1)
+
+    def test_classes_of_both_roles_are_listed_once(self):
+        course_class = create_course_class('C1')
+        other_course_class = create_course_class('C2')
+        enrollment = create_student(course_class, 'alice')
+        create_student(other_course_class, 'bob')
+        instructor = Instructor.objects.create(user=enrollment.student.user, full_name='alice')
+        for instructed_class in (course_class, other_course_class):
+            ClassInstructor.objects.create(instructor=instructor, course_class=instructed_class)
+        self.client.force_login(enrollment.student.user)
+
+        response = self.client.get('/classes/')
+        self.assertEqual(
+            sorted(course_class.course.code for course_class in response.context['current_classes']), ['C1', 'C2']
+        )
+
+    def test_single_class_redirects(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        self.client.force_login(enrollment.student.user)
+
+        response = self.client.get('/classes/')
+        self.assertRedirects(response, '/C1/2024/', fetch_redirect_response=False)
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        self.course_class = create_course_class()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice = create_student(self.course_class, 'alice')
+            self.bob = create_student(self.course_class, 'bob')
+            self.carol = create_student(self.course_class, 'carol')
+            add_assignments(self.course_class, self.alice, 1)
+        self.assignment_task = AssignmentTask.objects.get(course_class=self.course_class, task__name='Task 0')
+
+    def ranks(self):
+        return dict(Enrollment.objects.filter(course_class=self.course_class).values_list('student__full_name', 'rank'))
+
+    def check_leaderboard(self):
+        self.assertEqual(leaderboard.find_drift(self.course_class), [])
+        self.assertEqual(leaderboard.verify(self.course_class), [])
+
+    def test_grade_create_update_and_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            grade = Grade.objects.create(enrollment=self.bob, assignment_task=self.assignment_task, score=1)
+        self.check_leaderboard()
+        self.assertEqual(self.ranks(), {'alice': 2, 'bob': 1, 'carol': None})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            grade.score = 0.1
+            grade.save()
+        self.check_leaderboard()
+        self.assertEqual(self.ranks(), {'alice': 1, 'bob': 2, 'carol': None})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            grade.delete()
+        self.check_leaderboard()
+        self.assertEqual(self.ranks(), {'alice': 1, 'bob': None, 'carol': None})
+
+    def test_fractional_totals_are_shown_as_they_are(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Grade.objects.create(enrollment=self.bob, assignment_task=self.assignment_task, score=0.75)
+        self.check_leaderboard()
+
+        self.assertEqual([row['total'] for row in leaderboard.get_top(self.course_class, 10)], [8, 7.5])
+        self.assertEqual(Enrollment.objects.get(pk=self.bob.pk).total_score(), 7.5)
+
+    def test_grade_moved_to_another_enrollment(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            grade = Grade.objects.get(enrollment=self.alice, assignment_task=self.assignment_task)
+            grade.enrollment = self.carol
+            grade.save()
+        self.check_leaderboard()
+        self.assertEqual(self.ranks(), {'alice': 2, 'bob': None, 'carol': 1})
+
+    def test_points_change(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Grade.objects.create(enrollment=self.bob, assignment_task=self.assignment_task, score=1)
+
+        for points in (20, None, 10):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assignment_task.points = points
+                self.assignment_task.save()
+            self.check_leaderboard()
+
+    def test_ties_share_the_rank(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for grade in Grade.objects.filter(enrollment=self.alice):
+                Grade.objects.create(
+                    enrollment=self.bob, assignment_task=grade.assignment_task, score=grade.score
+                )
+            Grade.objects.create(enrollment=self.carol, assignment_task=self.assignment_task, score=0.1)
+        self.check_leaderboard()
+        self.assertEqual(self.ranks(), {'alice': 1, 'bob': 1, 'carol': 3})
+
+    def test_ranks_are_refreshed_once_per_transaction(self):
+        with mock.patch.object(leaderboard, 'refresh_ranks', wraps=leaderboard.refresh_ranks) as refresh_ranks:
+            with self.captureOnCommitCallbacks(execute=True):
+                for assignment_task in AssignmentTask.objects.filter(course_class=self.course_class):
+                    Grade.objects.create(enrollment=self.bob, assignment_task=assignment_task, score=1)
+                Grade.objects.filter(enrollment=self.alice).delete()
+                self.assertEqual(refresh_ranks.call_count, 0)
+
+        self.assertEqual(refresh_ranks.call_count, 1)
+        self.check_leaderboard()
+        self.assertEqual(self.ranks(), {'alice': None, 'bob': 1, 'carol': None})
+
+
+class GradebookTest(TestCase):
+    def setUp(self):
+        self.course_class = create_course_class()
+        self.enrollment = create_student(self.course_class, 'bob')
+        add_assignments(self.course_class, self.enrollment, 2)
+        self.other_enrollment = create_student(self.course_class, 'alice')
+
+        user = User.objects.create(username='teacher')
+        instructor = Instructor.objects.create(user=user, full_name='Teacher')
+        ClassInstructor.objects.create(instructor=instructor, course_class=self.course_class)
+        self.client.force_login(user)
+        self.url = '/%s/%s/gradebook/' % (self.course_class.course.code, self.course_class.code)
+
+    def test_gradebook_json(self):
+        for grade in Grade.objects.filter(enrollment=self.enrollment, assignment_task__points=None):
+            grade.is_canceled = True
+            grade.save()
+        Grade.objects.create(
+            enrollment=self.other_enrollment,
+            assignment_task=AssignmentTask.objects.filter(points=10).first(),
+            score=1,
+        )
+
+        gradebook_data = self.client.get(self.url + 'json').json()
+
+        self.assertEqual(
+            [(task['assignment'], task['task']) for task in gradebook_data['assignment_tasks']],
+            [('Assignment 0', 'Task 0'), ('Assignment 0', 'Task 2'), ('Assignment 0', 'Task 1'),
+             ('Assignment 1', 'Task 0'), ('Assignment 1', 'Task 2'), ('Assignment 1', 'Task 1')]
+        )
+        self.assertEqual([student['full_name'] for student in gradebook_data['students']], ['alice', 'bob'])
+        self.assertEqual(gradebook_data['students'][0]['grades'], [10, None, None, None, None, None])
+        self.assertEqual(gradebook_data['students'][1]['grades'], [5, 0, None, 5, 0, None])
+        self.assertEqual(
+            [student['total'] for student in gradebook_data['students']],
+            [Enrollment.objects.get(pk=self.other_enrollment.pk).total_score(),
+             Enrollment.objects.get(pk=self.enrollment.pk).total_score()]
+        )
+        self.assertEqual(gradebook_data['averages'], [7.5, None, None, 5, None, None])
+
+    def test_gradebook_page(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'bob')
+        self.assertContains(response, '16 XP')
+
+        self.client.force_login(self.enrollment.student.user)
+        self.assertTemplateUsed(self.client.get(self.url), 'course/error_page.html')
+
+
+class GradeImportTest(TestCase):
+    def setUp(self):
+        self.course_class = create_course_class()
+        self.enrollment = create_student(self.course_class, 'alice')
+        self.enrollment.student.id_number = '123'
+        self.enrollment.student.save()
+        self.other_enrollment = create_student(self.course_class, 'bob')
+        add_assignments(self.course_class, self.enrollment, 1)
+
+    def import_grades(self, text, file_format=imports.CSV):
+        return imports.import_grades(self.course_class, io.StringIO(text), file_format)
+
+    def test_import_creates_and_updates_grades(self):
+        counts, errors = self.import_grades(
+            "student,assignment,task,score\n"
+            "123,Assignment 0,Task 0,1\n"
+            "123,Assignment 0,Task 2,3\n"
+            "BOB@example.com,assignment 0,task 0,0.25\n"
+            "bob@example.com,Assignment 0,Task 1,0.5\n"
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(counts, {'created': 2, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(Grade.objects.get(enrollment=self.enrollment, assignment_task__task__name='Task 0').score, 1)
+        self.assertEqual(leaderboard.verify(self.course_class), [])
+        self.assertEqual(Enrollment.objects.get(pk=self.other_enrollment.pk).total_score(), 7.5)
+
+    def test_invalid_lines_are_reported_and_nothing_is_saved(self):
+        counts, errors = self.import_grades(
+            '{"student": "123", "assignment": "Assignment 0", "task": "Task 0", "score": 0.8}\n'
+            '{"student": "carol", "assignment": "Assignment 0", "task": "Task 0", "score": 1}\n'
+            '{"student": "123", "assignment": "Assignment 0", "task": "Task 0", "score": 1.5}\n'
+            '{"student": "123", "assignment": "Assignment 0", "task": "Task 2", "score": 2.5}\n'
+            'not json\n',
+            imports.JSON_LINES
+        )
+
+        self.assertEqual([line_number for line_number, _ in errors], [2, 3, 4, 5])
+        self.assertEqual(Grade.objects.get(enrollment=self.enrollment, assignment_task__task__name='Task 0').score, 0.5)
+
+    def test_non_finite_scores_are_rejected(self):
+        counts, errors = self.import_grades(
+            "student,assignment,task,score\n"
+            "123,Assignment 0,Task 0,nan\n"
+            "123,Assignment 0,Task 2,inf\n"
+        )
+
+        self.assertEqual([line_number for line_number, _ in errors], [2, 3])
+        self.assertEqual(Grade.objects.get(enrollment=self.enrollment, assignment_task__task__name='Task 0').score, 0.5)
+
+    def test_empty_canceled_cell_keeps_the_existing_value(self):
+        Grade.objects.filter(enrollment=self.enrollment).update(is_canceled=True)
+
+        counts, errors = self.import_grades(
+            "student,assignment,task,score,canceled\n"
+            "123,Assignment 0,Task 0,1,\n"
+            "123,Assignment 0,Task 2,3,no\n"
+        )
+
+        self.assertEqual(errors, [])
+        grades = Grade.objects.filter(enrollment=self.enrollment)
+        self.assertTrue(grades.get(assignment_task__task__name='Task 0').is_canceled)
+        self.assertFalse(grades.get(assignment_task__task__name='Task 2').is_canceled)
+
+
+class RosterImportTest(TestCase):
+    def test_import_roster(self):
+        course_class = create_course_class()
+        enrolled = create_student(course_class, 'alice')
+        User.objects.create(username='bob', email='Bob@example.com')
+
+        with CaptureQueriesContext(connection) as queries:
+            counts, errors, invitations = imports.import_roster(course_class, io.StringIO(
+                "email,first_name,last_name,id_number\n"
+                "alice@example.com,Alice,A,1\n"
+                "bob@example.com,Bob,B,2\n"
+                "carol@example.com,Carol,C,3\n"
+                "dave@example.com,Dave,D,4\n"
+            ))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            counts, {'users_created': 2, 'students_created': 3, 'enrolled': 3, 'already_enrolled': 1}
+        )
+        self.assertEqual([user.email for user in invitations], ['carol@example.com', 'dave@example.com'])
+        self.assertFalse(User.objects.get(email='carol@example.com').has_usable_password())
+        self.assertEqual(Student.objects.get(user__username='bob').full_name, 'Bob B')
+        self.assertEqual(Enrollment.objects.filter(course_class=course_class).count(), 4)
+        self.assertLess(len(queries), 15)
+
+    def test_invalid_lines_are_reported_and_nothing_is_saved(self):
+        course_class = create_course_class()
+
+        counts, errors, invitations = imports.import_roster(course_class, io.StringIO(
+            "email,full_name\n"
+            "carol@example.com,Carol C\n"
+            "not an email,Dave D\n"
+            "CAROL@example.com,Carol C\n"
+        ))
+
+        self.assertEqual([line_number for line_number, _ in errors], [3, 4])
+        self.assertFalse(User.objects.filter(email='carol@example.com').exists())
+
+    def test_emails_longer_than_a_username_are_rejected(self):
+        course_class = create_course_class()
+        long_email = '%s@example.com' % ('a' * (150 - len('@example.com') + 1))
+
+        counts, errors, invitations = imports.import_roster(course_class, io.StringIO(
+            "email,full_name\n"
+            "%s,Long Name\n"
+            "%s,Almost Long\n" % (long_email, long_email[1:])
+        ))
+
+        self.assertEqual(errors, [(2, 'Email too long: %s' % long_email)])
+        self.assertFalse(User.objects.exists())
+
+        counts, errors, invitations = imports.import_roster(course_class, io.StringIO(
+            "email,full_name\n%s,Almost Long\n" % long_email[1:]
+        ))
+        self.assertEqual(errors, [])
+        self.assertEqual(User.objects.get().username, long_email[1:])
+
+
+# The password reset views are only routed when EMAIL_HOST is set
+urlpatterns = gamifiededucation_urls.urlpatterns + [re_path(r'', include('django.contrib.auth.urls'))]
+
+@override_settings(ROOT_URLCONF='course.tests')
+class InvitationTest(TestCase):
+    def setUp(self):
+        self.users = [User(username=name, email='%s@example.com' % name) for name in ('alice', 'bob', 'carol')]
+        for user in self.users:
+            user.set_unusable_password()
+            user.save()
+
+    def test_invite_action_queues_and_worker_sends(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+
+        self.client.post('/admin/auth/user/', {
+            'action': 'invite_user',
+            '_selected_action': [user.id for user in self.users],
+        })
+        self.assertEqual(Invitation.objects.filter(status=Invitation.PENDING).count(), 3)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(invitations.send_batch(), {'sent': 3, 'failed': 0})
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [user.email for user in self.users])
+        self.assertIn('/reset/', mail.outbox[0].alternatives[0][0])
+        self.assertEqual(Invitation.objects.filter(status=Invitation.SENT).count(), 3)
+        self.assertEqual(invitations.send_batch(), {'sent': 0, 'failed': 0})
+
+    @override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+        EMAIL_HOST='127.0.0.1', EMAIL_PORT=1, EMAIL_TIMEOUT=1,
+    )
+    def test_failed_invitations_are_retried_later(self):
+        invitations.enqueue(self.users[:1], 'example.com')
+
+        self.assertEqual(invitations.send_batch(), {'sent': 0, 'failed': 1})
+        invitation = Invitation.objects.get()
+        self.assertEqual((invitation.status, invitation.attempts), (Invitation.PENDING, 1))
+        self.assertGreater(invitation.next_attempt_datetime, invitation.created_datetime)
+        self.assertEqual(invitations.send_batch(), {'sent': 0, 'failed': 0})
+
+    def test_invitations_sent_before_a_crash_are_not_sent_again(self):
+        invitations.enqueue(self.users, 'example.com')
+        build_message = invitations.build_message
+        def crash_on_second_message(invitation):
+            if invitation.user.username == 'bob':
+                raise SystemExit()
+            return build_message(invitation)
+
+        with mock.patch.object(invitations, 'build_message', side_effect=crash_on_second_message):
+            with self.assertRaises(SystemExit):
+                invitations.send_batch()
+        self.assertEqual([message.to[0] for message in mail.outbox], ['alice@example.com'])
+        self.assertEqual(
+            dict(Invitation.objects.values_list('user__username', 'status')),
+            {'alice': Invitation.SENT, 'bob': Invitation.SENDING, 'carol': Invitation.SENDING}
+        )
+
+        # The rest of the batch is still claimed by the dead worker until its lease expires
+        self.assertEqual(invitations.send_batch(), {'sent': 0, 'failed': 0})
+        with override_settings(INVITATION_LEASE=-1):
+            self.assertEqual(invitations.send_batch(), {'sent': 2, 'failed': 0})
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ['alice@example.com', 'bob@example.com', 'carol@example.com']
+        )
+
+    def test_inactive_users_are_not_sent_invitations(self):
+        invitations.enqueue(self.users, 'example.com')
+        User.objects.filter(username='bob').update(is_active=False)
+
+        self.assertEqual(invitations.send_batch(), {'sent': 2, 'failed': 0})
+        self.assertEqual(Invitation.objects.get(user__username='bob').status, Invitation.PENDING)
+
+
+class CloneCourseClassTest(TestCase):
+    def structure(self, course_class):
+        def rows(queryset, *fields):
+            return list(queryset.order_by('id').values_list(*fields))
+
+        return [
+            rows(ClassInstructor.objects.filter(course_class=course_class), 'instructor_id'),
+            rows(AssignmentTask.objects.filter(course_class=course_class), 'assignment_id', 'task_id', 'points', 'is_optional'),
+            rows(Widget.objects.filter(course_class=course_class), 'title', 'markdown_text', 'order'),
+            rows(Post.objects.filter(course_class=course_class), 'title', 'markdown_text', 'html_code', 'post_datetime', 'is_pinned_to_the_top', 'is_draft'),
+            rows(ClassBadge.objects.filter(course_class=course_class), 'badge_id', 'description', 'show_progress', 'show_info_before_completion', 'aggregation_type_for_criteria'),
+            rows(
+                ClassBadgeCriteria.objects.filter(class_badge__course_class=course_class),
+                'class_badge__badge_id', 'assignment_id', 'task_id', 'goal', 'goal_type', 'accepts_partial_goal'
+            ),
+        ]
+
+    def test_clone_is_structurally_identical(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        add_assignments(course_class, enrollment, 3)
+        add_badges(course_class, enrollment, 3)
+        for class_badge in ClassBadge.objects.filter(course_class=course_class):
+            ClassBadgeCriteria.objects.create(class_badge=class_badge, assignment=Assignment.objects.first(), goal=0.5)
+            ClassBadgeCriteria.objects.create(class_badge=class_badge, task=Task.objects.first(), goal=10, goal_type=ClassBadgeCriteria.XP)
+        instructor = Instructor.objects.create(user=User.objects.create(username='teacher'), full_name='Teacher')
+        ClassInstructor.objects.create(instructor=instructor, course_class=course_class)
+        Widget.objects.create(course_class=course_class, title='Widget', markdown_text='*text*', order=1)
+        Post.objects.create(course_class=course_class, title='Post', markdown_text='text', html_code='<p>text</p>')
+        CourseClass.objects.create(course=create_course_class('C2').course, code='2024 (2)', start_date=course_class.start_date, end_date=course_class.end_date)
+
+        with CaptureQueriesContext(connection) as queries:
+            clone = clone_course_class(course_class)
+
+        self.assertEqual(clone.code, '2024 (3)')
+        self.assertEqual(clone_course_class(course_class).code, '2024 (4)')
+        self.assertEqual(self.structure(clone), self.structure(course_class))
+        self.assertFalse(Enrollment.objects.filter(course_class=clone).exists())
+        self.assertLess(len(queries), 20)
+
+    def test_clone_starts_without_achievements_and_with_its_own_cache(self):
+        course_class = create_course_class()
+        CourseClass.objects.filter(pk=course_class.pk).update(
+            achievements_refreshed_datetime=timezone.now(), cache_generation=123
+        )
+        Widget.objects.create(course_class=course_class, title='Widget', markdown_text='*cloned*', order=1)
+        cache.clear()
+
+        with mock.patch('course.models.markdown2.markdown', wraps=markdown2.markdown) as markdown:
+            clone = CourseClass.objects.get(pk=clone_course_class(course_class).pk)
+            self.assertEqual(markdown.call_count, 1)
+
+        self.assertEqual(clone.achievements_refreshed_datetime, None)
+        self.assertNotEqual(clone.cache_generation, 123)
+
+
+class JobTest(TestCase):
+    def test_refresh_achievements_action_runs_in_background(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        add_assignments(course_class, enrollment, 1)
+        add_badges(course_class, enrollment, 1)
+        ClassBadgeCriteria.objects.create(class_badge=ClassBadge.objects.get(), assignment=Assignment.objects.get(), goal=1)
+        Achievement.objects.update(percentage=0)
+
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        self.client.post('/admin/course/courseclass/', {
+            'action': 'refresh_achievements',
+            '_selected_action': [course_class.id],
+        })
+
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(Achievement.objects.get().percentage, 0)
+
+        self.assertEqual(jobs.run_next_job(), job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.classes_done, job.rows_updated), (Job.DONE, 1, 1))
+        self.assertEqual(Achievement.objects.get().percentage, 0.8)
+        self.assertNotEqual(CourseClass.objects.get(pk=course_class.id).achievements_refreshed_datetime, None)
+        self.assertEqual(jobs.run_next_job(), None)
+        self.assertContains(self.client.get('/admin/course/job/'), '1 of 1 classes')
+
+    def test_job_of_a_dead_worker_is_resumed_after_its_lease(self):
+        course_classes = [create_course_class('C1'), create_course_class('C2')]
+        job = jobs.enqueue(Job.REFRESH_ACHIEVEMENTS, course_classes)
+
+        refresh_class = achievements.refresh_class
+        def die_on_second_class(course_class):
+            if course_class.id == course_classes[1].id:
+                raise SystemExit()
+            return refresh_class(course_class)
+
+        with mock.patch.object(achievements, 'refresh_class', side_effect=die_on_second_class):
+            with self.assertRaises(SystemExit):
+                jobs.run_next_job()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.classes_done), (Job.RUNNING, 1))
+
+        # Still leased to the dead worker
+        self.assertEqual(jobs.run_next_job(), None)
+
+        with override_settings(JOB_LEASE=-1), \
+            mock.patch.object(achievements, 'refresh_class', wraps=refresh_class) as resumed_refresh_class:
+            self.assertEqual(jobs.run_next_job(), job)
+        self.assertEqual([call.args[0].id for call in resumed_refresh_class.call_args_list], [course_classes[1].id])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.classes_done), (Job.DONE, 2))
+        self.assertIn('Restarted after 1 classes', job.log)
+
+
+class AdminChangelistTest(TestCase):
+    def count_changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        urls = ['/admin/course/enrollment/', '/admin/course/enrollment/?o=2.6', '/admin/course/student/']
+
+        for i in range(2):
+            create_student(create_course_class('A%d' % i), 'student%d' % i)
+        few_rows_queries = [self.count_changelist_queries(url) for url in urls]
+
+        for i in range(10):
+            create_student(create_course_class('B%d' % i), 'other%d' % i)
+        many_rows_queries = [self.count_changelist_queries(url) for url in urls]
+
+        self.assertEqual(few_rows_queries, many_rows_queries)
+
+
+class ExportTest(TestCase):
+    def test_csv_export(self):
+        course_class = create_course_class()
+        with self.captureOnCommitCallbacks(execute=True):
+            enrollment = create_student(course_class, 'bob')
+            add_assignments(course_class, enrollment, 1)
+        add_badges(course_class, enrollment, 1)
+        create_student(course_class, 'alice')
+
+        lines = list(exports.csv_lines(course_class, chunk_size=1))
+        rows = list(csv.reader(lines))
+
+        self.assertEqual(
+            rows[0],
+            ['Student', 'Id number', 'Email', 'Assignment 0 – Task 0', 'Assignment 0 – Task 2', 'Assignment 0 – Task 1',
+             'Total XP', 'Lost lives', 'Badge 0 (%)', 'Rank']
+        )
+        self.assertEqual(rows[1], ['alice', '', 'alice@example.com', '', '', '', '0', '0', '0', ''])
+        self.assertEqual(rows[2], ['bob', '', 'bob@example.com', '5', '3', '', '8', '0', '50', '1'])
+
+    def test_export_endpoint_is_for_instructors(self):
+        course_class = create_course_class()
+        enrollment = create_student(course_class, 'alice')
+        url = '/%s/%s/gradebook/csv' % (course_class.course.code, course_class.code)
+
+        self.client.force_login(enrollment.student.user)
+        self.assertTemplateUsed(self.client.get(url), 'course/error_page.html')
+
+        user = User.objects.create(username='teacher')
+        instructor = Instructor.objects.create(user=user, full_name='Teacher')
+        ClassInstructor.objects.create(instructor=instructor, course_class=course_class)
+        self.client.force_login(user)
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertIn('alice@example.com', b''.join(response.streaming_content).decode())
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.course_class = create_course_class()
+        self.enrollment = create_student(self.course_class, 'alice')
+        add_assignments(self.course_class, self.enrollment, 1)
+        self.client.force_login(self.enrollment.student.user)
+        self.url = '/%s/%s/assignments/' % (self.course_class.course.code, self.course_class.code)
+        instrumentation.aggregate.clear()
+
+    def test_requests_are_logged_and_aggregated(self):
+        with self.assertLogs('course.instrumentation', 'INFO') as logs:
+            self.client.get(self.url)
+            self.client.get(self.url)
+
+        first_sample = json.loads(logs.records[0].getMessage())
+        self.assertEqual(first_sample['view'], 'course:assignments')
+        self.assertGreater(first_sample['queries'], 0)
+        self.assertGreater(first_sample['cache_misses'], 0)
+
+        summary = instrumentation.summary()['course:assignments']
+        self.assertEqual(summary['requests'], 2)
+        self.assertEqual(summary['queries']['max'], first_sample['queries'])
+        self.assertGreater(summary['cache_hits']['max'], 0)
+
+    def test_view_over_budget(self):
+        with override_settings(VIEW_BUDGETS={'course:assignments': {'queries': 1}}):
+            with self.assertRaises(instrumentation.BudgetExceeded):
+                self.client.get(self.url)
+
+            with override_settings(VIEW_BUDGETS_RAISE=False):
+                with self.assertLogs('course.instrumentation', 'WARNING') as logs:
+                    self.client.get(self.url)
+        self.assertIn('course:assignments over budget', logs.output[0])
+
+    def test_wall_time_over_budget_is_only_logged(self):
+        self.assertTrue(settings.VIEW_BUDGETS_RAISE)
+        with override_settings(VIEW_BUDGETS={'course:assignments': {'wall_ms': 0}}):
+            with self.assertLogs('course.instrumentation', 'WARNING') as logs:
+                self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertIn('ms (budget 0 ms)', logs.output[0])
+
+    def test_metrics_endpoint(self):
+        self.client.get(self.url)
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'gamified_request_duration_seconds_count{view="course:assignments"}')
+        self.assertContains(response, 'gamified_cache_lookups_total{cache="class",result="miss"}')
+
+        client = Client()
+        self.assertEqual(client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(client.get('/metrics').status_code, 401)
+            self.assertEqual(client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            self.assertEqual(client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class SyntheticDataTest(TestCase):
+    def generate(self, prefix, seed, **options):
+        call_command(
+            'generatedata', prefix=prefix, seed=seed, classes=2, students=5, assignments=3, badges=2,
+            achievements=True, stdout=io.StringIO(), **options
+        )
+        course_classes = CourseClass.objects.filter(course__code__startswith='%s-' % prefix).order_by('id')
+        # Everything but the names, which start with the prefix
+        return {
+            'grades': list(Grade.objects.filter(
+                enrollment__course_class__in=course_classes
+            ).order_by('id').values_list(
+                'assignment_task__assignment__name', 'assignment_task__task__name', 'score', 'is_canceled'
+            )),
+            'classes': list(course_classes.values_list('start_date', 'end_date')),
+            'posts': list(Post.objects.filter(course_class__in=course_classes).order_by('id').values_list('post_datetime')),
+            'widgets': list(Widget.objects.filter(course_class__in=course_classes).order_by('id').values_list('markdown_text')),
+            'users': list(User.objects.filter(username__startswith='%s-' % prefix).order_by('id').values_list('date_joined')),
+            'students': list(Student.objects.filter(
+                enrollment__course_class__in=course_classes
+            ).order_by('id').values_list('id_number')),
+        }
+
+    def test_same_seed_gives_same_data(self):
+        first_data = self.generate('first', seed=1)
+        second_data = self.generate('second', seed=1)
+
+        self.assertGreater(len(first_data['grades']), 0)
+        self.assertGreater(len(first_data['posts']), 0)
+        self.assertEqual(first_data, second_data)
+        self.assertNotEqual(first_data['grades'], self.generate('third', seed=2)['grades'])
+        self.assertTrue(all(score >= 0 for _, _, score, _ in first_data['grades']))
+
+        for course_class in CourseClass.objects.all():
+            self.assertEqual(leaderboard.find_drift(course_class), [])
+            self.assertTrue(course_class.enrollment_set.filter(rank=1).exists())
+
+    def test_dates_follow_the_base_date(self):
+        data = self.generate('later', seed=1, base_date='2030-06-01')
+        for start_date, end_date in data['classes']:
+            self.assertLess(start_date, datetime.date(2030, 6, 1))
+            self.assertGreater(end_date, datetime.date(2030, 6, 1))
+        self.assertTrue(all(post_datetime.year == 2030 for post_datetime, in data['posts']))
+
+
+class AchievementEngineTest(TestCase):
+    def check_same_percentages(self, course_class):
+        percentages = achievements.compute_percentages(course_class)
+        self.assertGreater(len(percentages), 0)
+        self.assertEqual(percentages, reference_percentages(course_class))
+        return percentages
+
+    def test_engine_matches_per_row_computation(self):
+        for seed in (1, 2):
+            course_class = create_synthetic_class(random.Random(seed), 8, 4, 3, 4)
+            self.check_same_percentages(course_class)
+
+    def test_all_optional_assignment_and_goal_zero(self):
+        course_class = create_synthetic_class(random.Random(3), 6, 3, 3, 2)
+        assignment = Assignment.objects.filter(course=course_class.course).order_by('id').first()
+        task = Task.objects.filter(course=course_class.course).order_by('id').first()
+        AssignmentTask.objects.filter(course_class=course_class, assignment=assignment).update(is_optional=True)
+        self.assertEqual(assignment.points(course_class), None)
+
+        class_badge = ClassBadge.objects.filter(course_class=course_class).order_by('id').first()
+        ClassBadgeCriteria.objects.create(
+            class_badge=class_badge, assignment=assignment, goal_type=ClassBadgeCriteria.PERCENTAGE, goal=0.5
+        )
+        ClassBadgeCriteria.objects.create(
+            class_badge=class_badge, task=task, goal_type=ClassBadgeCriteria.XP, goal=0, accepts_partial_goal=False
+        )
+        # A badge whose only criterion can't be evaluated has no percentages
+        optional_badge = ClassBadge.objects.create(
+            badge=Badge.objects.create(course=course_class.course, name='Optional'), course_class=course_class
+        )
+        ClassBadgeCriteria.objects.create(
+            class_badge=optional_badge, assignment=assignment, goal_type=ClassBadgeCriteria.PERCENTAGE, goal=1
+        )
+
+        percentages = self.check_same_percentages(course_class)
+        self.assertNotIn(optional_badge.id, {class_badge_id for _, class_badge_id in percentages})
+
+    def test_saving_the_same_percentages_again_writes_nothing(self):
+        course_class = create_synthetic_class(random.Random(5), 6, 3, 3, 3)
+        percentages = achievements.compute_percentages(course_class)
+
+        counts = achievements.save_percentages(percentages)
+        self.assertEqual(counts, {'inserted': len(percentages), 'updated': 0, 'unchanged': 0})
+
+        with CaptureQueriesContext(connection) as queries:
+            counts = achievements.save_percentages(percentages)
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'unchanged': len(percentages)})
+        self.assertEqual([query['sql'] for query in queries if not query['sql'].startswith('SELECT')], [])
+
+    def test_incremental_refresh_matches_refresh_class(self):
+        course_class = create_synthetic_class(random.Random(4), 8, 4, 3, 4)
+        achievements.refresh_class(course_class)
+        enrollments = list(Enrollment.objects.filter(course_class=course_class).order_by('id'))
+        assignment_tasks = list(AssignmentTask.objects.filter(course_class=course_class).order_by('id'))
+        saved_before = set(Achievement.objects.values_list('enrollment_id', 'class_badge_id', 'percentage'))
+
+        with mock.patch.object(achievements, 'compute_percentages', wraps=achievements.compute_percentages) as compute:
+            with self.captureOnCommitCallbacks(execute=True):
+                Grade.objects.filter(enrollment=enrollments[0]).delete()
+                for grade in Grade.objects.filter(enrollment=enrollments[1]).select_related('assignment_task'):
+                    grade.score = 1 if grade.assignment_task.points != None else 10
+                    grade.save()
+                graded_ids = set(Grade.objects.filter(enrollment=enrollments[2]).values_list('assignment_task_id', flat=True))
+                for assignment_task in assignment_tasks:
+                    if assignment_task.id not in graded_ids:
+                        Grade.objects.create(enrollment=enrollments[2], assignment_task=assignment_task, score=1)
+                grade = Grade.objects.filter(enrollment=enrollments[3]).first()
+                grade.enrollment = enrollments[0]
+                grade.save()
+
+                assignment_tasks[0].points = 100
+                assignment_tasks[0].save()
+                assignment_tasks[1].is_optional = not assignment_tasks[1].is_optional
+                assignment_tasks[1].save()
+                assignment_tasks[2].delete()
+                AssignmentTask.objects.create(
+                    assignment=assignment_tasks[0].assignment, course_class=course_class, points=50,
+                    task=Task.objects.create(course=course_class.course, name='New task'),
+                )
+                self.assertEqual(compute.call_count, 0)
+        self.assertEqual(compute.call_count, 1)
+
+        self.assertNotEqual(set(Achievement.objects.values_list('enrollment_id', 'class_badge_id', 'percentage')), saved_before)
+        counts = achievements.refresh_class(course_class)
+        self.assertEqual(counts['inserted'] + counts['updated'], 0)
+
+        # Grades moved to another assignment task (e.g. in the admin) change
+        # the achievements that read the old one too
+        with self.captureOnCommitCallbacks(execute=True):
+            for enrollment in enrollments[4:]:
+                graded_ids = set(Grade.objects.filter(enrollment=enrollment).values_list('assignment_task_id', flat=True))
+                ungraded = [assignment_task for assignment_task in AssignmentTask.objects.filter(
+                    course_class=course_class
+                ).order_by('id') if assignment_task.id not in graded_ids]
+                grade = Grade.objects.filter(enrollment=enrollment).order_by('id').first()
+                if grade != None and len(ungraded) > 0:
+                    grade.assignment_task = ungraded[-1]
+                    grade.save()
+        counts = achievements.refresh_class(course_class)
+        self.assertEqual(counts['inserted'] + counts['updated'], 0)
+
+
+class RefreshAchievementsCommandTest(TestCase):
+    def setUp(self):
+        self.course_class = create_course_class()
+        enrollment = create_student(self.course_class, 'alice')
+        # Without running the on-commit callbacks, so the achievements are left out of date
+        add_assignments(self.course_class, enrollment, 1)
+        class_badge = ClassBadge.objects.create(
+            badge=Badge.objects.create(course=self.course_class.course, name='Badge 0'), course_class=self.course_class
+        )
+        ClassBadgeCriteria.objects.create(
+            class_badge=class_badge,
+            assignment=Assignment.objects.get(course=self.course_class.course),
+            task=Task.objects.get(course=self.course_class.course, name='Task 0'),
+            goal_type=ClassBadgeCriteria.PERCENTAGE, goal=1,
+        )
+
+    def refresh(self, **options):
+        output = io.StringIO()
+        call_command('refreshachievements', course=self.course_class.course.code, stdout=output, **options)
+        return output.getvalue()
+
+    def test_dry_run_prints_changes_without_saving(self):
+        with CaptureQueriesContext(connection) as queries:
+            output = self.refresh(dry_run=True, since='2000-01-01')
+
+        self.assertIn('1 achievements would change', output)
+        self.assertIn('alice – Badge 0: (none) -> 50.0%', output)
+        self.assertFalse(Achievement.objects.exists())
+        self.assertEqual(
+            [query['sql'] for query in queries if not query['sql'].startswith('SELECT')], []
+        )
+
+    def test_since_skips_classes_without_newer_grades(self):
+        self.assertEqual(self.refresh(since='2999-01-01'), '')
+        self.assertIn('1 inserted', self.refresh(since='2000-01-01'))
+        self.assertEqual(Achievement.objects.get().percentage, 0.5)
+
+
+class BenchmarkTest(TestCase):
+    def test_suite_and_comparison(self):
+        sizes = {'tiny': {'students': 3, 'assignments': 2, 'tasks': 2, 'badges': 1}}
+        results = benchmarks.run_suite(['tiny'], rounds=1, sizes=sizes)
+
+        names = [result['name'] for result in results['benchmarks']]
+        self.assertIn('assignments (instructor)', names)
+        self.assertIn('refresh_achievements', names)
+        for result in results['benchmarks']:
+            self.assertGreater(result['queries'], 0)
+            self.assertGreater(result['peak_memory'], 0)
+        # Nothing is saved
+        self.assertFalse(Course.objects.exists())
+
+        new_results = json.loads(json.dumps(results))
+        new_results['benchmarks'][0]['queries'] += 1
+        regressions = [row for row in benchmarks.compare(results, new_results) if row['is_regression']]
+        self.assertEqual(
+            [(row['name'], row['measure']) for row in regressions],
+            [(results['benchmarks'][0]['name'], 'queries')]
+        )
+
+
+class QueryScalingTest(TestCase):
+    """
+    Each page and the achievement refresh must make the same number of queries
+    for a small and a bigger class, below an explicit bound, so an N+1 query
+    fails here.
+    """
+    SIZES = [
+        {'students': 3, 'assignments': 2, 'tasks': 2, 'badges': 1},
+        {'students': 15, 'assignments': 6, 'tasks': 4, 'badges': 4},
+    ]
+
+    MAX_QUERIES = {
+        'student classes': 3,
+        'student home': 6,
+        'student assignments': 7,
+        'instructor classes': 3,
+        'instructor home': 7,
+        'instructor assignments': 10,
+        'instructor gradebook': 9,
+        'instructor gradebook json': 9,
+        'instructor gradebook csv': 9,
+        'admin enrollments': 6,
+        'admin students': 6,
+        'admin assignment tasks': 6,
+        'admin classes': 5,
+        'admin class change': 6,
+        'refresh_class': 6,
+        'refreshachievements command': 8,
+    }
+
+    def count_queries(self, function):
+        cache.clear()
+        # Both sizes start without cached content types, or only the first run would load them
+        ContentType.objects.clear_cache()
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        return len(queries)
+
+    def get_page(self, client, url):
+        response = client.get(url)
+        # The classes page redirects to the class when there is only one
+        self.assertIn(response.status_code, (200, 302), url)
+        if response.streaming:
+            b''.join(response.streaming_content)
+
+    def count_all_queries(self, index, size):
+        rng = random.Random(index)
+        course, assignments, tasks, badges = synthetic.create_course(
+            'scaling-%d' % index, size['assignments'], size['tasks'], size['badges']
+        )
+        course_class, _ = synthetic.create_class(
+            rng, course, assignments, tasks, badges, 'C', size['students'], number_of_posts=2, number_of_widgets=2
+        )
+        leaderboard.rebuild(course_class)
+        achievements.refresh_class(course_class)
+
+        enrollment = Enrollment.objects.filter(course_class=course_class).select_related('student__user').first()
+        instructor_user = ClassInstructor.objects.get(course_class=course_class).instructor.user
+        admin_user = User.objects.create_superuser('admin-%d' % index, '', None)
+        class_url = '/%s/%s' % (course.code, course_class.code)
+
+        student_client = Client()
+        student_client.force_login(enrollment.student.user)
+        instructor_client = Client()
+        instructor_client.force_login(instructor_user)
+        admin_client = Client()
+        admin_client.force_login(admin_user)
+
+        pages = {
+            'student classes': (student_client, '/classes/'),
+            'student home': (student_client, class_url + '/'),
+            'student assignments': (student_client, class_url + '/assignments/'),
+            'instructor classes': (instructor_client, '/classes/'),
+            'instructor home': (instructor_client, class_url + '/'),
+            'instructor assignments': (instructor_client, '%s/assignments/%d' % (class_url, enrollment.student_id)),
+            'instructor gradebook': (instructor_client, class_url + '/gradebook'),
+            'instructor gradebook json': (instructor_client, class_url + '/gradebook/json'),
+            'instructor gradebook csv': (instructor_client, class_url + '/gradebook/csv'),
+            'admin enrollments': (admin_client, '/admin/course/enrollment/'),
+            'admin students': (admin_client, '/admin/course/student/'),
+            'admin assignment tasks': (admin_client, '/admin/course/assignmenttask/'),
+            'admin classes': (admin_client, '/admin/course/courseclass/'),
+            'admin class change': (admin_client, '/admin/course/courseclass/%d/change/' % course_class.id),
+        }
+        query_counts = {
+            name: self.count_queries(lambda: self.get_page(client, url))
+            for name, (client, url) in pages.items()
+        }
+        query_counts['refresh_class'] = self.count_queries(lambda: achievements.refresh_class(course_class))
+        query_counts['refreshachievements command'] = self.count_queries(lambda: call_command(
+            'refreshachievements', course=course.code, stdout=io.StringIO()
+        ))
+        return query_counts
+
+    def test_query_counts_do_not_grow_with_the_class(self):
+        small_counts, big_counts = [self.count_all_queries(index, size) for index, size in enumerate(self.SIZES)]
+
+        for name, max_queries in self.MAX_QUERIES.items():
+            self.assertEqual(small_counts[name], big_counts[name], name)
+            self.assertLessEqual(big_counts[name], max_queries, name)
@@ -6,7 +6,11 @@ from . import views
 app_name = 'course'
 urlpatterns = [
     re_path(r'^classes/?$', views.classes, name='classes'),
+    re_path(r'^metrics/?$', views.metrics_page, name='metrics'),
     re_path(r'^([^/]+)/([^/]+)/?$', views.home, name='home'),
     re_path(r'^([^/]+)/([^/]+)/assignments/?([\d]+)?/?$', views.assignments, name='assignments'),
+    re_path(r'^([^/]+)/([^/]+)/gradebook/?$', views.gradebook_page, name='gradebook'),
+    re_path(r'^([^/]+)/([^/]+)/gradebook/json/?$', views.gradebook_json, name='gradebook_json'),
+    re_path(r'^([^/]+)/([^/]+)/gradebook/csv/?$', views.gradebook_csv, name='gradebook_csv'),
     re_path(r'^$', views.index, name='index'),
 ]
\ No newline at end of file
@@ -1,19 +1,25 @@
 import datetime
+import hashlib
 from functools import reduce
 from django.contrib.auth.views import LoginView
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.db.models import Sum, Case, When, F, Q, IntegerField, ExpressionWrapper
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import Http404
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import gettext_lazy as _
-from rank import DenseRank, UpperRank, Rank
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from django.utils.text import slugify
 
 from django.utils.timezone import get_default_timezone
 
 from .models import *
+from . import leaderboard, caching, gradebook, exports, metrics
+from .instrumentation import record_cache
 
 
 def error400_page(request, exception):
@@ -37,6 +43,17 @@ def error500_page(request):
 
 def index(request):
     return redirect('/login/')
+
+
+def metrics_page(request):
+    # Prometheus scrapes it without a session, so it uses the token (when one is set);
+    # staff users can also read it in the browser
+    has_token = settings.METRICS_TOKEN != '' and \
+        request.headers.get('Authorization') == 'Bearer %s' % settings.METRICS_TOKEN
+    if not has_token and not request.user.is_staff:
+        return HttpResponse(status=401)
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
     
     
 def login(request, **kwargs):
@@ -51,72 +68,67 @@ def login(request, **kwargs):
 
 @login_required(login_url='/login/')
 def classes(request):
-    today = datetime.date.today()
-    if hasattr(request.user, 'student'):
-        student = request.user.student
-        all_classes = CourseClass.objects.filter(
-            enrollment__student=student
-        )
-    elif hasattr(request.user, 'instructor'):
-        instructor = request.user.instructor
-        all_classes = CourseClass.objects.filter(
-            classinstructor__instructor=instructor
-        )
-    else:
-        all_classes = CourseClass.objects.none()
+    # A single query, with the course joined, for the classes of the student or instructor.
+    # Subqueries instead of joins, so there are no duplicated rows to remove with DISTINCT
+    all_classes = list(CourseClass.objects.filter(
+        Q(id__in=Enrollment.objects.filter(student__user_id=request.user.id).values('course_class_id')) |
+        Q(id__in=ClassInstructor.objects.filter(instructor__user_id=request.user.id).values('course_class_id'))
+    ).select_related('course'))
     
     if len(all_classes) == 1 and not request.user.is_staff:
         course_class = all_classes[0]
         return redirect('/%s/%s/' %(course_class.course.code, course_class.code))
     else:
+        past_classes, current_classes, future_classes = partition_classes(all_classes)
         return render(
             request,
             'course/classes.html',
             {
-                'past_classes': filter_past_classes(all_classes),
-                'current_classes': filter_current_classes(all_classes),
-                'future_classes': filter_future_classes(all_classes),
+                'past_classes': past_classes,
+                'current_classes': current_classes,
+                'future_classes': future_classes,
             }
         )
 
 
 @login_required(login_url='/login/')
 def home(request, course_code, class_code):
-    try:
-        enrollment = get_enrollment(request.user.id, course_code, class_code)
-        course_class = enrollment.course_class
-        student_id = enrollment.student_id
-    except ObjectDoesNotExist:
-        try:
-            class_instructor = get_class_instructor(request, course_code, class_code)
-            course_class = class_instructor.course_class
-            student_id = None
-        except ObjectDoesNotExist:
-            raise Http404("Student/instructor not found")
+    role, membership = resolve_membership(request.user, course_code, class_code)
+    course_class = membership.course_class
+    student_id = membership.student_id if role == STUDENT else None
     
-    ranking = get_ranking_data(course_class, course_class.ranking_size)
+    ranking = caching.get_or_compute(
+        course_class, 'ranking',
+        lambda: get_ranking_data(course_class, course_class.ranking_size)
+    )
 
-    posts = Post.objects.filter(
-        course_class=course_class
-    ).order_by(
-        '-is_pinned_to_the_top', '-post_datetime'
+    posts = caching.get_or_compute(
+        course_class, 'posts',
+        lambda: list(Post.objects.filter(
+            course_class=course_class
+        ).order_by(
+            '-is_pinned_to_the_top', '-post_datetime'
+        ))
     )
 
-    widgets = Widget.objects.filter(
-        course_class=course_class
-    ).order_by('order')
+    widgets = caching.get_or_compute(
+        course_class, 'widgets',
+        lambda: list(Widget.objects.filter(
+            course_class=course_class
+        ).order_by('order'))
+    )
     
-    if hasattr(request.user, 'student'):
-        posts = posts.filter(
-            post_datetime__lte=datetime.datetime.now(),
-            is_draft=False,
-        )
+    if role == STUDENT:
+        # Filtered here, so scheduled posts show up on time even if the list is cached
+        now = timezone.now()
+        posts = [post for post in posts if post.post_datetime <= now and not post.is_draft]
     
     return render(
         request,
         'course/class.html',
         {
             'active_tab': 'home',
+            'role': role,
             'course_class': course_class,
             'ranking_size': course_class.ranking_size,
             'ranking': ranking,
@@ -129,95 +141,183 @@ def home(request, course_code, class_code):
 
 @login_required(login_url='/login/')
 def assignments (request, course_code, class_code, student_id=None):
-    try:
-        enrollment = get_enrollment(request.user.id, course_code, class_code)
-        course_class = enrollment.course_class
+    role, membership = resolve_membership(request.user, course_code, class_code)
+    course_class = membership.course_class
+    if role == STUDENT:
+        enrollment = membership
         students_data = None
-    except ObjectDoesNotExist:
-        try:
-            class_instructor = get_class_instructor(request, course_code, class_code)
-            course_class = class_instructor.course_class
-            students_data = get_students_data(course_class)
-            try:
-                enrollment = Enrollment.objects.get(student_id=student_id, course_class=course_class)
-            except ObjectDoesNotExist:
-                enrollment = None
-                
-        except ObjectDoesNotExist:
-            raise Http404("Student/instructor not found")
+    else:
+        students_data = caching.get_or_compute(
+            course_class, 'students',
+            lambda: list(get_students_data(course_class))
+        )
+        enrollment = Enrollment.objects.select_related('student').filter(
+            student_id=student_id, course_class=course_class
+        ).first()
+        if enrollment != None:
+            enrollment.course_class = course_class
+
+    if enrollment != None:
+        assignment_items_data = caching.get_or_compute(
+            course_class, 'assignments:%d' % enrollment.id,
+            lambda: get_assignments_data(enrollment)
+        )
+        achievements_data = caching.get_or_compute(
+            course_class, 'achievements:%d' % enrollment.id,
+            lambda: get_achievements_data(enrollment)
+        )
+    else:
+        assignment_items_data = None
+        achievements_data = None
     
     return render(
         request,
         'course/assignments.html',
         {
             'active_tab': 'assignments',
+            'role': role,
             'course_class': course_class,
             'enrollment': enrollment,
-            'assignment_items_data': get_assignments_data(enrollment),
-            'achievements_data': get_achievements_data(enrollment),
+            'assignment_items_data': assignment_items_data,
+            'achievements_data': achievements_data,
             'students_data': students_data,
             'student_id': student_id
         }
     )
 
 
-def get_enrollment(student_user_id, course_code, class_code):
-    student = Student.objects.get(user_id=student_user_id)
-    course = Course.objects.get(code=course_code)
-    course_class = CourseClass.objects.get(course=course, code=class_code)
-    enrollment = Enrollment.objects.get(student=student, course_class=course_class)
+@login_required(login_url='/login/')
+def gradebook_page(request, course_code, class_code):
+    course_class = get_instructor_class(request.user, course_code, class_code)
+    gradebook_data = caching.get_or_compute(
+        course_class, 'gradebook',
+        lambda: gradebook.get_gradebook_data(course_class)
+    )
 
-    return enrollment
-    
-def get_class_instructor(request, course_code, class_code):
-    instructor = Instructor.objects.get(user_id=request.user.id)
-    course = Course.objects.get(code=course_code)
-    course_class = CourseClass.objects.get(course=course, code=class_code)
-    class_instructor = ClassInstructor.objects.get(instructor=instructor, course_class=course_class)
-
-    return class_instructor
-
-def filter_past_classes(query):
-    return query.filter(
-        end_date__lt=datetime.date.today()
-    ).order_by('-end_date', 'course__name', 'code').all()
-
-def filter_current_classes(query):
-    return query.filter(
-        start_date__lte=datetime.date.today(),
-        end_date__gte=datetime.date.today()
-    ).order_by('start_date', 'course__name', 'code').all()
-
-def filter_future_classes(query):
-    return query.filter(
-        start_date__gt=datetime.date.today()
-    ).order_by('start_date', 'course__name', 'code').all()
-    
-def get_ranking_data(course_class, ranking_size):
-    ranking = Grade.objects.values(
-        'enrollment__student__id'
-    ).annotate(
-        total = Sum(
-            Case(
-                When(is_canceled=True, then=0),
-                When(assignment_task__points=None, then=F('score')),
-                default=F('score') * F('assignment_task__points'),
-                output_field=IntegerField()
-            )
-        ),
-        full_name = F('enrollment__student__full_name'),
-        student_id = F('enrollment__student__id'),
-    ).annotate( 
-        # this "dense_rank" was throwing an error sometimes, randomly
-        # it was not finding the previous "total" annotation
-        # so I put it in another "annotate" to respect the dependency
-        dense_rank = Rank('total'),
+    return render(
+        request,
+        'course/gradebook.html',
+        {
+            'active_tab': 'gradebook',
+            'role': INSTRUCTOR,
+            'course_class': course_class,
+            'gradebook_data': gradebook_data,
+            # The cells are joined here: rendering them one by one in the template
+            # is the slowest part of the page for big classes (they are only numbers)
+            'rows': [
+                (student_data, mark_safe(''.join(
+                    '<td></td>' if grade_points == None else '<td>%d</td>' % grade_points
+                    for grade_points in student_data['grades']
+                )))
+                for student_data in gradebook_data['students']
+            ],
+        }
+    )
+
+@login_required(login_url='/login/')
+def gradebook_json(request, course_code, class_code):
+    course_class = get_instructor_class(request.user, course_code, class_code)
+    gradebook_data = caching.get_or_compute(
+        course_class, 'gradebook',
+        lambda: gradebook.get_gradebook_data(course_class)
+    )
+    return JsonResponse(gradebook_data)
+
+@login_required(login_url='/login/')
+def gradebook_csv(request, course_code, class_code):
+    course_class = get_instructor_class(request.user, course_code, class_code)
+    # Streamed, so big classes don't have to fit in memory
+    response = StreamingHttpResponse(exports.csv_lines(course_class), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s-%s.csv"' % (
+        slugify(course_class.course.code), slugify(course_class.code)
+    )
+    return response
+
+
+STUDENT = 'student'
+INSTRUCTOR = 'instructor'
+
+def resolve_membership(user, course_code, class_code):
+    """
+    Finds how the user takes part in a class: returns (STUDENT, enrollment) or
+    (INSTRUCTOR, class_instructor), with course_class and course already loaded.
+    Each role is resolved with a single joined query, and the result is cached
+    for a few minutes (and until the class changes), so navigating inside a
+    class only queries the generation of the class. Raises Http404 if there is
+    none.
+    """
+    cache_key = 'membership:%d:%s' % (
+        user.id, hashlib.sha1(('%s/%s' % (course_code, class_code)).encode('utf-8')).hexdigest()
+    )
+    cached = cache.get(cache_key)
+    if cached != None:
+        role, membership = cached
+        if membership.course_class.cache_generation == caching.class_generation(membership.course_class_id):
+            record_cache('membership', True)
+            return role, membership
+    record_cache('membership', False)
+
+    role = STUDENT
+    membership = Enrollment.objects.select_related(
+        'student', 'course_class__course'
     ).filter(
-        enrollment__course_class = course_class
-    ).order_by('-total', 'full_name')[:ranking_size]
-    # print(ranking.query)
+        student__user_id=user.id,
+        course_class__code=class_code,
+        course_class__course__code=course_code,
+    ).first()
+
+    if membership == None:
+        role = INSTRUCTOR
+        membership = ClassInstructor.objects.select_related(
+            'instructor', 'course_class__course'
+        ).filter(
+            instructor__user_id=user.id,
+            course_class__code=class_code,
+            course_class__course__code=course_code,
+        ).first()
+
+    if membership == None:
+        raise Http404("Student/instructor not found")
+
+    # course_class.cache_generation was loaded with the membership, so it is
+    # also the generation of the cached class data used by the views
+    cache.set(cache_key, (role, membership), settings.MEMBERSHIP_CACHE_TIMEOUT)
+
+    return role, membership
+
+def get_instructor_class(user, course_code, class_code):
+    """
+    Returns the class if the user is one of its instructors, or raises Http404.
+    """
+    role, membership = resolve_membership(user, course_code, class_code)
+    if role != INSTRUCTOR:
+        raise Http404("Instructor not found")
+    return membership.course_class
+
+def partition_classes(course_classes):
+    """
+    Splits a list of classes (with their courses loaded) in past, current and future classes.
+    Past classes are sorted from the most recent, the others by start date.
+    """
+    today = datetime.date.today()
+
+    past_classes = sorted(
+        (course_class for course_class in course_classes if course_class.end_date < today),
+        key=lambda course_class: (-course_class.end_date.toordinal(), course_class.course.name, course_class.code)
+    )
+    current_classes = sorted(
+        (course_class for course_class in course_classes if course_class.start_date <= today <= course_class.end_date),
+        key=lambda course_class: (course_class.start_date, course_class.course.name, course_class.code)
+    )
+    future_classes = sorted(
+        (course_class for course_class in course_classes if course_class.start_date > today),
+        key=lambda course_class: (course_class.start_date, course_class.course.name, course_class.code)
+    )
+
+    return past_classes, current_classes, future_classes
     
-    return ranking
+def get_ranking_data(course_class, ranking_size):
+    return leaderboard.get_top(course_class, ranking_size)
     
 def get_students_data(course_class):
     return Student.objects.values(
@@ -231,13 +331,26 @@ def get_assignments_data(enrollment):
     if enrollment == None:
         return None
     
+    # Everything is loaded in two queries: the assignment tasks of the class
+    # (with their assignments and tasks) and the grades of the enrollment
+    assignment_tasks = AssignmentTask.objects.filter(
+        course_class_id=enrollment.course_class_id
+    ).select_related(
+        'assignment', 'task'
+    ).order_by('assignment_id', 'is_optional', 'id')
+
+    grades = {
+        grade.assignment_task_id: grade
+        for grade in Grade.objects.filter(enrollment_id=enrollment.id)
+    }
+
+    assignment_tasks_by_assignment = {}
+    for assignment_task in assignment_tasks:
+        assignment_tasks_by_assignment.setdefault(assignment_task.assignment, []).append(assignment_task)
+
     points_data = []
-    assignments = enrollment.course_class.course.assignment_set.order_by('id').all()
-    for assignment in assignments:
-        tasks_data = get_tasks_data(assignment, enrollment)
-        
-        if len(tasks_data) == 0:
-            continue
+    for assignment, assignment_tasks in assignment_tasks_by_assignment.items():
+        tasks_data = get_tasks_data(assignment_tasks, grades)
         
         is_there_any_task_completed = reduce(
             lambda x, y: True if y['grade_points'] != None else x,
@@ -287,16 +400,17 @@ def get_assignments_data(enrollment):
 
     return points_data
 
-def get_tasks_data(assignment, enrollment):
+def get_tasks_data(assignment_tasks, grades):
     tasks_data = []
-    for assignment_task in assignment.ordered_assignment_tasks(enrollment.course_class):
-        grade = assignment_task.grade_set.all().filter(enrollment=enrollment).first()
+    for assignment_task in assignment_tasks:
+        grade = grades.get(assignment_task.id)
 
         task_data = {}
         task_data['name'] = assignment_task.task.name
         task_data['task_points'] = assignment_task.points
         task_data['is_optional'] = assignment_task.is_optional
         if grade != None:
+            grade.assignment_task = assignment_task # avoids a query in grade.points
             task_data['grade_percentage'] = round(grade.score * 100) if assignment_task.points != None else None
             task_data['grade_points'] = grade.points
             task_data['grade_is_canceled'] = grade.is_canceled
@@ -313,10 +427,19 @@ def get_achievements_data(enrollment):
     if enrollment == None:
         return None
     
+    # Two queries: the class badges (with their badges) and the achievements of the enrollment
+    class_badges = ClassBadge.objects.filter(
+        course_class_id=enrollment.course_class_id
+    ).select_related('badge').order_by('id')
+
+    achievements_by_class_badge = {
+        achievement.class_badge_id: achievement
+        for achievement in Achievement.objects.filter(enrollment_id=enrollment.id)
+    }
+
     achievements_data = []
-    class_badges = enrollment.course_class.classbadge_set.order_by('id').all()
     for class_badge in class_badges:
-        achievement = class_badge.achievement_set.filter(enrollment=enrollment).first()
+        achievement = achievements_by_class_badge.get(class_badge.id)
         
         achievement_data = {}
         achievement_data['percentage'] = achievement.percentage if achievement != None else 0
@@ -61,6 +61,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'course.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -137,6 +138,78 @@ AUTH_PASSWORD_VALIDATORS = [
 AUTHENTICATION_BACKENDS = ['course.backend.UsernameOrEmailBackend']
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The class pages are cached per class (see course/caching.py). The version of the
+# cached data of each class is stored in the database, so every process sees the
+# writes of the others even with the default per-process cache. A backend shared by
+# all the processes just avoids computing the same data in each of them:
+# CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache CACHE_LOCATION=/var/tmp/gamified_education_cache
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+COURSE_CACHE_TIMEOUT = int(os.environ.get('COURSE_CACHE_TIMEOUT', 60 * 60))
+MEMBERSHIP_CACHE_TIMEOUT = int(os.environ.get('MEMBERSHIP_CACHE_TIMEOUT', 5 * 60))
+
+
+# Request instrumentation (see course/instrumentation.py)
+# Maximum queries and wall time (in milliseconds) of each view, by view name, with
+# '*' for the views not listed. Over budget, a warning is logged. When VIEW_BUDGETS_RAISE
+# is set, going over the query budget raises BudgetExceeded instead (wall time depends
+# on the machine, so it is only logged). The test runner sets it; with another runner
+# (e.g. pytest), set the VIEW_BUDGETS_RAISE=True environment variable.
+
+VIEW_BUDGETS = {
+    'course:classes': {'queries': 6, 'wall_ms': 1000},
+    'course:home': {'queries': 10, 'wall_ms': 1000},
+    'course:assignments': {'queries': 10, 'wall_ms': 1000},
+    'course:gradebook': {'queries': 10, 'wall_ms': 2000},
+    'course:gradebook_json': {'queries': 10, 'wall_ms': 2000},
+    'course:gradebook_csv': {'queries': 6, 'wall_ms': 1000},
+    '*': {'queries': 40, 'wall_ms': 3000},
+}
+VIEW_BUDGETS_RAISE = os.environ.get('VIEW_BUDGETS_RAISE', 'False') == 'True'
+INSTRUMENTATION_WINDOW = int(os.environ.get('INSTRUMENTATION_WINDOW', 1000)) # requests kept per view
+
+TEST_RUNNER = 'gamifiededucation.test_runner.TestRunner'
+
+# Prometheus metrics at /metrics (see course/metrics.py), only for staff users and
+# requests with "Authorization: Bearer <METRICS_TOKEN>" (when it is set)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# When PROMETHEUS_MULTIPROC_DIR is set, each process writes its metrics to files in
+# that directory and /metrics adds up all of them; otherwise each process keeps its
+# own metrics in memory (tests, one-off commands). gunicorn.conf.py sets it for the
+# web workers, and the Procfile sets the same directory for the sendinvitations and
+# runjobs workers (set it in the environment of cron commands to include them too).
+# gunicorn.conf.py empties it when the server starts, so restart the other processes
+# with it (a deploy does).
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+if PROMETHEUS_MULTIPROC_DIR != '':
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'course': {
+            'handlers': ['console'],
+            'level': os.environ.get('COURSE_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.11/topics/i18n/
 
@@ -181,6 +254,21 @@ EMAIL_PORT = os.environ.get('EMAIL_PORT', 25)
 EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', False)
 EMAIL_REPLY_TO = json.loads(os.environ.get('EMAIL_REPLY_TO', "[]"))
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', '')
+
+# Invitation outbox (see course/invitations.py)
+INVITATION_BATCH_SIZE = int(os.environ.get('INVITATION_BATCH_SIZE', 50))
+INVITATION_MAX_ATTEMPTS = int(os.environ.get('INVITATION_MAX_ATTEMPTS', 5))
+INVITATION_RETRY_DELAY = int(os.environ.get('INVITATION_RETRY_DELAY', 60)) # seconds, doubled after each failure
+INVITATIONS_PER_MINUTE = int(os.environ.get('INVITATIONS_PER_MINUTE', 0)) # 0 for no limit
+# Seconds after which the invitations claimed by a worker that died are sent by another one.
+# It must be longer than sending a whole batch takes (with the rate limit too).
+INVITATION_LEASE = int(os.environ.get('INVITATION_LEASE', 15 * 60))
+
+# Background jobs (see course/jobs.py)
+# Seconds without progress after which a running job is taken by another worker (its worker
+# is assumed dead). It must be longer than the slowest step of a job (e.g. refreshing one class).
+JOB_LEASE = int(os.environ.get('JOB_LEASE', 15 * 60))
+
 RECAPTCHA_PUBLIC_KEY = os.environ.get('RECAPTCHA_PUBLIC_KEY', '')
 RECAPTCHA_PRIVATE_KEY = os.environ.get('RECAPTCHA_PRIVATE_KEY', '')
 NOCAPTCHA = True
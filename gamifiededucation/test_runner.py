@@ -0,0 +1,17 @@
+import logging
+import os
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the tests raising BudgetExceeded when a view goes over its query budget
+    (see course/instrumentation.py), and without the log line of each request.
+    VIEW_BUDGETS_RAISE=False and COURSE_LOG_LEVEL override them.
+    """
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        settings.VIEW_BUDGETS_RAISE = os.environ.get('VIEW_BUDGETS_RAISE', 'True') == 'True'
+        if 'COURSE_LOG_LEVEL' not in os.environ:
+            logging.getLogger('course').setLevel(logging.WARNING)
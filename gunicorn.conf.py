@@ -0,0 +1,18 @@
+# Gunicorn settings, read by default from the working directory
+import os
+import shutil
+
+# The Prometheus metrics of all the processes are written to this directory and
+# added up at /metrics (the same directory is set for the other processes in the Procfile)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/gamified_education_metrics')
+
+def on_starting(server):
+    # Metrics of a previous run would be added to the new ones
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    if directory != '':
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)